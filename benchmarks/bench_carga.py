@@ -0,0 +1,479 @@
+"""Prueba de carga reproducible del servidor con clientes virtuales concurrentes.
+
+Arranca servidor.py en un directorio temporal y lanza --clientes clientes virtuales, cada uno
+con su conexión (protocolo binario) y su usuario. Durante --duracion segundos cada cliente
+elige comandos al azar según la --mezcla (LIST_FILES, DOWNLOAD_FILE, UPLOAD_FILE, LOGIN y
+SHARE), con ficheros de los --tamanos indicados. Con la misma --semilla cada cliente repite la
+misma secuencia. Con --retardo_ms o --ancho_banda el tráfico pasa por proxy_latencia.py.
+
+Muestra por comando las operaciones/s, los MB/s de contenido, los percentiles de la latencia y
+los errores, y la CPU y la memoria (RSS) del servidor, leídas de /proc (solo en Linux). Con
+--salida guarda los resultados en JSON. Con --base los compara con otros guardados antes con la
+misma configuración y termina con el código 1 si el rendimiento ha empeorado más de la
+tolerancia, para que una regresión haga fallar la ejecución. Los clientes abren el socket con
+cliente.conectar, con las mismas opciones que el cliente real, y una descarga o subida pequeña
+que tarde lo que un ACK retardado (unos 40 ms) cuenta como regresión; una referencia que la
+tenga se rechaza.
+
+Los clientes son hilos de este proceso: con muchos clientes y peticiones pequeñas el propio
+generador de carga puede quedarse sin CPU antes que el servidor (se ve en cpu_pct).
+
+    python benchmarks/bench_carga.py --clientes 8 --duracion 20 --salida base.json
+    python benchmarks/bench_carga.py --clientes 8 --duracion 20 --base base.json
+    python benchmarks/bench_carga.py --mezcla DOWNLOAD_FILE:1 UPLOAD_FILE:1 --tamanos 1G --clientes 2
+    python benchmarks/bench_carga.py --clientes 16 --servidor "--workers 4 --hilos 8"
+"""
+import argparse as ap
+import json
+import os
+import platform
+import random
+import shlex
+import sys
+import tempfile
+import threading
+import time
+
+import comun
+
+sys.path.insert(0, comun.RAIZ)
+import cliente     # Están en la raíz del repositorio, junto a servidor.py
+import protocolo
+
+COMANDOS = ("LIST_FILES", "DOWNLOAD_FILE", "UPLOAD_FILE", "LOGIN", "SHARE")
+TRANSFERENCIAS = ("DOWNLOAD_FILE", "UPLOAD_FILE")   # Su latencia se mide también por tamaño
+ESPERA_ACK_MS = 30  # Una transferencia pequeña por encima de esto sin retardo simulado es Nagle + ACK retardado
+UNIDADES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+CLAVE = "carga"     # Contraseña de los usuarios de la prueba
+
+
+def tamano(texto):
+    """'1K', '64M', '1G' o un número de bytes."""
+    texto = texto.strip().upper().rstrip("B")
+    if texto[-1:] in UNIDADES:
+        return int(float(texto[:-1]) * UNIDADES[texto[-1]])
+    return int(texto)
+
+
+def nombre_tamano(tam):
+    for sufijo, unidad in sorted(UNIDADES.items(), key=lambda u: -u[1]):
+        if tam >= unidad and tam % unidad == 0:
+            return f"{tam // unidad}{sufijo}"
+    return str(tam)
+
+
+def mezcla(texto):
+    """'COMANDO:peso' -> (COMANDO, peso)."""
+    comando, _, peso = texto.partition(":")
+    comando = comando.upper()
+    if comando not in COMANDOS:
+        raise ap.ArgumentTypeError(f"comando '{comando}' no admitido (usa {', '.join(COMANDOS)})")
+    try:
+        return comando, float(peso or 1)
+    except ValueError:
+        raise ap.ArgumentTypeError(f"peso '{peso}' no válido")
+
+
+class Conexion:
+    """Conexión de un cliente virtual, con las peticiones que usa la prueba."""
+
+    def __init__(self, puerto):
+        self.sock = cliente.conectar("127.0.0.1", puerto)   # Con las mismas opciones que el cliente real
+        self.buf = bytearray(1 << 20)
+
+    def cerrar(self):
+        self.sock.close()
+
+    def respuesta(self):
+        cab = protocolo.recibir_cabecera(self.sock)
+        if cab is None:
+            raise ConnectionError("el servidor ha cerrado la conexión")
+        texto = protocolo.texto_respuesta(cab, protocolo.recibir_exacto(self.sock, cab.longitud))
+        return cab.estado == protocolo.ESTADO_OK, texto
+
+    def peticion(self, orden, *argumentos):
+        """Manda un comando y devuelve (ok, texto de la respuesta)."""
+        self.sock.sendall(protocolo.trama(protocolo.OPERACIONES[orden], protocolo.argumentos(argumentos)))
+        return self.respuesta()
+
+    def subir(self, ruta, nombre):
+        """UPLOAD_FILE de ruta con otro nombre, escrito como lo hace cliente.enviar_peticion.
+        Devuelve (ok, bytes enviados)."""
+        with open(ruta, "rb") as f:
+            tam = os.fstat(f.fileno()).st_size
+            peticion = (protocolo.trama(protocolo.OPERACIONES["UPLOAD_FILE"], protocolo.argumentos([nombre]))
+                        + protocolo.cabecera(protocolo.OP_DATOS, tam))
+            if tam <= protocolo.MAX_JUNTO:
+                self.sock.sendall(peticion + os.pread(f.fileno(), tam, 0))
+            else:
+                self.sock.sendall(peticion)
+                self.sock.sendfile(f, 0, tam)
+        ok, _ = self.respuesta()
+        return ok, tam
+
+    def descargar(self, nombre):
+        """DOWNLOAD_FILE descartando el contenido. Devuelve (ok, bytes recibidos)."""
+        self.sock.sendall(protocolo.trama(protocolo.OPERACIONES["DOWNLOAD_FILE"], protocolo.argumentos([nombre])))
+        cab = protocolo.recibir_cabecera(self.sock)
+        if cab is None:
+            raise ConnectionError("el servidor ha cerrado la conexión")
+        if cab.estado != protocolo.ESTADO_OK:
+            protocolo.recibir_exacto(self.sock, cab.longitud)
+            return False, 0
+        pendiente = cab.longitud
+        while pendiente:
+            leidos = self.sock.recv_into(self.buf, min(pendiente, len(self.buf)))
+            if not leidos:
+                raise ConnectionError("conexión cerrada a mitad de una descarga")
+            pendiente -= leidos
+        return True, cab.longitud
+
+
+class ClienteVirtual(threading.Thread):
+    """Un usuario que, tras registrarse y subir sus ficheros, lanza comandos hasta el final."""
+
+    def __init__(self, numero, puerto, ficheros, pesos, semilla, vecino, ventana):
+        super().__init__(daemon=True)
+        self.numero = numero
+        self.usuario = f"carga{numero}"
+        self.vecino = vecino
+        self.puerto = puerto
+        self.ficheros = ficheros    # tamaño -> ruta local
+        self.comandos, self.pesos = zip(*pesos)
+        self.azar = random.Random(f"{semilla}-{numero}")
+        self.ventana = ventana
+        self.latencias = {}         # comando -> [segundos]
+        self.por_tamano = {}        # (comando, tamaño) -> [segundos], solo de TRANSFERENCIAS
+        self.errores = {}
+        self.bytes = {}
+        self.fallo = None
+
+    def preparar(self, conexion):
+        conexion.peticion("SING_IN", self.usuario, CLAVE, CLAVE)
+        ok, texto = conexion.peticion("LOGIN", self.usuario, CLAVE)
+        if not ok:
+            raise RuntimeError(f"LOGIN de {self.usuario}: {texto}")
+        for tam, ruta in self.ficheros.items():
+            ok, _ = conexion.subir(ruta, f"base_{nombre_tamano(tam)}.bin")
+            if not ok:
+                raise RuntimeError(f"no se ha podido subir el fichero base de {nombre_tamano(tam)}")
+
+    def operacion(self, conexion, comando):
+        """Ejecuta un comando. Devuelve (ok, bytes de contenido transferidos, tamaño del fichero o None)."""
+        if comando == "LIST_FILES":
+            return conexion.peticion("LIST_FILES")[0], 0, None
+        if comando == "LOGIN":
+            return conexion.peticion("LOGIN", self.usuario, CLAVE)[0], 0, None
+        tam = self.azar.choice(list(self.ficheros))
+        if comando == "DOWNLOAD_FILE":
+            return *conexion.descargar(f"base_{nombre_tamano(tam)}.bin"), tam
+        if comando == "UPLOAD_FILE":
+            return *conexion.subir(self.ficheros[tam], f"subida_{nombre_tamano(tam)}.bin"), tam
+        return conexion.peticion("SHARE", f"base_{nombre_tamano(tam)}.bin", self.vecino)[0], 0, tam
+
+    def run(self):
+        try:
+            conexion = Conexion(self.puerto)
+        except OSError as e:
+            self.fallo = str(e)
+            self.ventana.abortar()
+            return
+        try:
+            self.preparar(conexion)
+            inicio, fin = self.ventana.esperar()
+            while time.perf_counter() < fin:
+                comando = self.azar.choices(self.comandos, self.pesos)[0]
+                t0 = time.perf_counter()
+                ok, transferidos, tam = self.operacion(conexion, comando)
+                t1 = time.perf_counter()
+                if t0 >= inicio and t1 <= fin:     # Fuera del calentamiento y del plazo
+                    self.latencias.setdefault(comando, []).append(t1 - t0)
+                    if comando in TRANSFERENCIAS:
+                        self.por_tamano.setdefault((comando, tam), []).append(t1 - t0)
+                    self.bytes[comando] = self.bytes.get(comando, 0) + transferidos
+                    if not ok:
+                        self.errores[comando] = self.errores.get(comando, 0) + 1
+        except (OSError, RuntimeError, protocolo.ErrorProtocolo, threading.BrokenBarrierError) as e:
+            self.fallo = f"{self.usuario}: {e}"
+            self.ventana.abortar()
+        finally:
+            conexion.cerrar()
+
+
+class Ventana:
+    """Intervalo de medida común a todos los clientes: empieza tras el calentamiento, cuando
+    todos han terminado de prepararse."""
+
+    def __init__(self, clientes, calentamiento, duracion):
+        self.calentamiento = calentamiento
+        self.duracion = duracion
+        self.inicio = self.fin = None
+        self.barrera = threading.Barrier(clientes + 1, action=self._fijar)
+
+    def _fijar(self):
+        self.inicio = time.perf_counter() + self.calentamiento
+        self.fin = self.inicio + self.duracion
+
+    def esperar(self):
+        self.barrera.wait()
+        return self.inicio, self.fin
+
+    def abortar(self):
+        self.barrera.abort()
+
+
+def proceso_servidor(pid):
+    """(segundos de CPU, RSS actual, RSS máximo en bytes) del servidor, o None sin /proc.
+    Con --workers suma los procesos hijos del supervisor."""
+    procesos = [pid]
+    try:
+        for entrada in os.listdir("/proc"):
+            if entrada.isdigit():
+                try:
+                    with open(f"/proc/{entrada}/stat") as f:
+                        if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                            procesos.append(int(entrada))
+                except (OSError, IndexError, ValueError):
+                    continue
+        cpu = rss = rss_max = 0
+        for p in procesos:
+            with open(f"/proc/{p}/stat") as f:
+                campos = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/status") as f:
+                memoria = {l.split(":")[0]: int(l.split()[1]) * 1024 for l in f if l.startswith(("VmRSS", "VmHWM"))}
+            cpu += (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")   # utime + stime
+            rss += memoria.get("VmRSS", 0)
+            rss_max += memoria.get("VmHWM", 0)
+    except (OSError, IndexError, ValueError):
+        return None
+    return cpu, rss, rss_max
+
+
+def percentil(ordenados, q):
+    """Percentil q (0-1) por el método del rango más cercano."""
+    if not ordenados:
+        return 0.0
+    return ordenados[min(max(int(q * len(ordenados) + 0.5) - 1, 0), len(ordenados) - 1)]
+
+
+def resumir(latencias, errores, transferidos, duracion):
+    ordenadas = sorted(latencias)
+    return {
+        "operaciones": len(ordenadas),
+        "errores": errores,
+        "ops_s": round(len(ordenadas) / duracion, 2),
+        "mb_s": round(transferidos / duracion / 1e6, 3),
+        "media_ms": round(sum(ordenadas) / len(ordenadas) * 1000, 3) if ordenadas else 0.0,
+        "p50_ms": round(percentil(ordenadas, 0.50) * 1000, 3),
+        "p90_ms": round(percentil(ordenadas, 0.90) * 1000, 3),
+        "p99_ms": round(percentil(ordenadas, 0.99) * 1000, 3),
+        "max_ms": round(ordenadas[-1] * 1000, 3) if ordenadas else 0.0,
+    }
+
+
+def resultados(clientes, duracion):
+    comandos = {}
+    todas, errores, transferidos = [], 0, 0
+    for comando in COMANDOS:
+        latencias = [l for c in clientes for l in c.latencias.get(comando, ())]
+        if not latencias:
+            continue
+        err = sum(c.errores.get(comando, 0) for c in clientes)
+        byt = sum(c.bytes.get(comando, 0) for c in clientes)
+        comandos[comando] = resumir(latencias, err, byt, duracion)
+        if comando in TRANSFERENCIAS:
+            tamanos = sorted({t for c in clientes for (o, t) in c.por_tamano if o == comando})
+            comandos[comando]["tamanos"] = {
+                nombre_tamano(t): resumir([l for c in clientes for l in c.por_tamano.get((comando, t), ())], 0, 0, duracion)
+                for t in tamanos}
+        todas += latencias
+        errores += err
+        transferidos += byt
+    return resumir(todas, errores, transferidos, duracion), comandos
+
+
+def mostrar(datos):
+    print(f"{'comando':>13} {'ops':>8} {'err':>5} {'ops/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for nombre, r in list(datos["comandos"].items()) + [("TOTAL", datos["total"])]:
+        print(f"{nombre:>13} {r['operaciones']:>8} {r['errores']:>5} {r['ops_s']:>9.1f} {r['mb_s']:>8.2f} "
+              f"{r['p50_ms']:>8.2f} {r['p90_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}")
+        tamanos = r.get("tamanos", {})
+        for tam, t in tamanos.items() if len(tamanos) > 1 else ():
+            print(f"{tam:>13} {t['operaciones']:>8} {'':>5} {t['ops_s']:>9.1f} {'':>8} "
+                  f"{t['p50_ms']:>8.2f} {t['p90_ms']:>8.2f} {t['p99_ms']:>8.2f} {t['max_ms']:>8.2f}")
+    s = datos["servidor"]
+    if s:
+        print(f"Servidor: {s['cpu_s']:.2f} s de CPU ({s['cpu_pct']:.0f}%, {s['cpu_us_op']:.0f} µs por operación), "
+              f"RSS {s['rss_mib']:.1f} MiB (máximo {s['rss_max_mib']:.1f} MiB)")
+
+
+def esperas_ack(datos):
+    """Transferencias pequeñas (las que van en una sola escritura, ver protocolo.MAX_JUNTO) con
+    una mediana de unos 40 ms sin retardo simulado: el síntoma de que cabecera y contenido salen
+    en escrituras separadas con Nagle activo y el otro extremo retrasa el ACK. Una referencia así
+    no sirve, porque la regresión quedaría dentro de la tolerancia."""
+    configuracion = datos["configuracion"]
+    if configuracion["retardo_ms"] or configuracion["ancho_banda"]:
+        return []
+    esperas = []
+    for comando in TRANSFERENCIAS:
+        for tam, r in datos["comandos"].get(comando, {}).get("tamanos", {}).items():
+            if tamano(tam) <= protocolo.MAX_JUNTO and r["p50_ms"] >= ESPERA_ACK_MS:
+                esperas.append(f"{comando} {tam} p50 {r['p50_ms']:g} ms")
+    return esperas
+
+
+def comparar(actual, base, tolerancia, tolerancia_latencia):
+    """Lista de regresiones de actual respecto a base (vacía si no hay ninguna)."""
+    regresiones = [f"{e} (Nagle + ACK retardado)" for e in esperas_ack(actual)]
+
+    def peor(que, valor, referencia, mayor_es_mejor, margen):
+        if not referencia:
+            return
+        cambio = (valor - referencia) / referencia
+        if (-cambio if mayor_es_mejor else cambio) > margen:
+            regresiones.append(f"{que}: {referencia:g} -> {valor:g} ({cambio:+.1%}, tolerancia {margen:.0%})")
+
+    grupos = [("TOTAL", actual["total"], base["total"])]
+    grupos += [(c, r, base["comandos"][c]) for c, r in actual["comandos"].items() if c in base["comandos"]]
+    for nombre, r, b in grupos:
+        peor(f"{nombre} ops/s", r["ops_s"], b["ops_s"], True, tolerancia)
+        peor(f"{nombre} p50", r["p50_ms"], b["p50_ms"], False, tolerancia_latencia)
+        peor(f"{nombre} p99", r["p99_ms"], b["p99_ms"], False, tolerancia_latencia)
+        if r["errores"] > b["errores"]:
+            regresiones.append(f"{nombre} errores: {b['errores']} -> {r['errores']}")
+    peor("TOTAL MB/s", actual["total"]["mb_s"], base["total"]["mb_s"], True, tolerancia)
+    if actual["servidor"] and base["servidor"]:
+        peor("CPU del servidor por operación (µs)", actual["servidor"]["cpu_us_op"], base["servidor"]["cpu_us_op"], False, tolerancia)
+        peor("RSS máximo del servidor (MiB)", actual["servidor"]["rss_max_mib"], base["servidor"]["rss_max_mib"], False, tolerancia)
+    return regresiones
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog=sys.argv[0], description='Prueba de carga del servidor con clientes virtuales')
+    parser.add_argument('--clientes', type=int, default=4, help='Clientes virtuales concurrentes (una conexión cada uno)')
+    parser.add_argument('--duracion', type=float, default=10, help='Segundos de medida')
+    parser.add_argument('--calentamiento', type=float, default=2, help='Segundos que se descartan antes de medir')
+    parser.add_argument('--mezcla', type=mezcla, nargs='+', metavar='COMANDO:PESO',
+                        default=[("LIST_FILES", 4), ("DOWNLOAD_FILE", 3), ("UPLOAD_FILE", 2), ("LOGIN", 1), ("SHARE", 1)],
+                        help=f'Comandos y su peso relativo ({", ".join(COMANDOS)})')
+    parser.add_argument('--tamanos', type=tamano, nargs='+', default=[1 << 10, 1 << 20], metavar='TAM',
+                        help='Tamaños de los ficheros de DOWNLOAD_FILE, UPLOAD_FILE y SHARE (1K ... 1G)')
+    parser.add_argument('--semilla', type=int, default=0, help='Semilla de la secuencia de comandos de cada cliente')
+    parser.add_argument('--engine', default='hilos', choices=('secuencial', 'hilos', 'asyncio'), help='Motor del servidor')
+    parser.add_argument('--servidor', default='', help='Argumentos adicionales para servidor.py (p. ej. "--hilos 16")')
+    parser.add_argument('--retardo_ms', type=float, default=0, help='Retardo añadido en cada sentido por proxy_latencia.py')
+    parser.add_argument('--ancho_banda', type=float, default=0, help='MB/s totales del enlace simulado (0 = sin límite)')
+    parser.add_argument('--ventana_kib', type=int, default=16384, help='Ventana por conexión del proxy')
+    parser.add_argument('--salida', help='Fichero JSON donde guardar los resultados')
+    parser.add_argument('--base', help='Resultados JSON de referencia con los que comparar')
+    parser.add_argument('--tolerancia', type=float, default=0.10, help='Empeoramiento admitido en ops/s, MB/s, CPU y memoria (0.10 = 10%%)')
+    parser.add_argument('--tolerancia_latencia', type=float, default=0.25, help='Empeoramiento admitido en los percentiles de la latencia')
+    args = parser.parse_args(sys.argv[1:])
+    if args.engine == 'secuencial' and args.clientes > 1:
+        # Atiende una conexión cada vez: los demás clientes no llegarían a prepararse
+        parser.error("el motor secuencial solo admite --clientes 1")
+
+    configuracion = {
+        "clientes": args.clientes, "duracion": args.duracion, "calentamiento": args.calentamiento,
+        "mezcla": dict(args.mezcla), "tamanos": args.tamanos, "semilla": args.semilla, "engine": args.engine,
+        "servidor": args.servidor, "retardo_ms": args.retardo_ms, "ancho_banda": args.ancho_banda,
+        "ventana_kib": args.ventana_kib,
+    }
+    base = None
+    if args.base:
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+        if base.get("configuracion") != configuracion:
+            distintos = sorted(k for k in configuracion if base.get("configuracion", {}).get(k) != configuracion[k])
+            sys.exit(f"Error: la referencia {args.base} se midió con otra configuración ({', '.join(distintos)})")
+        if any("tamanos" not in base["comandos"][c] for c in TRANSFERENCIAS if c in base["comandos"]):
+            sys.exit(f"Error: la referencia {args.base} no tiene latencias por tamaño; vuelve a generarla")
+        esperas = esperas_ack(base)
+        if esperas:
+            sys.exit(f"Error: la referencia {args.base} tiene esperas de ACK retardado ({', '.join(esperas)}); vuelve a generarla")
+
+    with tempfile.TemporaryDirectory() as raiz:
+        servidor_dir = os.path.join(raiz, "servidor")
+        cliente_dir = os.path.join(raiz, "cliente")
+        os.mkdir(servidor_dir)
+        os.mkdir(cliente_dir)
+        ficheros = {}
+        for tam in sorted(set(args.tamanos)):
+            ficheros[tam] = os.path.join(cliente_dir, f"{nombre_tamano(tam)}.bin")
+            comun.crear_fichero(ficheros[tam], tam)
+
+        servidor, puerto = comun.arrancar_servidor(servidor_dir, ["--engine", args.engine] + shlex.split(args.servidor))
+        proxy = None
+        destino = puerto
+        if args.retardo_ms or args.ancho_banda:
+            proxy, destino = comun.arrancar_proxy(raiz, puerto, ["--retardo_ms", str(args.retardo_ms),
+                                                                 "--ventana_kib", str(args.ventana_kib),
+                                                                 "--ancho_banda", str(args.ancho_banda)])
+        try:
+            ventana = Ventana(args.clientes, args.calentamiento, args.duracion)
+            clientes = [ClienteVirtual(i, destino, ficheros, args.mezcla, args.semilla,
+                                       f"carga{(i + 1) % args.clientes}", ventana)
+                        for i in range(args.clientes)]
+            for c in clientes:
+                c.start()
+            antes = despues = None
+            try:
+                ventana.esperar()
+            except threading.BrokenBarrierError:
+                pass
+            else:
+                time.sleep(max(ventana.inicio - time.perf_counter(), 0))
+                antes = proceso_servidor(servidor.pid)
+                time.sleep(max(ventana.fin - time.perf_counter(), 0))
+                despues = proceso_servidor(servidor.pid)
+            for c in clientes:
+                c.join()
+        finally:
+            if proxy:
+                comun.parar(proxy)
+            comun.parar(servidor, puerto)
+
+    fallos = [c.fallo for c in clientes if c.fallo]
+    if fallos:
+        sys.exit("Error: " + "\n".join(fallos))
+
+    total, comandos = resultados(clientes, args.duracion)
+    servidor_datos = None
+    if antes and despues:
+        cpu = despues[0] - antes[0]
+        servidor_datos = {
+            "cpu_s": round(cpu, 3),
+            "cpu_pct": round(cpu / args.duracion * 100, 1),
+            "cpu_us_op": round(cpu / max(total["operaciones"], 1) * 1e6, 1),
+            "rss_mib": round(despues[1] / (1 << 20), 1),
+            "rss_max_mib": round(despues[2] / (1 << 20), 1),
+        }
+    datos = {
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "configuracion": configuracion,
+        "total": total,
+        "comandos": comandos,
+        "servidor": servidor_datos,
+    }
+    print(f"{args.clientes} clientes, {args.duracion:g} s, motor {args.engine}, "
+          f"tamaños {' '.join(nombre_tamano(t) for t in args.tamanos)}"
+          + (f", RTT {2 * args.retardo_ms:g} ms" if args.retardo_ms else "")
+          + (f", enlace de {args.ancho_banda:g} MB/s" if args.ancho_banda else ""))
+    mostrar(datos)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(datos, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+    if base:
+        regresiones = comparar(datos, base, args.tolerancia, args.tolerancia_latencia)
+        if regresiones:
+            print(f"Regresiones respecto a {args.base}:")
+            for r in regresiones:
+                print(f"  {r}")
+            sys.exit(1)
+        print(f"Sin regresiones respecto a {args.base}")
@@ -0,0 +1,77 @@
+"""Benchmark de la compresión en las transferencias (cliente.py --compresion).
+
+Sube y descarga un fichero de texto (un log en CSV, muy comprimible) y otro aleatorio (como uno
+ya comprimido) a través de proxy_latencia.py con el ancho de banda limitado, con cada algoritmo.
+Muestra los MB/s efectivos (bytes del fichero original / tiempo): con un enlace lento compensa
+comprimir el texto, y el fichero aleatorio no debe ir más lento que sin comprimir gracias a la
+detección por muestras.
+
+    python benchmarks/bench_compresion.py --tam_mib 32 --ancho_banda 12.5
+"""
+import argparse as ap
+import filecmp
+import os
+import random
+import sys
+import tempfile
+
+import comun
+
+
+def crear_log(ruta, tam):
+    """Fichero CSV parecido a un log de accesos, de unos tam bytes."""
+    aleatorio = random.Random(0)
+    escrito = 0
+    with open(ruta, "w") as f:
+        i = 0
+        while escrito < tam:
+            linea = (f"{i},2026-10-18T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d},usuario{aleatorio.randint(1, 200)},"
+                     f"GET /api/v1/recursos/{aleatorio.randint(1, 5000)},{aleatorio.choice((200, 200, 200, 304, 404))},{aleatorio.randint(100, 90000)}\n")
+            f.write(linea)
+            escrito += len(linea)
+            i += 1
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog=sys.argv[0], description='Benchmark de la compresión de las transferencias')
+    parser.add_argument('--tam_mib', type=int, default=32, help='Tamaño de los ficheros de prueba en MiB')
+    parser.add_argument('--ancho_banda', type=float, default=12.5, help='MB/s del enlace simulado (12.5 = 100 Mbit/s)')
+    parser.add_argument('--retardo_ms', type=float, default=1, help='Retardo del proxy en cada sentido')
+    parser.add_argument('--nivel', type=int, default=0, help='Nivel de compresión (0 = el de cada algoritmo)')
+    parser.add_argument('--algoritmos', nargs='+', default=['no', 'zlib', 'lzma', 'bz2'], help='Algoritmos a probar')
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as raiz:
+        servidor_dir = os.path.join(raiz, "servidor")
+        cliente_dir = os.path.join(raiz, "cliente")
+        os.mkdir(servidor_dir)
+        os.mkdir(cliente_dir)
+        tam = args.tam_mib << 20
+        ficheros = {"log.csv": crear_log, "aleatorio.bin": comun.crear_fichero}
+        for nombre, crear in ficheros.items():
+            crear(os.path.join(cliente_dir, nombre), tam)
+
+        servidor, puerto = comun.arrancar_servidor(servidor_dir, ["--engine", "hilos"])
+        proxy, puerto_proxy = comun.arrancar_proxy(raiz, puerto, ["--retardo_ms", str(args.retardo_ms),
+                                                                  "--ventana_kib", "16384",
+                                                                  "--ancho_banda", str(args.ancho_banda)])
+        try:
+            print(f"Ficheros de {args.tam_mib} MiB, enlace de {args.ancho_banda:g} MB/s, RTT {2 * args.retardo_ms:g} ms")
+            print(f"{'algoritmo':>9} {'fichero':>14} {'subida MB/s':>12} {'descarga MB/s':>14}")
+            for algoritmo in args.algoritmos:
+                opciones = ["--compresion", algoritmo, "--nivel", str(args.nivel)]
+                for nombre in ficheros:
+                    original = os.path.join(cliente_dir, nombre)
+                    subida = comun.cliente(puerto_proxy, ["UPLOAD_FILE", nombre], cliente_dir, opciones)
+                    subido = os.path.join(servidor_dir, nombre)
+                    descarga_dir = os.path.join(raiz, f"descarga-{algoritmo}")
+                    os.makedirs(descarga_dir, exist_ok=True)
+                    descarga = comun.cliente(puerto_proxy, ["DOWNLOAD_FILE", nombre], descarga_dir, opciones)
+                    for copia in (subido, os.path.join(descarga_dir, nombre)):
+                        if not filecmp.cmp(original, copia, shallow=False):
+                            raise RuntimeError(f"{copia} no coincide con el original ({algoritmo})")
+                    os.remove(subido)
+                    print(f"{algoritmo:>9} {nombre:>14} {tam / subida / 1e6:>12.1f} {tam / descarga / 1e6:>14.1f}", flush=True)
+        finally:
+            comun.parar(proxy)
+            comun.parar(servidor, puerto)
@@ -0,0 +1,66 @@
+"""Benchmark de transferencias en paralelo (cliente.py --conexiones N).
+
+Sube y descarga un fichero con 1, 2, 4 y 8 conexiones a través de proxy_latencia.py, que añade
+retardo y limita la ventana de cada conexión como un enlace de larga distancia, y muestra los
+MB/s de cada caso. Comprueba además que los ficheros llegan idénticos.
+
+    python benchmarks/bench_paralelo.py --tam_mib 32 --retardo_ms 25 --ventana_kib 256
+"""
+import argparse as ap
+import filecmp
+import os
+import sys
+import tempfile
+
+import comun
+
+
+def medir(puerto, comando, directorio, conexiones, repeticiones):
+    """Mejor tiempo de varias repeticiones de un comando del cliente."""
+    return min(comun.cliente(puerto, comando, directorio, ["--conexiones", str(conexiones)])
+               for _ in range(repeticiones))
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog=sys.argv[0], description='Benchmark de transferencias con varias conexiones')
+    parser.add_argument('--tam_mib', type=int, default=32, help='Tamaño del fichero de prueba en MiB')
+    parser.add_argument('--retardo_ms', type=float, default=25, help='Retardo del proxy en cada sentido')
+    parser.add_argument('--ventana_kib', type=int, default=256, help='Ventana por conexión del proxy')
+    parser.add_argument('--ancho_banda', type=float, default=0, help='MB/s totales del enlace simulado (0 = sin límite)')
+    parser.add_argument('--conexiones', type=int, nargs='+', default=[1, 2, 4, 8], help='Número de conexiones a probar')
+    parser.add_argument('--repeticiones', type=int, default=1, help='Repeticiones de cada medida (se queda la mejor)')
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as raiz:
+        servidor_dir = os.path.join(raiz, "servidor")
+        cliente_dir = os.path.join(raiz, "cliente")
+        os.mkdir(servidor_dir)
+        os.mkdir(cliente_dir)
+        tam = args.tam_mib << 20
+        comun.crear_fichero(os.path.join(cliente_dir, "prueba.bin"), tam)
+
+        servidor, puerto = comun.arrancar_servidor(servidor_dir, ["--engine", "hilos", "--hilos", str(2 * max(args.conexiones) + 2)])
+        proxy, puerto_proxy = comun.arrancar_proxy(raiz, puerto, ["--retardo_ms", str(args.retardo_ms),
+                                                                  "--ventana_kib", str(args.ventana_kib),
+                                                                  "--ancho_banda", str(args.ancho_banda)])
+        try:
+            print(f"Fichero de {args.tam_mib} MiB, RTT {2 * args.retardo_ms:g} ms, ventana {args.ventana_kib} KiB por conexión")
+            print(f"{'conexiones':>10} {'subida MB/s':>12} {'descarga MB/s':>14}")
+            for n in args.conexiones:
+                subida = medir(puerto_proxy, ["UPLOAD_FILE", "prueba.bin"], cliente_dir, n, args.repeticiones)
+                subido = os.path.join(servidor_dir, "prueba.bin")
+                if not filecmp.cmp(subido, os.path.join(cliente_dir, "prueba.bin"), shallow=False):
+                    raise RuntimeError(f"la subida con {n} conexiones no coincide con el original")
+                descarga_dir = os.path.join(raiz, f"descarga{n}")
+                os.mkdir(descarga_dir)
+                descarga = medir(puerto_proxy, ["DOWNLOAD_FILE", "prueba.bin"], descarga_dir, n, args.repeticiones)
+                if not filecmp.cmp(subido, os.path.join(descarga_dir, "prueba.bin"), shallow=False):
+                    raise RuntimeError(f"la descarga con {n} conexiones no coincide con el original")
+                os.remove(subido)
+                for nombre in os.listdir(servidor_dir):
+                    if nombre.startswith("prueba"):
+                        os.remove(os.path.join(servidor_dir, nombre))
+                print(f"{n:>10} {tam / subida / 1e6:>12.1f} {tam / descarga / 1e6:>14.1f}", flush=True)
+        finally:
+            comun.parar(proxy)
+            comun.parar(servidor, puerto)
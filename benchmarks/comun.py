@@ -0,0 +1,84 @@
+"""Utilidades compartidas por los benchmarks: arrancar el servidor y el proxy en un directorio
+temporal y lanzar el cliente como lo haría un usuario."""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVIDOR = os.path.join(RAIZ, "servidor.py")
+CLIENTE = os.path.join(RAIZ, "cliente.py")
+PROXY = os.path.join(RAIZ, "benchmarks", "proxy_latencia.py")
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def esperar_puerto(puerto, limite=10):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        try:
+            socket.create_connection(("127.0.0.1", puerto), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nadie escucha en el puerto {puerto}")
+
+
+def arrancar(script, argumentos, directorio, puerto):
+    """Lanza un script en segundo plano y espera a que escuche en puerto."""
+    proceso = subprocess.Popen([sys.executable, script] + argumentos, cwd=directorio,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    esperar_puerto(puerto)
+    return proceso
+
+
+def arrancar_servidor(directorio, argumentos=()):
+    puerto = puerto_libre()
+    proceso = arrancar(SERVIDOR, ["--ip", "127.0.0.1", "--puerto", str(puerto)] + list(argumentos), directorio, puerto)
+    return proceso, puerto
+
+
+def arrancar_proxy(directorio, destino, argumentos=()):
+    puerto = puerto_libre()
+    proceso = arrancar(PROXY, ["--puerto", str(puerto), "--destino", f"127.0.0.1:{destino}"] + list(argumentos), directorio, puerto)
+    return proceso, puerto
+
+
+def cliente(puerto, comando, directorio, opciones=()):
+    """Ejecuta cliente.py y devuelve los segundos que ha tardado. Lanza un error si falla."""
+    inicio = time.perf_counter()
+    resultado = subprocess.run([sys.executable, CLIENTE, "--puerto", str(puerto)] + list(opciones) + list(comando),
+                               cwd=directorio, capture_output=True, text=True)
+    segundos = time.perf_counter() - inicio
+    if resultado.returncode != 0:
+        raise RuntimeError(f"{' '.join(comando)} ha fallado:\n{resultado.stdout}{resultado.stderr}")
+    return segundos
+
+
+def parar(proceso, puerto=None):
+    """Apaga el servidor con SHUTDOWN (o el proceso a secas) y espera a que termine."""
+    if puerto is None:
+        proceso.terminate()
+    else:
+        try:
+            cliente(puerto, ["SHUTDOWN"], RAIZ)
+        except RuntimeError:
+            proceso.terminate()
+    try:
+        proceso.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proceso.kill()
+        proceso.wait()
+
+
+def crear_fichero(ruta, tam):
+    with open(ruta, "wb") as f:
+        while tam > 0:
+            bloque = os.urandom(min(tam, 1 << 20))
+            f.write(bloque)
+            tam -= len(bloque)
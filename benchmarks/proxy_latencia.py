@@ -0,0 +1,120 @@
+"""Proxy TCP que simula un enlace de larga distancia ("long fat pipe") entre cliente y servidor.
+
+Cada trozo de datos se entrega con --retardo_ms de retraso en cada sentido, y cada conexión solo
+puede tener --ventana_kib KiB pendientes de confirmar (como la ventana de TCP): una sola conexión
+no pasa de ventana / RTT aunque el enlace dé para más. Con --ancho_banda se limita además el
+total del enlace, compartido por todas las conexiones.
+
+    python benchmarks/proxy_latencia.py --puerto 6000 --destino 127.0.0.1:5005 --retardo_ms 25
+"""
+import asyncio
+import argparse as ap
+import sys
+import time
+
+
+class Enlace:
+    """Ancho de banda total del enlace (cubo de fichas compartido por todas las conexiones)."""
+
+    def __init__(self, bytes_por_segundo):
+        self.tasa = bytes_por_segundo
+        self.disponible = 0.0
+        self.ultimo = time.monotonic()
+        self.cerrojo = asyncio.Lock()
+
+    async def consumir(self, n):
+        if not self.tasa:
+            return
+        async with self.cerrojo:
+            while True:
+                ahora = time.monotonic()
+                self.disponible = min(self.disponible + (ahora - self.ultimo) * self.tasa, self.tasa * 0.05)
+                self.ultimo = ahora
+                if self.disponible >= n or self.disponible >= self.tasa * 0.05:
+                    self.disponible -= n
+                    return
+                await asyncio.sleep((n - self.disponible) / self.tasa)
+
+
+async def canal(lector, escritor, retardo, ventana, enlace):
+    """Copia un sentido de la conexión con retardo y ventana limitada."""
+    bucle = asyncio.get_running_loop()
+    cola = asyncio.Queue()
+    hueco = asyncio.Condition()
+    pendiente = 0
+
+    async def liberar(n):
+        # La "confirmación" tarda otro retardo en volver al emisor
+        nonlocal pendiente
+        async with hueco:
+            pendiente -= n
+            hueco.notify_all()
+
+    async def leer():
+        nonlocal pendiente
+        while True:
+            async with hueco:
+                await hueco.wait_for(lambda: pendiente < ventana)
+                maximo = ventana - pendiente
+            datos = await lector.read(min(maximo, 1 << 16))
+            pendiente += len(datos)
+            cola.put_nowait((bucle.time() + retardo, datos))
+            if not datos:
+                return
+
+    async def entregar():
+        while True:
+            instante, datos = await cola.get()
+            await asyncio.sleep(max(instante - bucle.time(), 0))
+            if not datos:
+                if escritor.can_write_eof():
+                    escritor.write_eof()
+                return
+            await enlace.consumir(len(datos))
+            escritor.write(datos)
+            await escritor.drain()
+            bucle.call_later(retardo, lambda n=len(datos): asyncio.ensure_future(liberar(n)))
+
+    try:
+        await asyncio.gather(leer(), entregar())
+    except (ConnectionError, OSError):
+        pass
+
+
+async def atender(cliente_r, cliente_w, destino, retardo, ventana, enlace):
+    try:
+        servidor_r, servidor_w = await asyncio.open_connection(*destino)
+    except OSError:
+        cliente_w.close()
+        return
+    await asyncio.gather(canal(cliente_r, servidor_w, retardo, ventana, enlace),
+                         canal(servidor_r, cliente_w, retardo, ventana, enlace))
+    servidor_w.close()
+    cliente_w.close()
+
+
+async def main(args):
+    ip, puerto = args.destino.rsplit(":", 1)
+    enlace = Enlace(args.ancho_banda * 1e6)
+    retardo = args.retardo_ms / 1000
+    servidor = await asyncio.start_server(
+        lambda r, w: atender(r, w, (ip, int(puerto)), retardo, args.ventana_kib * 1024, enlace),
+        args.ip, args.puerto)
+    print(f"Proxy en {args.ip}:{args.puerto} -> {args.destino} (retardo {args.retardo_ms} ms, "
+          f"ventana {args.ventana_kib} KiB)", flush=True)
+    async with servidor:
+        await servidor.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog=sys.argv[0], description='Proxy TCP con latencia y ventana limitada')
+    parser.add_argument('--ip', default='127.0.0.1', help='IP en la que escucha el proxy')
+    parser.add_argument('--puerto', type=int, required=True, help='Puerto en el que escucha el proxy')
+    parser.add_argument('--destino', default='127.0.0.1:5005', help='ip:puerto del servidor')
+    parser.add_argument('--retardo_ms', type=float, default=25, help='Retardo en cada sentido (RTT = 2 x retardo)')
+    parser.add_argument('--ventana_kib', type=int, default=256, help='KiB en vuelo por conexión y sentido')
+    parser.add_argument('--ancho_banda', type=float, default=0, help='MB/s totales del enlace (0 = sin límite)')
+    try:
+        asyncio.run(main(parser.parse_args(sys.argv[1:])))
+    except KeyboardInterrupt:
+        pass
@@ -2,6 +2,18 @@ import socket # Para usar sockets TCP
 import sys # Para admitir argumentos por línea de comandos
 import argparse as ap # Para facilitar el parseo de dichos argumentos. Usamos alias ap
 import os #para ficheros
+import re
+import shlex # Para separar en palabras los comandos del modo interactivo
+import select
+import time
+import hashlib
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import protocolo # Protocolo binario de tramas compartido con servidor.py
+import delta # Subidas por diferencias (al estilo rsync)
+import directorios # Transferencia de directorios completos como un tar
 
 def leer_fichero(nombre_fichero):
     try:
@@ -10,62 +22,74 @@ def leer_fichero(nombre_fichero):
     except:
         return (False, b'')
 
-if __name__ == '__main__':
-    # Lista de comandos
-    command_list = ("LIST_FILES", 
-                    "DOWNLOAD_FILE", 
-                    "DELETE_FILE", 
-                    "UPLOAD_FILE",
-                    "MOVE_FILE",
-                    "CREATE_DIR",
-                    "DELETE_DIR",
-                    "LIST_DIR",
-                    "HELP",
-                    "RENAME_FILE",
-                    #--EXTRA--
-                    "LOGIN",
-                    "SING_IN",
-                    "SHARE",
-                    "SHUTDOWN"    #comando que se proporciona al alumno
-                    )
-  
-    # Definimos el parseador. Por convenio, los argumentos opcionales se encabezan con '--'
-    # Para más información, consulte https://docs.python.org/3/howto/argparse.html
-    parser = ap.ArgumentParser(prog=sys.argv[0], description='Un cliente TCP de hola mundo')
-    parser.add_argument('--ip', help='IP del servidor', default="127.0.0.1") # Por defecto usamos localhost
-    # Los puertos por defecto están en el rango 0-1023. Podemos usar puertos a partir de ahí
-    parser.add_argument('--puerto', type=int, help='Puerto TCP de salida [1024-65535]', default=5005, choices=range(1024,65535), metavar='PUERTO (1024-65535)') 
-    parser.add_argument('--tam_buf',  type=int, help='Longitud del buffer interno', default=4096)
-    parser.add_argument('comando', nargs="+", help='Comando a ejecutar', default='LIST_FILES')
-    
-    # Parseamos los argumentos de acuerdo al parser
-    args = parser.parse_args(sys.argv[1:]) 
-    
-    # Miramos si los argumentos son correctos
-    comando = args.comando
+# Lista de comandos
+command_list = ("LIST_FILES", 
+                "DOWNLOAD_FILE", 
+                "DELETE_FILE", 
+                "UPLOAD_FILE",
+                "MOVE_FILE",
+                "CREATE_DIR",
+                "DELETE_DIR",
+                "LIST_DIR",
+                "HELP",
+                "RENAME_FILE",
+                #--EXTRA--
+                "LOGIN",
+                "SING_IN",
+                "SHARE",
+                "SHUTDOWN",    #comando que se proporciona al alumno
+                "HASH",
+                "UPLOAD_STATUS",
+                "STAT",
+                "GC",
+                "CAPACIDADES",
+                "LOGOUT",
+                "UPLOAD_DIR",
+                "DOWNLOAD_DIR",
+                "COPY_DIR",
+                "DELETE_FILES",
+                "TREE",
+                "SEARCH",
+                "STATS",
+                )
+
+# Nº total de palabras esperado (comando incluido)
+args_por_comando = {
+    "DOWNLOAD_FILE": (2, 3, 4),  # rango opcional: offset [longitud]
+    "DELETE_FILE": 2,
+    "UPLOAD_FILE": (2, 3, 4),    # reanudación opcional: offset [sha256]
+    "MOVE_FILE": 3,
+    "CREATE_DIR": 2,
+    "DELETE_DIR": (2, 3),        # recursivo=1 opcional
+    "RENAME_FILE": 3,
+    "LOGIN": 3,
+    "SING_IN": 4,
+    "SHARE": 3,
+    "LIST_FILES": tuple(range(1, 8)),  # ruta y opciones de paginación opcionales
+    "LIST_DIR": tuple(range(1, 8)),
+    "HELP": 1,
+    "SHUTDOWN": 1,
+    "HASH": (2, 3),
+    "UPLOAD_STATUS": 2,
+    "STAT": 2,
+    "GC": 1,
+    "CAPACIDADES": 1,
+    "LOGOUT": 1,
+    "UPLOAD_DIR": (2, 3),        # destino opcional (por defecto, el mismo nombre)
+    "DOWNLOAD_DIR": (2, 3),
+    "COPY_DIR": 3,
+    "DELETE_FILES": (2, 3),
+    "TREE": (1, 2),
+    "SEARCH": tuple(range(1, 11)),    # patrón y opciones clave=valor
+    "STATS": (1, 2),             # 'prometheus' opcional
+}
+
+def validar_comando(comando):
+    """Pone la orden en mayúsculas y comprueba que existe y que el número de argumentos es correcto."""
     comando[0] = comando[0].upper()
-    # Comprobar que el comando existe y que el número de argumentos es correcto
     if comando[0] not in command_list:
         print("Error: comando desconocido:", comando[0])
-        sys.exit(-1)
-
-    # Nº total de palabras esperado (comando incluido)
-    args_por_comando = {
-        "DOWNLOAD_FILE": 2,
-        "DELETE_FILE": 2,
-        "UPLOAD_FILE": 2,
-        "MOVE_FILE": 3,
-        "CREATE_DIR": 2,
-        "DELETE_DIR": 2,
-        "RENAME_FILE": 3,
-        "LOGIN": 3,
-        "SING_IN": 4,
-        "SHARE": 3,
-        "LIST_FILES": (1, 2),  # ruta opcional
-        "LIST_DIR": (1, 2),    # ruta opcional
-        "HELP": 1,
-        "SHUTDOWN": 1,
-    }
+        return False
 
     regla = args_por_comando.get(comando[0])
     if regla is None:
@@ -73,25 +97,209 @@ if __name__ == '__main__':
     elif isinstance(regla, tuple):
         if len(comando) not in regla:
             print(f"Error: uso incorrecto de {comando[0]}")
-            sys.exit(-1)
+            return False
     else:
         if len(comando) != regla:
             print(f"Error: uso incorrecto de {comando[0]}")
-            sys.exit(-1)
+            return False
+    return True
+
+class Progreso:
+    """Muestra por la salida de error el avance y la velocidad de una transferencia."""
+
+    def __init__(self, total, activo=True):
+        self.total = total
+        self.activo = activo
+        self.hecho = 0
+        self.inicio = time.monotonic()
+        self.ultimo = 0.0
+        self.cerrojo = threading.Lock()  # Lo comparten los hilos de una transferencia en paralelo
+
+    def avanzar(self, n):
+        with self.cerrojo:
+            self.hecho += n
+            if self.activo:
+                ahora = time.monotonic()
+                if ahora - self.ultimo >= 0.2:
+                    self.ultimo = ahora
+                    self._pintar(ahora, "\r")
+
+    def terminar(self):
+        if self.activo:
+            self._pintar(time.monotonic(), "\r")
+            sys.stderr.write("\n")
+
+    def _pintar(self, ahora, inicio_linea):
+        segundos = max(ahora - self.inicio, 1e-9)
+        porcentaje = 100.0 * self.hecho / self.total if self.total else 100.0
+        sys.stderr.write(f"{inicio_linea}{porcentaje:6.1f}%  {self.hecho}/{self.total} bytes  {self.hecho / segundos / 1e6:8.1f} MB/s")
+        sys.stderr.flush()
+
+def recibir_a_fichero(cliente, f, tam, tam_buf, progreso=None, resumen=None):
+    """Escribe en f los tam bytes siguientes de la conexión a medida que llegan, con un único
+    buffer reutilizado. Devuelve los bytes recibidos (menos de tam si se corta la conexión).
+    Con resumen (un objeto de hashlib) los resume de paso, sin volver a leer el fichero."""
+    buf = bytearray(max(tam_buf, 1))
+    vista = memoryview(buf)
+    recibido = 0
+    while recibido < tam:
+        leidos = cliente.recv_into(vista, min(len(buf), tam - recibido))
+        if not leidos:
+            break
+        f.write(vista[:leidos])
+        if resumen is not None:
+            resumen.update(vista[:leidos])
+        recibido += leidos
+        if progreso:
+            progreso.avanzar(leidos)
+    return recibido
+
+def recibir_contenido(cliente, f, tam, tam_buf, progreso, comprimido, resumen=None):
+    """Recibe el contenido de una descarga, tal cual o comprimido en tramas."""
+    if comprimido:
+        cab = protocolo.recibir_cabecera(cliente)
+        if cab is None:
+            return 0
+        return protocolo.recibir_comprimido(cliente, f, cab, progreso.avanzar, resumen)
+    return recibir_a_fichero(cliente, f, tam, tam_buf, progreso, resumen)
+
+def comprobar_resumen(resumen, esperado, que):
+    """Compara el SHA-256 calculado aquí con el del servidor. Lanza ValueError si no coinciden."""
+    if esperado is not None and resumen.hexdigest() != esperado:
+        raise ValueError(f"Error: el SHA-256 de {que} ({resumen.hexdigest()}) no coincide con el del servidor ({esperado}).")
+
+def descargar_a_disco(cliente, nombre_local, tam, tam_buf, mostrar_progreso=False, comprimido=False, resumen=None, esperado=None):
+    """Descarga tam bytes en nombre_local pasando por un fichero temporal '.part', que solo
+    sustituye al destino si la descarga se completa. Devuelve True si se ha completado.
+    Con resumen (un objeto de hashlib) se resume lo recibido y, antes de sustituir el destino,
+    se compara con esperado(), el SHA-256 del servidor: si no coinciden se descarta lo
+    descargado y se lanza ValueError."""
+    temporal = nombre_local + ".part"
+    progreso = Progreso(tam, mostrar_progreso)
+    with open(temporal, "wb") as f:
+        recibido = recibir_contenido(cliente, f, tam, tam_buf, progreso, comprimido, resumen)
+    progreso.terminar()
+    if recibido < tam:
+        # Se conserva lo descargado para poder continuar con --reanudar
+        print(f"Descarga incompleta: {recibido} de {tam} bytes guardados en '{temporal}' (usa --reanudar para continuar)")
+        return False
+    if resumen is not None:
+        try:
+            comprobar_resumen(resumen, esperado(), "lo descargado")
+        except ValueError:
+            os.remove(temporal)
+            raise
+    os.replace(temporal, nombre_local)
+    return True
+
+def guardar_rango(cliente, nombre_local, offset, tam, tam_buf, mostrar_progreso=False, comprimido=False, resumen=None, esperado=None):
+    """Escribe un rango descargado en su posición dentro de nombre_local (que se crea si no
+    existe). Devuelve True si se ha recibido el rango completo. Con resumen lo comprueba como
+    descargar_a_disco, pero el rango ya está escrito: el error solo avisa."""
+    progreso = Progreso(tam, mostrar_progreso)
+    with open(nombre_local, "r+b" if os.path.exists(nombre_local) else "wb") as f:
+        f.seek(offset)
+        recibido = recibir_contenido(cliente, f, tam, tam_buf, progreso, comprimido, resumen)
+    progreso.terminar()
+    if recibido == tam and resumen is not None:
+        comprobar_resumen(resumen, esperado(), f"el rango {offset}+{tam}")
+    return recibido == tam
+
+def sha256_fichero(ruta, longitud=None):
+    """Resumen SHA-256 (hex) de los primeros 'longitud' bytes del fichero (todo si es None)."""
+    resumen = hashlib.sha256()
+    pendiente = longitud
+    with open(ruta, "rb") as f:
+        while pendiente is None or pendiente > 0:
+            bloque = f.read(1 << 20 if pendiente is None else min(1 << 20, pendiente))
+            if not bloque:
+                break
+            resumen.update(bloque)
+            if pendiente is not None:
+                pendiente -= len(bloque)
+    return resumen.hexdigest()
+
+def resumir(f, resumen, tam, inicio=0):
+    """Añade a resumen (un objeto de hashlib) tam bytes de f a partir de inicio."""
+    while tam > 0:
+        datos = os.pread(f.fileno(), min(1 << 20, tam), inicio)
+        if not datos:
+            break
+        resumen.update(datos)
+        inicio += len(datos)
+        tam -= len(datos)
+    return resumen
+
+def resumen_transferencia(comando, verificar=True):
+    """Objeto de hashlib con el que verificar un DOWNLOAD_FILE o UPLOAD_FILE, o None."""
+    return hashlib.sha256() if verificar and comando[0] in ("DOWNLOAD_FILE", "UPLOAD_FILE") else None
 
-#EMPIEZA A COMPROBAR A PARTIR DE AQUÍ
+def resumen_subida(texto):
+    """SHA-256 de lo recibido que el servidor incluye en la respuesta de UPLOAD_FILE, o None."""
+    encontrado = re.search(r"\(SHA-256 ([0-9a-f]{64})\)", texto)
+    return encontrado.group(1) if encontrado else None
 
+def enviar_fichero(cliente, f, tam, mostrar_progreso=False, inicio=0, progreso=None, resumen=None):
+    """Envía tam bytes de f a partir de inicio con socket.sendfile (sin cargarlo en memoria),
+    por tramos para poder ir mostrando el progreso. Con progreso se suma a uno compartido.
+    Con resumen (un objeto de hashlib) los datos pasan por Python para resumirlos según se
+    envían: se leen por bloques en lugar de usar sendfile."""
+    compartido = progreso is not None
+    if not compartido:
+        progreso = Progreso(tam, mostrar_progreso)
+    tramo = 8 << 20 if progreso.activo else tam
+    enviado = 0
+    while enviado < tam:
+        if resumen is None:
+            n = cliente.sendfile(f, inicio + enviado, min(tramo, tam - enviado))
+        else:
+            datos = os.pread(f.fileno(), min(1 << 20, tam - enviado), inicio + enviado)
+            resumen.update(datos)
+            cliente.sendall(datos)
+            n = len(datos)
+        if not n:
+            raise ConnectionError(f"el fichero ha cambiado durante el envío ({enviado} de {tam} bytes)")
+        enviado += n
+        progreso.avanzar(n)
+    if not compartido:
+        progreso.terminar()
+
+def conectar(ip, puerto):
     # Definimos socket e intentamos conectarnos al servidor. Para más información consulte: https://wiki.python.org/moin/HowTo/Sockets
     # Primero definimos el socket (SOCK_STREAM es TCP) usa direcciones de internet (AF_INET) -> socket(family, type, protocolo(por defecto es TCP no es necesario especificar))
     cliente = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Intentamos conectarnos al servidor en el puerto especificado -> connect(ip, port)
-    cliente.connect((args.ip, args.puerto))
+    cliente.connect((ip, puerto))
+    protocolo.sin_retardo(cliente)
+    return cliente
+
+def conexion_cerrada(cliente):
+    """Comprueba sin bloquear si el servidor ha cerrado la conexión (p. ej. por inactividad)."""
+    legible, _, _ = select.select([cliente], [], [], 0)
+    if not legible:
+        return False
+    try:
+        return cliente.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+def pedir_resumen_texto(cliente, fichero, tam_buf, token=None):
+    """Pide con HASH, por el protocolo de texto, el SHA-256 de un fichero del servidor."""
+    cliente.send(((f"@{token} " if token else "") + f"HASH {fichero}").encode("ascii"))
+    respuesta = cliente.recv(tam_buf).decode("utf-8").split()
+    return respuesta[1] if len(respuesta) > 1 and respuesta[0] == "SUCCESS:" else None
+
+def ejecutar_comando(cliente, comando, ip, tam_buf, progreso=False, token=None, verificar=True):
+    """Envía un comando por una conexión abierta e interpreta la respuesta del servidor.
+    Con token, el comando va precedido de '@token' para usar la sesión guardada. Con verificar,
+    las descargas completas y las subidas se comprueban con el SHA-256 del servidor."""
     # Una vez conectados, debemos definir el protocolo del programa. 
-    # En este caso simple, el cliente manda un mensaje al que el servidor hace ECHO.
 
     comando_concat = ' '.join(comando) # Concatenamos el mensaje con espacios en medio
 
-    print ("Mandando el comando:", comando_concat, 'a la IP:', args.ip)
+    print ("Mandando el comando:", comando_concat, 'a la IP:', ip)
+    if token:
+        comando_concat = f"@{token} {comando_concat}"
     
     #Enviar comando con send(comando)
     #Previamente hay que codificarlo en ascii
@@ -101,9 +309,9 @@ if __name__ == '__main__':
 
     # Consideramos cada caso en particular para interpretar la respuesta.
     if comando[0] == command_list[0]:  # Primer caso: LIST_FILES
-      data = cliente.recv(args.tam_buf)
+      data = cliente.recv(tam_buf)
       #Comprobar la información recibida del comando LIST_FILES
-      respuesta = data.decode("ascii")
+      respuesta = data.decode("utf-8")
       #Pintar información
       print("Respuesta del servidor:\n", respuesta)
       
@@ -114,7 +322,7 @@ if __name__ == '__main__':
         fichero = comando[1]
         try:
             #Recibir longitud del fichero
-            longitud_str = cliente.recv(args.tam_buf).decode("ascii")
+            longitud_str = cliente.recv(tam_buf).decode("utf-8")
             if "Error" in longitud_str:
                 print(longitud_str)
             else:
@@ -124,24 +332,23 @@ if __name__ == '__main__':
                 #Enviar ACK
                 cliente.send("ACK".encode("ascii"))
 
-                #Recibir contenido
-                recv_bytes = b""
-                while len(recv_bytes) < longitud:
-                    bloque = cliente.recv(args.tam_buf)
-                    if not bloque:
-                        break
-                    recv_bytes += bloque
-
-                #Comprobar y escribir en disco
-                if len(recv_bytes) == longitud:
+                #Recibir contenido directamente a disco (un rango va a su posición en el fichero local)
+                nombre_local = os.path.basename(fichero)
+                if len(comando) > 2:
+                    completo = guardar_rango(cliente, nombre_local, int(comando[2]), longitud, tam_buf, progreso)
+                else:
+                    # El servidor resume el fichero según lo envía: HASH contesta sin releerlo
+                    completo = descargar_a_disco(cliente, nombre_local, longitud, tam_buf, progreso,
+                                                 resumen=hashlib.sha256() if verificar else None,
+                                                 esperado=lambda: pedir_resumen_texto(cliente, fichero, tam_buf, token))
+                if completo:
                     print("Descargado correctamente")
-                    nombre_local = os.path.basename(fichero)
-                    with open(nombre_local, "wb") as f:
-                        f.write(recv_bytes)
                     print(f"Fichero '{fichero}' guardado en la ruta actual")
                 else:
                     print("No se pudo descargar")
 
+        except ValueError as e:
+            print(e)
         except Exception as e:
             print("ERROR")
       else:
@@ -150,7 +357,7 @@ if __name__ == '__main__':
     elif comando[0] == command_list[2]:   #Tercer caso: DELETE_FILE
       if len(comando) > 1:
         try:
-            respuesta = cliente.recv(args.tam_buf).decode("ascii")
+            respuesta = cliente.recv(tam_buf).decode("utf-8")
             print("Respuesta del servidor:", respuesta)
         except Exception as e:
             print(f"Error en DELETE_FILE: {e}")
@@ -162,34 +369,36 @@ if __name__ == '__main__':
         fichero = comando[1]
         try:
             # 1) Comprobar el primer UPLOAD_ACK
-            ack1 = cliente.recv(args.tam_buf).decode("ascii").strip()
+            ack1 = cliente.recv(tam_buf).decode("utf-8").strip()
             if ack1 != "UPLOAD_ACK":
                 print("Error: no se recibió UPLOAD_ACK inicial.")
             else:
-                # Leer el fichero
                 with open(fichero, "rb") as f:
-                    contenido = f.read()
+                    # 2) Mandar la longitud del contenido (lo que falta si se reanuda desde un offset)
+                    inicio = int(comando[2]) if len(comando) > 2 else 0
+                    tam = max(os.fstat(f.fileno()).st_size - inicio, 0)
+                    cliente.sendall(str(tam).encode("ascii"))
 
-                # 2) Mandar la longitud del contenido
-                tam = str(len(contenido))
-                cliente.sendall(tam.encode("ascii"))
+                    # 3) Recibir el segundo UPLOAD_ACK
+                    ack2 = cliente.recv(tam_buf).decode("utf-8").strip()
+                    if ack2 != "UPLOAD_ACK":
+                        print("Error: no se recibió UPLOAD_ACK tras tamaño.")
+                    else:
+                        # 4) Enviar el contenido (resumiéndolo, con lo que ya tenga el servidor si se reanuda)
+                        resumen = resumir(f, hashlib.sha256(), inicio) if verificar else None
+                        enviar_fichero(cliente, f, tam, progreso, inicio, resumen=resumen)
 
-                # 3) Recibir el segundo UPLOAD_ACK
-                ack2 = cliente.recv(args.tam_buf).decode("ascii").strip()
-                if ack2 != "UPLOAD_ACK":
-                    print("Error: no se recibió UPLOAD_ACK tras tamaño.")
-                else:
-                    # 4) Enviar el contenido
-                    cliente.sendall(contenido)
-
-                    # 5) Esperar confirmación de recepción de datos
-                    confirm = cliente.recv(args.tam_buf).decode("ascii").strip()
-                    mensajes = confirm.split("\n")
-                    for msg in mensajes:
-                        if msg == "DATA_RECEIVED":
-                            print("Confirmación recibida")
-                        elif msg.startswith("SUCCESS"):
-                            print(msg)
+                        # 5) Esperar confirmación de recepción de datos
+                        confirm = cliente.recv(tam_buf).decode("utf-8").strip()
+                        mensajes = confirm.split("\n")
+                        for msg in mensajes:
+                            if msg == "DATA_RECEIVED":
+                                print("Confirmación recibida")
+                            elif msg.startswith("SUCCESS"):
+                                print(msg)
+                                remoto = resumen_subida(msg)
+                                if resumen is not None and remoto and remoto != resumen.hexdigest():
+                                    print(f"Error: el SHA-256 que ha recibido el servidor ({remoto}) no coincide con el del fichero local ({resumen.hexdigest()}).")
 
         except FileNotFoundError:
             print(f"Error: el fichero '{fichero}' no existe en el cliente.")
@@ -204,7 +413,7 @@ if __name__ == '__main__':
           origen = comando[1]
           destino = comando[2]
           try:
-              respuesta = cliente.recv(args.tam_buf).decode("ascii")
+              respuesta = cliente.recv(tam_buf).decode("utf-8")
               if "SUCCESS" in respuesta:
                   print(f"Fichero '{origen}' movido correctamente a '{destino}'.")
               else:
@@ -216,32 +425,32 @@ if __name__ == '__main__':
           print("Error: Debes especificar fichero y destino.")
 
     elif comando[0] == command_list[5]: #Sexto caso: CREATE_DIR
-      data = cliente.recv(args.tam_buf)
-      respuesta = data.decode("ascii")
+      data = cliente.recv(tam_buf)
+      respuesta = data.decode("utf-8")
       if "SUCCESS" in respuesta:
         print("Directorio creado correctamente.")
       else:
         print("Error al crear el directorio:", respuesta)
 
     elif comando[0] == command_list[6]: #Séptimo caso: DELETE_DIR
-      data = cliente.recv(args.tam_buf)
-      respuesta = data.decode("ascii")
+      data = cliente.recv(tam_buf)
+      respuesta = data.decode("utf-8")
       if "SUCCESS" in respuesta:
         print("Directorio eliminado correctamente.")
       else:
         print("Error al eliminar el directorio:", respuesta)
 
     elif comando[0] == command_list[7]: #Octavo caso: LIST_DIR
-      data = cliente.recv(args.tam_buf)
+      data = cliente.recv(tam_buf)
       #Comprobar la información recibida 
-      respuesta = data.decode("ascii")
+      respuesta = data.decode("utf-8")
       #Pintar información
       print("Respuesta del servidor:\n", respuesta)
 
     elif comando[0] == command_list[8]: #Noveno caso: HELP
       try:
         # El comando ya se envió de forma genérica antes
-        respuesta = cliente.recv(args.tam_buf).decode("ascii")
+        respuesta = cliente.recv(tam_buf).decode("utf-8")
 
         # Comprobar información recibida
         if respuesta:
@@ -252,31 +461,786 @@ if __name__ == '__main__':
       except Exception as e:
         print(f"Error al recibir la ayuda: {e}")
     elif comando[0] == command_list[9]: #Noveno caso: RENAME_FILE
-      respuesta = cliente.recv(args.tam_buf).decode("ascii")
+      respuesta = cliente.recv(tam_buf).decode("utf-8")
       print("Respuesta del servidor:", respuesta)
     
       
     #--EXTRA--
     elif comando[0] == "LOGIN":
-      respuesta = cliente.recv(args.tam_buf).decode("ascii")
+      respuesta = cliente.recv(tam_buf).decode("utf-8")
       print("Respuesta del servidor:", respuesta)
 
     elif comando[0] == "SING_IN":
-      respuesta = cliente.recv(args.tam_buf).decode("ascii")
+      respuesta = cliente.recv(tam_buf).decode("utf-8")
       print("Respuesta del servidor:", respuesta)
 
     elif comando[0] == "SHARE":
-      respuesta = cliente.recv(args.tam_buf).decode("ascii")
+      respuesta = cliente.recv(tam_buf).decode("utf-8")
       print("Respuesta del servidor:", respuesta)
 
     elif comando[0] == "SHUTDOWN":
-      respuesta = cliente.recv(args.tam_buf).decode("ascii")
+      respuesta = cliente.recv(tam_buf).decode("utf-8")
       print(respuesta.strip())
 
     else: #Decimo caso: UNKNOWN_COMMAND
-      respuesta = cliente.recv(args.tam_buf).decode("ascii")
+      respuesta = cliente.recv(tam_buf).decode("utf-8")
       print(respuesta)
-    # Enviamos la respuesta al cliente
+
+def enviar_peticion(cliente, comando, progreso=False, compresion=0, etiqueta=0, resumen=None):
+    """Manda la petición de un comando con el protocolo de tramas, y en UPLOAD_FILE y
+    UPLOAD_DIR también el contenido, sin esperar la respuesta. Devuelve False si no se ha mandado.
+    resumen (un objeto de hashlib, ver resumen_transferencia) pide verificar la transferencia:
+    DOWNLOAD_FILE lleva FLAG_RESUMEN y UPLOAD_FILE resume el fichero según lo envía. Hay que
+    pasar el mismo a recibir_respuesta."""
+    orden = comando[0]
+    argumentos = comando[1:]
+    if orden == "DOWNLOAD_DIR":
+        argumentos = comando[1:2]   # El destino local no viaja
+    elif orden == "UPLOAD_DIR":
+        argumentos = [comando[2] if len(comando) > 2 else os.path.basename(os.path.normpath(comando[1]))]
+    flags = compresion
+    if orden == "DOWNLOAD_FILE" and resumen is not None:
+        flags |= protocolo.FLAG_RESUMEN
+    peticion = protocolo.trama(protocolo.OPERACIONES[orden], protocolo.argumentos(argumentos), etiqueta=etiqueta, flags=flags)
+
+    if orden == "UPLOAD_FILE":
+        try:
+            f = open(comando[1], "rb")
+        except FileNotFoundError:
+            print(f"Error: el fichero '{comando[1]}' no existe en el cliente.")
+            return False
+        # Petición y contenido van seguidos: el servidor contesta una sola vez, sin ACK intermedios
+        with f:
+            inicio = int(comando[2]) if len(comando) > 2 else 0
+            tam = max(os.fstat(f.fileno()).st_size - inicio, 0)
+            if resumen is not None:
+                resumir(f, resumen, inicio)     # Lo que ya tiene el servidor si se reanuda
+            if compresion and protocolo.comprimible(f, inicio, tam):
+                cliente.sendall(peticion)
+                medidor = Progreso(tam, progreso)
+                protocolo.enviar_comprimido(cliente, f, inicio, tam, compresion, medidor.avanzar, etiqueta, resumen)
+                medidor.terminar()
+            elif tam <= protocolo.MAX_JUNTO:
+                # Fichero pequeño: petición, cabecera y contenido en una sola escritura
+                datos = os.pread(f.fileno(), tam, inicio)
+                if resumen is not None:
+                    resumen.update(datos)
+                cliente.sendall(peticion + protocolo.cabecera(protocolo.OP_DATOS, len(datos), etiqueta=etiqueta) + datos)
+            else:
+                cliente.sendall(peticion + protocolo.cabecera(protocolo.OP_DATOS, tam, etiqueta=etiqueta))
+                enviar_fichero(cliente, f, tam, progreso, inicio, resumen=resumen)
+    elif orden == "UPLOAD_DIR":
+        if not os.path.isdir(comando[1]):
+            print(f"Error: el directorio '{comando[1]}' no existe en el cliente.")
+            return False
+        # El tar se genera mientras se envía, detrás de la petición
+        cliente.sendall(peticion)
+        salida = protocolo.EscritorTramas(cliente, compresion, etiqueta)
+        ficheros, dirs, total = directorios.empaquetar(comando[1], salida)
+        salida.cerrar()
+        if progreso:
+            print(f"Enviados {ficheros} ficheros y {dirs} directorios ({total} bytes)", file=sys.stderr)
+    else:
+        cliente.sendall(peticion)
+    return True
+
+def recibir_respuesta(cliente, comando, tam_buf, progreso=False, resumen=None):
+    """Recibe la respuesta a un comando mandado con enviar_peticion; en DOWNLOAD_FILE guarda
+    el fichero. Devuelve la cabecera y el texto de la respuesta. Con resumen (el mismo que se
+    pasó a enviar_peticion) comprueba el SHA-256 de lo transferido con el del servidor; si no
+    coinciden, la respuesta pasa a ser un error."""
+    cab = protocolo.recibir_cabecera(cliente)
+    if cab is None:
+        raise ConnectionError("el servidor ha cerrado la conexión")
+
+    # Las operaciones recursivas mandan antes de la respuesta tramas OP_DATOS con texto: las
+    # líneas de TREE, que se muestran según llegan, y avisos de progreso
+    avisos = False
+    while cab.operacion == protocolo.OP_DATOS:
+        for linea in protocolo.recibir_exacto(cliente, cab.longitud).decode("utf-8", errors="replace").split("\n"):
+            if linea.startswith("PROGRESS: "):
+                if progreso or sys.stderr.isatty():
+                    sys.stderr.write(f"\r{linea[10:]}")
+                    sys.stderr.flush()
+                    avisos = True
+            else:
+                print(linea)
+        cab = protocolo.recibir_cabecera(cliente)
+        if cab is None:
+            raise ConnectionError("el servidor ha cerrado la conexión")
+    if avisos:
+        sys.stderr.write("\n")
+
+    if comando[0] == "DOWNLOAD_FILE" and cab.estado == protocolo.ESTADO_OK:
+        comprimido = bool(cab.flags & protocolo.MASCARA_COMPRESION)
+        tam = cab.longitud
+        if comprimido:
+            tam, = protocolo.TAM_ORIGINAL.unpack(protocolo.recibir_exacto(cliente, cab.longitud))
+        print(f"Tamaño recibido: {tam} bytes{' (comprimido)' if comprimido else ''}")
+        nombre_local = os.path.basename(comando[1])
+        esperado = lambda: protocolo.recibir_resumen(cliente)    # Llega detrás del contenido
+        try:
+            if len(comando) > 2:
+                # Rango: se escribe en su posición dentro del fichero local
+                completo = guardar_rango(cliente, nombre_local, int(comando[2]), tam, tam_buf, progreso, comprimido, resumen, esperado)
+            else:
+                completo = descargar_a_disco(cliente, nombre_local, tam, tam_buf, progreso, comprimido, resumen, esperado)
+        except ValueError as e:
+            return cab._replace(estado=protocolo.ESTADO_ERROR), str(e)
+        if not completo:
+            raise ConnectionError("conexión cerrada antes de recibir el fichero completo")
+        return cab, f"Fichero '{comando[1]}' guardado en la ruta actual" + (" (SHA-256 verificado)" if resumen is not None else "")
+
+    if comando[0] == "DOWNLOAD_DIR" and cab.estado == protocolo.ESTADO_OK:
+        protocolo.recibir_exacto(cliente, cab.longitud)
+        destino = comando[2] if len(comando) > 2 else os.path.basename(os.path.normpath(comando[1]))
+        entrada = protocolo.LectorTramas(cliente)
+        try:
+            # Lo que manda el servidor se comprueba igual: ningún nombre puede salir de destino
+            ficheros, dirs, omitidos = directorios.extraer(entrada, destino)
+        except (ValueError, OSError) as e:
+            return cab._replace(estado=protocolo.ESTADO_ERROR), str(e)
+        finally:
+            entrada.descartar()
+        return cab, f"{ficheros} ficheros y {dirs} directorios guardados en '{destino}'"
+
+    texto = protocolo.texto_respuesta(cab, protocolo.recibir_exacto(cliente, cab.longitud))
+    if comando[0] == "UPLOAD_FILE" and resumen is not None and cab.estado == protocolo.ESTADO_OK:
+        remoto = resumen_subida(texto)
+        if remoto and remoto != resumen.hexdigest():
+            return cab._replace(estado=protocolo.ESTADO_ERROR), \
+                f"Error: el SHA-256 que ha recibido el servidor ({remoto}) no coincide con el del fichero local ({resumen.hexdigest()})."
+    return cab, texto
+
+def ejecutar_comando_binario(cliente, comando, ip, tam_buf, progreso=False, compresion=0, verificar=True):
+    """Envía un comando con el protocolo de tramas e interpreta la respuesta.
+    compresion son las flags negociadas con el servidor (0 = sin comprimir). Con verificar,
+    DOWNLOAD_FILE y UPLOAD_FILE comprueban el SHA-256 de lo transferido y UPLOAD_DIR comprueba
+    con TREE lo que ha quedado en el servidor.
+    Devuelve True si el servidor contesta sin error."""
+    orden = comando[0]
+    print ("Mandando el comando:", ' '.join(comando), 'a la IP:', ip)
+    resumen = resumen_transferencia(comando, verificar)
+    if not enviar_peticion(cliente, comando, progreso, compresion, resumen=resumen):
+        return False
+    cab, respuesta = recibir_respuesta(cliente, comando, tam_buf, progreso, resumen)
+    if orden == "UPLOAD_DIR" and verificar and cab.estado == protocolo.ESTADO_OK:
+        destino = comando[2] if len(comando) > 2 else os.path.basename(os.path.normpath(comando[1]))
+        error = comprobar_directorio(cliente, comando[1], destino)
+        if error:
+            cab, respuesta = cab._replace(estado=protocolo.ESTADO_ERROR), error
+        else:
+            respuesta = respuesta.strip() + " Comprobado con TREE."
+
+    if orden == "DOWNLOAD_FILE" and cab.estado == protocolo.ESTADO_OK:
+        print("Descargado correctamente")
+        print(respuesta)
+    elif orden == "HELP" and cab.estado == protocolo.ESTADO_OK:
+        print("=== AYUDA DEL SERVIDOR ===")
+        print(respuesta)
+    elif orden in ("LIST_FILES", "LIST_DIR"):
+        print("Respuesta del servidor:\n", respuesta)
+    else:
+        print("Respuesta del servidor:", respuesta.strip())
+    return cab.estado == protocolo.ESTADO_OK
+
+def comprobar_directorio(cliente, local, remoto):
+    """Después de un UPLOAD_DIR pide TREE de remoto y comprueba que están todos los ficheros
+    (con su tamaño) y directorios de local, y que el resumen de TREE cuenta lo mismo si remoto
+    no tenía nada más. Devuelve el texto del error, o None si todo coincide."""
+    cliente.sendall(protocolo.trama(protocolo.OPERACIONES["TREE"], protocolo.argumentos([remoto])))
+    arbol = {}
+    cab = protocolo.recibir_cabecera(cliente)
+    while cab is not None and cab.operacion == protocolo.OP_DATOS:
+        for linea in protocolo.recibir_exacto(cliente, cab.longitud).decode("utf-8", errors="replace").split("\n"):
+            nombre, tab, tam = linea.rpartition("\t")
+            if tab and not linea.startswith("PROGRESS: "):
+                arbol[nombre] = int(tam)
+        cab = protocolo.recibir_cabecera(cliente)
+    if cab is None:
+        raise ConnectionError("el servidor ha cerrado la conexión")
+    texto = protocolo.texto_respuesta(cab, protocolo.recibir_exacto(cliente, cab.longitud)).strip()
+    if cab.estado != protocolo.ESTADO_OK:
+        return f"Error: no se ha podido comprobar el directorio subido ({texto})."
+    enviado = directorios.contenido(local)
+    distintos = [n for n, tam in enviado.items() if n not in arbol or (tam is not None and arbol[n] != tam)]
+    if distintos:
+        return f"Error: tras UPLOAD_DIR faltan o son distintas {len(distintos)} entradas en '{remoto}' (p. ej. '{distintos[0]}')."
+    if len(arbol) == len(enviado):
+        # TREE cuenta igual que UPLOAD_DIR: la raíz es un directorio más
+        ficheros = sum(tam is not None for tam in enviado.values())
+        esperado = f"SUCCESS: {ficheros} ficheros, {len(enviado) - ficheros} directorios,"
+        if not texto.startswith(esperado):
+            return f"Error: TREE de '{remoto}' no cuenta lo subido ({texto}; se esperaba '{esperado} ...')."
+    return None
+
+def listado_completo(cliente, comando, args):
+    """Pide un LIST_FILES / LIST_DIR por páginas y las va mostrando según llegan, siguiendo el
+    cursor de cada respuesta hasta la última. Así un directorio enorme no tiene que caber en
+    una sola respuesta y las primeras entradas salen enseguida."""
+    argumentos = [a for a in comando[1:] if not a.lower().startswith("cursor=")]
+    cursor = next((a.split("=", 1)[1] for a in comando[1:] if a.lower().startswith("cursor=")), None)
+    if not any("=" in a for a in argumentos):
+        argumentos.append("limite=1000")
+    print ("Mandando el comando:", ' '.join(comando), 'a la IP:', args.ip)
+    total = 0
+    while True:
+        peticion = argumentos + ([f"cursor={cursor}"] if cursor else [])
+        cliente.sendall(protocolo.trama(protocolo.OPERACIONES[comando[0]], protocolo.argumentos(peticion), flags=args.flags_compresion))
+        ok, texto = consultar_respuesta(cliente)
+        if not ok:
+            print("Respuesta del servidor:", texto)
+            return False
+        primera, _, lineas = texto.partition("\n")
+        _, entradas, cursor = primera.split()
+        if lineas:
+            print(lineas, flush=True)
+        total += int(entradas)
+        if cursor == "-":
+            break
+    print(f"{total} entradas")
+    return True
+
+def preparar_conexion(cliente, args):
+    """Primera petición de cada conexión con el protocolo binario: presenta el token de la
+    sesión guardada, si lo hay, para seguir con ella sin repetir LOGIN, y pregunta al servidor
+    (CAPACIDADES) si admite el algoritmo de --compresion. Devuelve las flags que hay que poner
+    en las peticiones (0 si no se comprime)."""
+    if args.protocolo != "binario" or (args.compresion == "no" and not args.token):
+        return 0
+    ok, texto = consultar(cliente, "CAPACIDADES", [], args.token)
+    if not ok and args.token:
+        print("Aviso: la sesión guardada ha caducado; vuelve a hacer LOGIN.")
+        guardar_token(args, None)
+        ok, texto = consultar(cliente, "CAPACIDADES", [])
+    if args.compresion == "no":
+        return 0
+    if not ok or args.compresion not in texto.split()[1:]:
+        print(f"Aviso: el servidor no admite compresión {args.compresion}; se transfiere sin comprimir.")
+        return 0
+    return protocolo.flags_compresion(args.compresion, args.nivel)
+
+def leer_token(args):
+    """Token de la sesión guardada para este servidor en --sesiones, o None."""
+    try:
+        with open(args.sesiones, encoding="utf-8") as f:
+            for linea in f:
+                servidor, _, token = linea.strip().partition(" ")
+                if servidor == f"{args.ip}:{args.puerto}" and token:
+                    return token
+    except OSError:
+        pass
+    return None
+
+def guardar_token(args, token):
+    """Guarda (o borra, con token None) el token de la sesión con este servidor en --sesiones.
+    Se guarda solo para el usuario: quien tenga el token tiene la sesión."""
+    servidor = f"{args.ip}:{args.puerto}"
+    lineas = []
+    try:
+        with open(args.sesiones, encoding="utf-8") as f:
+            lineas = [l for l in f if l.strip() and l.split(" ", 1)[0] != servidor]
+    except OSError:
+        pass
+    if token:
+        lineas.append(f"{servidor} {token}\n")
+    descriptor = os.open(args.sesiones, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(descriptor, "w", encoding="utf-8") as f:
+        f.writelines(lineas)
+    args.token = token
+
+def iniciar_sesion(cliente, comando, args):
+    """LOGIN con cualquiera de los dos protocolos. Guarda el token que devuelve el servidor:
+    las siguientes ejecuciones del cliente (y las conexiones de las transferencias en
+    paralelo) lo presentan en lugar de repetir LOGIN."""
+    print ("Mandando el comando: LOGIN", comando[1], 'a la IP:', args.ip)
+    if args.protocolo == "binario":
+        ok, texto = consultar(cliente, "LOGIN", comando[1:])
+    else:
+        cliente.send(' '.join(comando).encode('ascii'))
+        texto = cliente.recv(args.tam_buf).decode("utf-8").strip()
+        ok = not protocolo.es_error(texto)
+    texto, _, token = texto.partition(" TOKEN ")
+    if ok and token:
+        guardar_token(args, token.strip())
+    print("Respuesta del servidor:", texto)
+    return ok
+
+def cerrar_sesion(cliente, args):
+    """LOGOUT: cierra la sesión en el servidor y olvida el token guardado."""
+    print ("Mandando el comando: LOGOUT a la IP:", args.ip)
+    if args.protocolo == "binario":
+        ok, texto = consultar(cliente, "LOGOUT", [], args.token)
+    else:
+        cliente.send((f"@{args.token} LOGOUT" if args.token else "LOGOUT").encode('ascii'))
+        texto = cliente.recv(args.tam_buf).decode("utf-8").strip()
+        ok = not protocolo.es_error(texto)
+    guardar_token(args, None)
+    print("Respuesta del servidor:", texto)
+    return ok
+
+def consultar(cliente, orden, argumentos, token=None):
+    """Manda un comando con el protocolo binario y devuelve (ok, texto de la respuesta) sin
+    mostrar nada. Sirve para los comandos auxiliares que lanza el propio cliente. Con token,
+    la petición lleva el de la sesión (FLAG_SESION)."""
+    flags = 0
+    if token:
+        flags = protocolo.FLAG_SESION
+        argumentos = [token] + list(argumentos)
+    cliente.sendall(protocolo.trama(protocolo.OPERACIONES[orden], protocolo.argumentos(argumentos), flags=flags))
+    return consultar_respuesta(cliente)
+
+def consultar_respuesta(cliente):
+    """Recibe una respuesta de texto del protocolo binario y devuelve (ok, texto)."""
+    cab = protocolo.recibir_cabecera(cliente)
+    if cab is None:
+        raise ConnectionError("el servidor ha cerrado la conexión")
+    texto = protocolo.texto_respuesta(cab, protocolo.recibir_exacto(cliente, cab.longitud))
+    return cab.estado == protocolo.ESTADO_OK, texto.strip()
+
+def reanudar_descarga(cliente, fichero, tam_buf, mostrar_progreso=False):
+    """Continúa una descarga cortada a partir de lo que ya hay en '<fichero>.part' y comprueba
+    con HASH que el resultado es idéntico al fichero del servidor."""
+    nombre_local = os.path.basename(fichero)
+    temporal = nombre_local + ".part"
+    offset = os.path.getsize(temporal) if os.path.exists(temporal) else 0
+    print(f"Reanudando la descarga de '{fichero}' desde el byte {offset}")
+    cliente.sendall(protocolo.trama(protocolo.OPERACIONES["DOWNLOAD_FILE"], protocolo.argumentos([fichero, str(offset)])))
+    cab = protocolo.recibir_cabecera(cliente)
+    if cab is None:
+        raise ConnectionError("el servidor ha cerrado la conexión")
+    if cab.estado != protocolo.ESTADO_OK:
+        print("Respuesta del servidor:", protocolo.recibir_exacto(cliente, cab.longitud).decode("utf-8", errors="replace"))
+        return False
+
+    progreso = Progreso(cab.longitud, mostrar_progreso)
+    with open(temporal, "a+b") as f:
+        # Lo que ya había se resume una vez; lo que llega, según llega
+        resumen = resumir(f, hashlib.sha256(), offset)
+        recibido = recibir_a_fichero(cliente, f, cab.longitud, tam_buf, progreso, resumen)
+    progreso.terminar()
+    if recibido < cab.longitud:
+        print(f"Descarga incompleta: {offset + recibido} bytes guardados en '{temporal}' (usa --reanudar para continuar)")
+        return False
+
+    ok, texto = consultar(cliente, "HASH", [fichero])
+    if not ok or texto.split()[1] != resumen.hexdigest():
+        os.remove(temporal)
+        print("Error: el fichero reanudado no coincide con el del servidor; se ha descartado la descarga.")
+        return False
+    os.replace(temporal, nombre_local)
+    print(f"Descargado correctamente ({cab.longitud} bytes nuevos, SHA-256 verificado)")
+    print(f"Fichero '{fichero}' guardado en la ruta actual")
+    return True
+
+def reanudar_subida(cliente, fichero, mostrar_progreso=False):
+    """Continúa una subida cortada: pregunta al servidor cuánto tiene (UPLOAD_STATUS), comprueba
+    que coincide con el principio del fichero local y sube solo el resto. El servidor verifica
+    el SHA-256 del fichero completo antes de guardarlo."""
+    try:
+        f = open(fichero, "rb")
+    except FileNotFoundError:
+        print(f"Error: el fichero '{fichero}' no existe en el cliente.")
+        return False
+    with f:
+        tam = os.fstat(f.fileno()).st_size
+        offset = 0
+        ok, texto = consultar(cliente, "UPLOAD_STATUS", [fichero])
+        if ok:
+            parcial, resumen_parcial = texto.split()[1:3]
+            if int(parcial) <= tam and sha256_fichero(fichero, int(parcial)) == resumen_parcial:
+                offset = int(parcial)
+        print(f"Reanudando la subida de '{fichero}' desde el byte {offset}")
+
+        argumentos = [fichero, str(offset), sha256_fichero(fichero)]
+        cliente.sendall(protocolo.trama(protocolo.OPERACIONES["UPLOAD_FILE"], protocolo.argumentos(argumentos))
+                        + protocolo.cabecera(protocolo.OP_DATOS, tam - offset))
+        enviar_fichero(cliente, f, tam - offset, mostrar_progreso, offset)
+    cab = protocolo.recibir_cabecera(cliente)
+    if cab is None:
+        raise ConnectionError("el servidor ha cerrado la conexión")
+    print("Respuesta del servidor:", protocolo.recibir_exacto(cliente, cab.longitud).decode("utf-8", errors="replace").strip())
+    return cab.estado == protocolo.ESTADO_OK
+
+def subida_delta(cliente, fichero, args):
+    """Sube solo lo que ha cambiado de un fichero que el servidor ya tiene: pide las firmas de
+    su copia (FIRMAS) y manda referencias a los bloques que no han cambiado y los bytes nuevos
+    (UPLOAD_DELTA). Si el servidor no tiene el fichero, lo sube completo."""
+    try:
+        f = open(fichero, "rb")
+    except FileNotFoundError:
+        print(f"Error: el fichero '{fichero}' no existe en el cliente.")
+        return False
+    with f:
+        cliente.sendall(protocolo.trama(protocolo.OPERACIONES["FIRMAS"], protocolo.argumentos([fichero])))
+        cab = protocolo.recibir_cabecera(cliente)
+        if cab is None:
+            raise ConnectionError("el servidor ha cerrado la conexión")
+        firmas = protocolo.recibir_exacto(cliente, cab.longitud)
+        if cab.estado != protocolo.ESTADO_OK:
+            print(f"El servidor no tiene una versión de '{fichero}'; se sube completo.")
+            return ejecutar_comando_binario(cliente, ["UPLOAD_FILE", fichero], args.ip, args.tam_buf, args.progreso, verificar=args.verificar)
+
+        _, _, mtime_base, _ = delta.leer_firmas(firmas)
+        argumentos = [fichero, str(mtime_base), sha256_fichero(fichero)]
+        cliente.sendall(protocolo.trama(protocolo.OPERACIONES["UPLOAD_DELTA"], protocolo.argumentos(argumentos)))
+        enviado = 0
+        for instrucciones in delta.instrucciones(f, firmas):
+            cliente.sendall(protocolo.trama(protocolo.OP_DATOS, instrucciones))
+            enviado += len(instrucciones)
+        tam = os.fstat(f.fileno()).st_size
+    ok, texto = consultar_respuesta(cliente)
+    print(f"Diferencias: {enviado} bytes enviados y {len(firmas)} bytes de firmas recibidos para un fichero de {tam} bytes")
+    print("Respuesta del servidor:", texto)
+    return ok
+
+# Tiempo máximo sin actividad en las conexiones de una transferencia en paralelo. Con
+# --engine secuencial el servidor no las atiende mientras otra conexión siga abierta.
+ESPERA_PARALELO = 60
+# Tamaño mínimo de cada trozo: no merece la pena abrir conexiones para ficheros pequeños
+TROZO_MINIMO = 1 << 20
+
+def trozos(tam, n):
+    """Divide tam bytes en (como mucho) n rangos contiguos (offset, longitud)."""
+    if tam == 0:
+        return []
+    n = max(1, min(n, -(-tam // TROZO_MINIMO)))
+    paso = -(-tam // n)
+    return [(offset, min(paso, tam - offset)) for offset in range(0, tam, paso)]
+
+def conexion_paralela(args):
+    """Abre una conexión más para una transferencia en paralelo, con la misma sesión que la
+    conexión principal (presenta su token, sin repetir LOGIN)."""
+    cliente = conectar(args.ip, args.puerto)
+    cliente.settimeout(ESPERA_PARALELO)
+    if args.token:
+        ok, texto = consultar(cliente, "CAPACIDADES", [], args.token)
+        if not ok:
+            cliente.close()
+            raise ConnectionError(texto)
+    return cliente
+
+def en_paralelo(args, rangos, tarea):
+    """Ejecuta tarea(conexión, offset, longitud) para todos los rangos a la vez, cada uno por
+    su propia conexión. Lanza el primer error que se haya producido."""
+    def con_conexion(offset, longitud):
+        cliente = conexion_paralela(args)
+        try:
+            tarea(cliente, offset, longitud)
+        finally:
+            cliente.close()
+
+    if not rangos:
+        return
+    with ThreadPoolExecutor(max_workers=len(rangos)) as pool:
+        futuros = [pool.submit(con_conexion, offset, longitud) for offset, longitud in rangos]
+    for futuro in futuros:
+        if futuro.exception():
+            raise futuro.exception()
+
+def descarga_paralela(fichero, args):
+    """Descarga un fichero repartido en rangos por args.conexiones conexiones. Cada rango se
+    escribe en su posición de '<fichero>.part', que sustituye al destino al terminar."""
+    control = conexion_paralela(args)
+    with control:
+        ok, estado = consultar(control, "STAT", [fichero])
+        if not ok:
+            print("Respuesta del servidor:", estado)
+            return False
+        tam = int(estado.split()[1])
+        nombre_local = os.path.basename(fichero)
+        temporal = nombre_local + ".part"
+        with open(temporal, "wb") as f:
+            f.truncate(tam)
+        rangos = trozos(tam, args.conexiones)
+        print(f"Descargando '{fichero}' ({tam} bytes) por {max(len(rangos), 1)} conexiones")
+        progreso = Progreso(tam, args.progreso)
+
+        def descargar_rango(cliente, offset, longitud):
+            # Con FLAG_RESUMEN el servidor manda detrás el SHA-256 del rango
+            resumen = hashlib.sha256() if args.verificar else None
+            cliente.sendall(protocolo.trama(protocolo.OPERACIONES["DOWNLOAD_FILE"],
+                                            protocolo.argumentos([fichero, str(offset), str(longitud)]),
+                                            flags=protocolo.FLAG_RESUMEN if resumen else 0))
+            cab = protocolo.recibir_cabecera(cliente)
+            if cab is None:
+                raise ConnectionError("el servidor ha cerrado la conexión")
+            if cab.estado != protocolo.ESTADO_OK:
+                raise ConnectionError(protocolo.recibir_exacto(cliente, cab.longitud).decode("utf-8", errors="replace"))
+            with open(temporal, "r+b") as f:
+                f.seek(offset)
+                if recibir_a_fichero(cliente, f, cab.longitud, args.tam_buf, progreso, resumen) < longitud:
+                    raise ConnectionError("conexión cerrada antes de recibir el rango completo")
+            if resumen and protocolo.recibir_resumen(cliente) != resumen.hexdigest():
+                raise ConnectionError(f"el rango {offset}+{longitud} no coincide con su SHA-256 en el servidor")
+
+        try:
+            en_paralelo(args, rangos, descargar_rango)
+            progreso.terminar()
+            # Si el fichero ha cambiado mientras tanto, los rangos pueden no encajar
+            ok, final = consultar(control, "STAT", [fichero])
+            if not ok or final.split()[1:3] != estado.split()[1:3]:
+                raise ConnectionError("el fichero ha cambiado en el servidor durante la descarga")
+        except Exception:
+            os.remove(temporal)
+            raise
+    os.replace(temporal, nombre_local)
+    print("Descargado correctamente")
+    print(f"Fichero '{fichero}' guardado en la ruta actual")
+    return True
+
+def subida_paralela(fichero, args):
+    """Sube un fichero repartido en trozos por args.conexiones conexiones (UPLOAD_BEGIN,
+    UPLOAD_PART y UPLOAD_COMMIT). El servidor escribe cada trozo en su posición y solo publica
+    el fichero, con un rename atómico, cuando están todos y el SHA-256 coincide."""
+    try:
+        tam = os.path.getsize(fichero)
+    except FileNotFoundError:
+        print(f"Error: el fichero '{fichero}' no existe en el cliente.")
+        return False
+    control = conexion_paralela(args)
+    with control:
+        ok, texto = consultar(control, "UPLOAD_BEGIN", [str(tam)])
+        if not ok:
+            print("Respuesta del servidor:", texto)
+            return False
+        id_subida = texto.split()[1]
+        rangos = trozos(tam, args.conexiones)
+        print(f"Subiendo '{fichero}' ({tam} bytes) por {max(len(rangos), 1)} conexiones")
+        progreso = Progreso(tam, args.progreso)
+
+        def subir_rango(cliente, offset, longitud):
+            with open(fichero, "rb") as f:
+                cliente.sendall(protocolo.trama(protocolo.OPERACIONES["UPLOAD_PART"],
+                                                protocolo.argumentos([id_subida, str(offset)]))
+                                + protocolo.cabecera(protocolo.OP_DATOS, longitud))
+                enviar_fichero(cliente, f, longitud, inicio=offset, progreso=progreso)
+            ok, texto = consultar_respuesta(cliente)
+            if not ok:
+                raise ConnectionError(texto)
+
+        try:
+            en_paralelo(args, rangos, subir_rango)
+            progreso.terminar()
+        except Exception:
+            consultar(control, "UPLOAD_ABORT", [id_subida])
+            raise
+        ok, texto = consultar(control, "UPLOAD_COMMIT", [id_subida, fichero, sha256_fichero(fichero)])
+    print("Respuesta del servidor:", texto)
+    return ok
+
+def ejecutar(cliente, comando, args):
+    """Ejecuta un comando con el protocolo elegido en la línea de comandos."""
+    try:
+        if cliente is not None and args.protocolo == "binario" and args.flags_compresion is None:
+            # Se negocia una vez por conexión, al mandar el primer comando
+            args.flags_compresion = preparar_conexion(cliente, args)
+        if comando[0] == "LOGIN":
+            return iniciar_sesion(cliente, comando, args)
+        if comando[0] == "LOGOUT":
+            return cerrar_sesion(cliente, args)
+        if args.reanudar and comando[0] in ("DOWNLOAD_FILE", "UPLOAD_FILE"):
+            if args.protocolo != "binario" or len(comando) > 2:
+                print("Error: --reanudar necesita --protocolo binario y solo admite el nombre del fichero.")
+                return False
+            if comando[0] == "DOWNLOAD_FILE":
+                return reanudar_descarga(cliente, comando[1], args.tam_buf, args.progreso)
+            return reanudar_subida(cliente, comando[1], args.progreso)
+        if args.delta and comando[0] == "UPLOAD_FILE":
+            if args.protocolo != "binario" or len(comando) > 2:
+                print("Error: --delta necesita --protocolo binario y solo admite el nombre del fichero.")
+                return False
+            return subida_delta(cliente, comando[1], args)
+        if args.conexiones > 1 and comando[0] in ("DOWNLOAD_FILE", "UPLOAD_FILE"):
+            if args.protocolo != "binario" or len(comando) > 2:
+                print("Error: --conexiones necesita --protocolo binario y solo admite el nombre del fichero.")
+                return False
+            if comando[0] == "DOWNLOAD_FILE":
+                return descarga_paralela(comando[1], args)
+            return subida_paralela(comando[1], args)
+        if comando[0] in ("UPLOAD_DIR", "DOWNLOAD_DIR") and args.protocolo != "binario":
+            print(f"Error: {comando[0]} necesita --protocolo binario.")
+            return False
+        if args.todas and comando[0] in ("LIST_FILES", "LIST_DIR") and args.protocolo != "binario":
+            print("Error: --todas necesita --protocolo binario.")
+            return False
+        if args.protocolo == "binario":
+            if args.todas and comando[0] in ("LIST_FILES", "LIST_DIR"):
+                return listado_completo(cliente, comando, args)
+            return ejecutar_comando_binario(cliente, comando, args.ip, args.tam_buf, args.progreso, args.flags_compresion, args.verificar)
+        ejecutar_comando(cliente, comando, args.ip, args.tam_buf, args.progreso, args.token, args.verificar)
+        return True
+    except protocolo.ErrorProtocolo as e:
+        print(e, "¿El servidor solo admite --protocolo texto?")
+    except TimeoutError:
+        print("Error: el servidor no responde; las transferencias en paralelo necesitan un servidor con --engine hilos o asyncio.")
+    except ConnectionError as e:
+        print(f"Error: {e}")
+    return False
+
+def ejecutar_lote(args):
+    """Ejecuta los comandos de --lote (un fichero, o la entrada estándar con '-') por una sola
+    conexión sin esperar cada respuesta: un hilo manda las peticiones según lee las líneas,
+    con el número de línea como etiqueta, y este recibe las respuestas, que el servidor
+    devuelve en el mismo orden. Muestra el resultado de cada comando y devuelve el código de
+    salida: 0 si todos han ido bien y 1 si alguno ha fallado."""
+    if args.protocolo != "binario" or args.reanudar or args.delta or args.conexiones > 1 or args.todas:
+        print("Error: --lote necesita --protocolo binario y no admite --reanudar, --delta, --conexiones ni --todas.")
+        return 1
+    try:
+        entrada = sys.stdin if args.lote == "-" else open(args.lote, encoding="utf-8")
+    except OSError as e:
+        print(f"Error: no se puede leer el lote: {e}")
+        return 1
+    cliente = conectar(args.ip, args.puerto)
+    try:
+        args.flags_compresion = preparar_conexion(cliente, args)
+    except (ConnectionError, protocolo.ErrorProtocolo) as e:
+        print(f"Error: {e}")
+        cliente.close()
+        return 1
+    pendientes = queue.Queue()  # (línea, comando, error, resumen) en el orden en que se han mandado
+
+    def mandar():
+        try:
+            with entrada:
+                for numero, linea in enumerate(entrada, 1):
+                    try:
+                        comando = shlex.split(linea, comments=True)
+                    except ValueError as e:
+                        pendientes.put((numero, [linea.strip()], str(e), None))
+                        continue
+                    if not comando:
+                        continue
+                    resumen = resumen_transferencia(comando, args.verificar)
+                    if not validar_comando(comando):
+                        pendientes.put((numero, comando, "comando no válido", None))
+                    elif not enviar_peticion(cliente, comando, False, args.flags_compresion, numero, resumen):
+                        pendientes.put((numero, comando, "no se ha podido mandar", None))
+                    else:
+                        pendientes.put((numero, comando, None, resumen))
+                        if comando[0] == "SHUTDOWN":
+                            break
+        except OSError as e:
+            pendientes.put((0, ["(envío)"], str(e), None))
+        finally:
+            pendientes.put(None)
+
+    hilo = threading.Thread(target=mandar, daemon=True)
+    hilo.start()
+    total = fallos = 0
+    roto = None
+    while (elemento := pendientes.get()) is not None:
+        numero, comando, error, resumen = elemento
+        total += 1
+        # Sin las contraseñas de LOGIN y SING_IN
+        mostrar = ' '.join(comando[:2] if comando[0] in ("LOGIN", "SING_IN") else comando)
+        if error is None and roto is None:
+            try:
+                cab, texto = recibir_respuesta(cliente, comando, args.tam_buf, resumen=resumen)
+                if cab.etiqueta != numero:
+                    raise protocolo.ErrorProtocolo(f"Error: respuesta de la línea {cab.etiqueta} cuando se esperaba la {numero}.")
+            except (ConnectionError, protocolo.ErrorProtocolo) as e:
+                # Sin conexión no llegarán más respuestas; se desbloquea el hilo que manda
+                roto = str(e)
+                try:
+                    cliente.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        if error is None and roto is not None:
+            error = f"sin respuesta ({roto})"
+        if error is not None:
+            fallos += 1
+            print(f"[{numero}] ERROR {mostrar}: {error}")
+            continue
+        ok = cab.estado == protocolo.ESTADO_OK
+        if comando[0] == "LOGIN":
+            texto, _, token = texto.partition(" TOKEN ")
+            if ok and token:
+                guardar_token(args, token.strip())
+        elif comando[0] == "LOGOUT" and ok:
+            guardar_token(args, None)
+        fallos += not ok
+        print(f"[{numero}] {'OK' if ok else 'ERROR'} {mostrar}: {texto.strip()}")
+    hilo.join()
+    cliente.close()
+    print(f"{total} comandos, {fallos} con error")
+    return 1 if fallos else 0
+
+def modo_interactivo(args):
+    """Lee comandos de la entrada estándar y los ejecuta todos sobre la misma conexión.
+    Sirve también para scripts: python cliente.py --interactivo < comandos.txt"""
+    cliente = conectar(args.ip, args.puerto)
+    interactivo = sys.stdin.isatty()
+    try:
+        while True:
+            try:
+                linea = input("> " if interactivo else "")
+            except EOFError:
+                break
+            comando = shlex.split(linea, comments=True)
+            if not comando:
+                continue
+            if comando[0].upper() in ("EXIT", "QUIT"):
+                break
+            if not validar_comando(comando):
+                continue
+            # Si el servidor cerró la conexión por inactividad, abrimos otra
+            if conexion_cerrada(cliente):
+                cliente.close()
+                cliente = conectar(args.ip, args.puerto)
+                args.flags_compresion = None
+            ejecutar(cliente, comando, args)
+            if comando[0] == "SHUTDOWN":
+                break
+    finally:
+        cliente.close()
+
+if __name__ == '__main__':
+    # Definimos el parseador. Por convenio, los argumentos opcionales se encabezan con '--'
+    # Para más información, consulte https://docs.python.org/3/howto/argparse.html
+    parser = ap.ArgumentParser(prog=sys.argv[0], description='Un cliente TCP de ficheros')
+    parser.add_argument('--ip', help='IP del servidor', default="127.0.0.1") # Por defecto usamos localhost
+    # Los puertos por defecto están en el rango 0-1023. Podemos usar puertos a partir de ahí
+    parser.add_argument('--puerto', type=int, help='Puerto TCP de salida [1024-65535]', default=5005, choices=range(1024,65535), metavar='PUERTO (1024-65535)') 
+    parser.add_argument('--tam_buf',  type=int, help='Longitud del buffer interno', default=65536)
+    parser.add_argument('--reanudar', action='store_true', help='Continuar un DOWNLOAD_FILE o UPLOAD_FILE cortado desde donde se quedó')
+    parser.add_argument('--progreso', action='store_true', help='Mostrar el avance y la velocidad de las transferencias')
+    parser.add_argument('--protocolo', help='binario (tramas con longitud, sin ACK intermedios) o texto (protocolo original)', default='binario', choices=('binario', 'texto'))
+    parser.add_argument('--delta', action='store_true', help='UPLOAD_FILE sube solo lo que ha cambiado respecto a la copia del servidor, que se actualiza (sin -copiaX)')
+    parser.add_argument('--conexiones', type=int, default=1, help='Reparte DOWNLOAD_FILE y UPLOAD_FILE en trozos por N conexiones en paralelo (servidor con --engine hilos o asyncio)')
+    parser.add_argument('--compresion', help='Comprimir transferencias y listados con este algoritmo si el servidor lo admite (solo --protocolo binario)', default='no', choices=('no',) + tuple(protocolo.COMPRESORES))
+    parser.add_argument('--nivel', type=int, help='Nivel de compresión (1-9, 0 = el de por defecto del algoritmo)', default=0, choices=range(10), metavar='0-9')
+    parser.add_argument('--sin_verificar', dest='verificar', action='store_false', help='No comprobar el SHA-256 de lo transferido con DOWNLOAD_FILE y UPLOAD_FILE (envía con sendfile sin resumir) ni con TREE lo subido con UPLOAD_DIR')
+    parser.add_argument('--todas', action='store_true', help='LIST_FILES y LIST_DIR piden el listado por páginas y las muestran todas según llegan (solo --protocolo binario)')
+    parser.add_argument('--sesiones', help='Fichero donde se guarda el token de sesión de cada servidor tras un LOGIN', default=os.path.join(os.path.expanduser("~"), ".cliente_sesiones"))
+    parser.add_argument('--lote', '--batch', metavar='FICHERO', help="Ejecuta los comandos del fichero ('-' = entrada estándar) por una conexión, sin esperar cada respuesta (solo --protocolo binario)")
+    parser.add_argument('--interactivo', action='store_true', help='Ejecuta los comandos leídos de la entrada estándar sobre una única conexión')
+    parser.add_argument('comando', nargs="*", help='Comando a ejecutar', default=['LIST_FILES'])
+    
+    # Parseamos los argumentos de acuerdo al parser
+    args = parser.parse_args(sys.argv[1:]) 
+    args.token = leer_token(args)  # Sesión guardada por un LOGIN anterior con este servidor
+    args.flags_compresion = None  # Se negocia con el servidor en cada conexión
+
+    if args.lote:
+        sys.exit(ejecutar_lote(args))
+    if args.interactivo:
+        modo_interactivo(args)
+        sys.exit(0)
+    
+    # Miramos si los argumentos son correctos
+    comando = args.comando
+    # Comprobar que el comando existe y que el número de argumentos es correcto
+    if not validar_comando(comando):
+        sys.exit(-1)
+
+    # Las transferencias en paralelo abren sus propias conexiones
+    paralelo = args.conexiones > 1 and comando[0] in ("DOWNLOAD_FILE", "UPLOAD_FILE") and not (args.delta and comando[0] == "UPLOAD_FILE")
+    cliente = None if paralelo else conectar(args.ip, args.puerto)
+    ok = ejecutar(cliente, comando, args)
     # Una vez acabado el intercambio de datos, debemos cerrar el socket
     # Cerramos el socket -> close()
-    cliente.close()
+    if cliente:
+        cliente.close()
+    sys.exit(0 if ok else 1)
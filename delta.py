@@ -0,0 +1,219 @@
+"""Subidas por diferencias (al estilo rsync), común a cliente.py y servidor.py.
+
+1. El servidor parte su copia del fichero en bloques de tam_bloque bytes y manda la firma de
+   cada uno: una suma débil que se puede desplazar byte a byte (Adler-32) y un resumen fuerte.
+2. El cliente recorre su versión buscando bloques con la misma firma en cualquier posición y
+   manda solo instrucciones: "copia los bloques i..i+n de tu fichero" o "estos bytes literales".
+3. El servidor reconstruye el fichero nuevo a partir de su copia y las instrucciones.
+
+Si solo han cambiado unos KiB de un fichero enorme, por la red viajan las firmas, un par de
+bloques literales y unas pocas referencias en lugar del fichero entero.
+
+Las firmas viajan como FIRMAS_CABECERA seguida de una FIRMA por bloque. Las instrucciones van
+en tramas OP_DATOS (cada una con instrucciones completas) terminadas con una trama vacía.
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+FIRMAS_CABECERA = struct.Struct("!IQQ")   # tam_bloque, tamaño del fichero, mtime_ns
+FIRMA = struct.Struct("!I16s")            # suma débil (Adler-32), resumen fuerte (BLAKE2b-128)
+COPIA = struct.Struct("!cQI")             # b"C", primer bloque, número de bloques
+LITERAL = struct.Struct("!cI")            # b"L", longitud (seguida de los bytes)
+
+MAX_LITERAL = 1 << 20       # Bytes literales por instrucción
+MAX_TRAMA = 4 << 20         # Tamaño máximo de una trama de instrucciones
+_MOD = 65521                # Módulo de Adler-32
+BUSQUEDA = 2                # Bloques que se recorren byte a byte buscando una coincidencia
+SALTO = 14                  # Bloques que se dan por cambiados si la búsqueda no encuentra nada
+
+
+def tam_bloque(tam):
+    """Tamaño de bloque para un fichero: ~raíz cuadrada del tamaño, entre 2 KiB y 128 KiB.
+    Equilibra el tamaño de las firmas con lo que se reenvía por cada bloque modificado."""
+    if tam <= 0:
+        return 2048
+    return 1 << min(max(math.ceil(math.log2(math.isqrt(tam) or 1)), 11), 17)
+
+
+def resumen_fuerte(datos):
+    return hashlib.blake2b(datos, digest_size=16).digest()
+
+
+def firmas(f, tam, mtime_ns=0):
+    """Firmas de todos los bloques del fichero abierto f, ya codificadas para enviarlas."""
+    bloque = tam_bloque(tam)
+    salida = bytearray(FIRMAS_CABECERA.pack(bloque, tam, mtime_ns))
+    buf = bytearray(bloque)
+    vista = memoryview(buf)
+    while True:
+        leidos = f.readinto(buf)
+        if not leidos:
+            break
+        datos = vista[:leidos]
+        salida += FIRMA.pack(zlib.adler32(datos), resumen_fuerte(datos))
+    return bytes(salida)
+
+
+def leer_firmas(carga):
+    """Devuelve (tam_bloque, tam, mtime_ns, lista de (débil, fuerte)) a partir de las firmas."""
+    bloque, tam, mtime_ns = FIRMAS_CABECERA.unpack_from(carga)
+    lista = [FIRMA.unpack_from(carga, pos) for pos in range(FIRMAS_CABECERA.size, len(carga), FIRMA.size)]
+    return bloque, tam, mtime_ns, lista
+
+
+def instrucciones(f, carga_firmas):
+    """Recorre el fichero local f y genera las tramas de instrucciones (bytes) que reconstruyen
+    su contenido a partir del fichero del servidor descrito por carga_firmas."""
+    bloque, tam_base, _, lista = leer_firmas(carga_firmas)
+    # Índice de bloques completos por suma débil; el último bloque, si es más corto, aparte
+    tabla = {}
+    for indice, (debil, fuerte) in enumerate(lista):
+        if (indice + 1) * bloque <= tam_base:
+            tabla.setdefault(debil, {}).setdefault(fuerte, indice)
+    ultimo = None
+    if tam_base % bloque:
+        ultimo = (len(lista) - 1, tam_base % bloque, *lista[-1])
+
+    tam = os.fstat(f.fileno()).st_size
+    if tam == 0:
+        yield b""
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+        yield from _recorrer(datos, tam, bloque, tabla, ultimo)
+
+
+def _recorrer(datos, tam, bloque, tabla, ultimo):
+    trama = bytearray()
+    copia = None            # (primer bloque, número de bloques) pendiente de emitir
+    literal = 0             # Inicio de los bytes literales pendientes
+
+    def emitir(hasta):
+        # Cierra la copia pendiente y emite como literales los bytes hasta 'hasta'
+        nonlocal copia, literal
+        if copia:
+            trama.extend(COPIA.pack(b"C", *copia))
+            copia = None
+        while literal < hasta:
+            fin = min(literal + MAX_LITERAL, hasta)
+            trama.extend(LITERAL.pack(b"L", fin - literal))
+            trama.extend(datos[literal:fin])
+            literal = fin
+
+    def buscar(debil, inicio, longitud):
+        candidatos = tabla.get(debil)
+        if candidatos:
+            return candidatos.get(resumen_fuerte(datos[inicio:inicio + longitud]))
+        return None
+
+    pos = 0
+    while pos + bloque <= tam:
+        debil = zlib.adler32(datos[pos:pos + bloque])
+        indice = buscar(debil, pos, bloque)
+        if indice is None:
+            # Desplazamos la ventana byte a byte hasta volver a encontrar un bloque conocido.
+            # En Python esto es lento: si en BUSQUEDA bloques no aparece ninguno, la zona ha
+            # cambiado entera y saltamos SALTO bloques como literales antes de volver a buscar.
+            a, b = debil & 0xFFFF, debil >> 16
+            limite = min(pos + BUSQUEDA * bloque, tam - bloque)
+            while pos < limite:
+                sale, entra = datos[pos], datos[pos + bloque]
+                a = (a - sale + entra) % _MOD
+                b = (b - bloque * sale + a - 1) % _MOD
+                pos += 1
+                debil = (b << 16) | a
+                if debil in tabla:
+                    indice = buscar(debil, pos, bloque)
+                    if indice is not None:
+                        break
+            if indice is None:
+                if pos + bloque >= tam:
+                    break   # Ningún bloque más coincide: el resto irá como literal
+                pos = min(pos + SALTO * bloque, tam - bloque)
+                if pos - literal >= MAX_LITERAL:
+                    emitir(pos)
+                    yield bytes(trama)
+                    trama.clear()
+                continue
+
+        if copia and copia[0] + copia[1] == indice and literal == pos:
+            copia = (copia[0], copia[1] + 1)
+        else:
+            emitir(pos)
+            copia = (indice, 1)
+        pos += bloque
+        literal = pos
+        if len(trama) >= MAX_LITERAL:
+            emitir(pos)
+            yield bytes(trama)
+            trama.clear()
+
+    # El final del fichero puede coincidir con el último bloque (corto) del servidor
+    if ultimo and tam - literal >= ultimo[1]:
+        indice, longitud, debil, fuerte = ultimo
+        inicio = tam - longitud
+        if zlib.adler32(datos[inicio:tam]) == debil and resumen_fuerte(datos[inicio:tam]) == fuerte:
+            emitir(inicio)
+            copia = (indice, 1)
+            literal = tam
+    emitir(tam)
+    if trama:
+        yield bytes(trama)
+    yield b""
+
+
+def aplicar(carga, base, destino, bloque, tam_base):
+    """Aplica una trama de instrucciones: copia bloques de base (fichero abierto) y escribe los
+    literales en destino. Devuelve los bytes escritos. Lanza ValueError si es incorrecta."""
+    escritos = 0
+    pos = 0
+    vista = memoryview(carga)
+    while pos < len(carga):
+        tipo = carga[pos:pos + 1]
+        if tipo == b"C":
+            _, primero, n = COPIA.unpack_from(carga, pos)
+            pos += COPIA.size
+            if n == 0 or primero + n > -(-tam_base // bloque):
+                raise ValueError("Error: referencia a un bloque que no existe.")
+            inicio = primero * bloque
+            longitud = min(n * bloque, tam_base - inicio)
+            escritos += _copiar(base, destino, inicio, longitud)
+        elif tipo == b"L":
+            _, longitud = LITERAL.unpack_from(carga, pos)
+            pos += LITERAL.size
+            if pos + longitud > len(carga):
+                raise ValueError("Error: instrucción literal incompleta.")
+            destino.write(vista[pos:pos + longitud])
+            pos += longitud
+            escritos += longitud
+        else:
+            raise ValueError("Error: instrucción de diferencias desconocida.")
+    return escritos
+
+
+def _copiar(base, destino, inicio, longitud):
+    """Copia un rango de base al final de destino sin pasar por Python si el sistema lo permite."""
+    destino.flush()
+    pendiente = longitud
+    if hasattr(os, "copy_file_range"):
+        try:
+            while pendiente:
+                n = os.copy_file_range(base.fileno(), destino.fileno(), pendiente, inicio + longitud - pendiente)
+                if not n:
+                    break
+                pendiente -= n
+        except OSError:
+            pass
+        destino.seek(0, os.SEEK_END)  # copy_file_range avanza el descriptor, no el objeto fichero
+    if pendiente:
+        base.seek(inicio + longitud - pendiente)
+        while pendiente:
+            trozo = base.read(min(pendiente, 1 << 20))
+            if not trozo:
+                raise ValueError("Error: la copia del servidor es más corta de lo esperado.")
+            destino.write(trozo)
+            pendiente -= len(trozo)
+    return longitud
@@ -0,0 +1,166 @@
+"""Transferencia de directorios completos (UPLOAD_DIR / DOWNLOAD_DIR), común a cliente.py y
+servidor.py.
+
+El árbol viaja como un tar que se genera mientras se envía (tarfile en modo flujo, "w|") y se
+extrae mientras se recibe ("r|"): no hay archivo temporal en disco y una sola petición mueve
+miles de ficheros pequeños sin una ida y vuelta por fichero. El tar va en tramas OP_DATOS
+(protocolo.EscritorTramas / LectorTramas), comprimidas si se ha negociado compresión.
+
+Solo se empaquetan y se extraen ficheros regulares y directorios: los enlaces simbólicos, los
+enlaces duros y los ficheros especiales se omiten.
+"""
+import hashlib
+import os
+import secrets
+import tarfile
+
+BLOQUE = 1 << 20    # Bytes que se copian de una vez entre el tar y los ficheros
+
+
+def _recorrer(raiz, relativa=""):
+    """Entradas (ruta relativa, DirEntry) del árbol, cada directorio antes que su contenido."""
+    with os.scandir(os.path.join(raiz, relativa) if relativa else raiz) as entradas:
+        subdirectorios = []
+        for e in entradas:
+            nombre = f"{relativa}/{e.name}" if relativa else e.name
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    subdirectorios.append(nombre)
+                yield nombre, e
+            except OSError:
+                continue
+    for nombre in subdirectorios:
+        try:
+            yield from _recorrer(raiz, nombre)
+        except OSError:
+            continue    # Borrado o sin permisos mientras se recorría
+
+
+def empaquetar(raiz, salida):
+    """Escribe en salida (un objeto con write) un tar con los ficheros y subdirectorios de raiz.
+    Devuelve (ficheros, directorios, bytes de contenido); raiz cuenta como un directorio más,
+    igual que en TREE."""
+    ficheros = total = 0
+    directorios = 1
+    with tarfile.open(fileobj=salida, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for nombre, e in _recorrer(raiz):
+            try:
+                st = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            # TarInfo a mano: gettarinfo busca además el usuario y el grupo de cada fichero
+            info = tarfile.TarInfo(nombre)
+            info.mtime = int(st.st_mtime)   # Con decimales tarfile añade una cabecera PAX a cada entrada
+            info.mode = st.st_mode & 0o777
+            if e.is_dir(follow_symlinks=False):
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+                directorios += 1
+            elif e.is_file(follow_symlinks=False):
+                try:
+                    f = open(e.path, "rb")
+                except OSError:
+                    continue
+                with f:
+                    info.size = os.fstat(f.fileno()).st_size
+                    tar.addfile(info, f)
+                ficheros += 1
+                total += info.size
+    return ficheros, directorios, total
+
+
+def contenido(raiz):
+    """Lo que empaquetar mandaría de raiz, con los nombres de TREE: {ruta relativa: tamaño} de
+    los ficheros y {ruta relativa + '/': None} de los directorios ('./' es raiz)."""
+    entradas = {"./": None}
+    for nombre, e in _recorrer(raiz):
+        try:
+            if e.is_dir(follow_symlinks=False):
+                entradas[nombre + "/"] = None
+            elif e.is_file(follow_symlinks=False):
+                entradas[nombre] = e.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return entradas
+
+
+def dentro_de(raiz, nombre):
+    """Comprobación por defecto de los nombres al extraer: (ok, ruta, error) como
+    _resolver_ruta_usuario del servidor, sin rutas absolutas ni salidas con '..'."""
+    if os.path.isabs(nombre):
+        return False, "", f"Error: el archivo contiene la ruta absoluta '{nombre}'."
+    base = os.path.normpath(raiz)
+    ruta = os.path.normpath(os.path.join(base, nombre))
+    if not ruta.startswith(base + os.sep) and ruta != base:
+        return False, "", f"Error: el archivo contiene '{nombre}', fuera del directorio destino."
+    return True, ruta, ""
+
+
+def extraer(entrada, raiz, resolver=None, al_guardar=None, sincronizar=False):
+    """Extrae en raiz el tar que se lee de entrada (un objeto con read) según va llegando.
+    resolver(nombre) -> (ok, ruta, error) comprueba cada nombre (por defecto, dentro_de raiz).
+    Cada fichero se escribe en un temporal y se coloca con os.replace, así nunca se modifica
+    un fichero que ya existe (puede ser un enlace compartido con otros). al_guardar(ruta,
+    sha256) se llama con cada fichero colocado. Con sincronizar se hace fsync de cada uno.
+    Devuelve (ficheros, directorios, omitidos), con raiz entre los directorios como en
+    empaquetar. Lanza ValueError si un nombre no es válido; lo extraído hasta entonces se queda."""
+    if resolver is None:
+        resolver = lambda nombre: dentro_de(raiz, nombre)
+    os.makedirs(raiz, exist_ok=True)
+    ficheros = omitidos = 0
+    directorios = 1
+    fechas = []     # Los directorios reciben su fecha al final: crear ficheros la cambia
+    try:
+        with tarfile.open(fileobj=entrada, mode="r|") as tar:
+            for miembro in tar:
+                ok, ruta, error = resolver(miembro.name)
+                if not ok:
+                    raise ValueError(error)
+                if miembro.isdir():
+                    os.makedirs(ruta, exist_ok=True)
+                    fechas.append((ruta, miembro.mtime))
+                    directorios += 1
+                elif miembro.isreg():
+                    _guardar(tar.extractfile(miembro), ruta, miembro, al_guardar, sincronizar)
+                    ficheros += 1
+                else:
+                    omitidos += 1
+    except tarfile.TarError as e:
+        raise ValueError(f"Error: archivo tar incorrecto ({e}).")
+    for ruta, mtime in reversed(fechas):
+        try:
+            os.utime(ruta, (mtime, mtime))
+        except OSError:
+            pass
+    return ficheros, directorios, omitidos
+
+
+def _guardar(origen, ruta, miembro, al_guardar, sincronizar):
+    directorio = os.path.dirname(ruta)
+    os.makedirs(directorio, exist_ok=True)
+    temporal = os.path.join(directorio, f".{os.path.basename(ruta)}.{secrets.token_hex(4)}.part")
+    resumen = hashlib.sha256()
+    escritos = 0
+    try:
+        with open(temporal, "xb") as f:
+            while True:
+                datos = origen.read(BLOQUE)
+                if not datos:
+                    break
+                resumen.update(datos)
+                f.write(datos)
+                escritos += len(datos)
+            if sincronizar:
+                f.flush()
+                os.fsync(f.fileno())
+        if escritos != miembro.size:
+            raise ValueError(f"Error: el archivo tar se corta a mitad de '{miembro.name}'.")
+        os.chmod(temporal, (miembro.mode & 0o777) | 0o600)
+        os.utime(temporal, (miembro.mtime, miembro.mtime))
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    if al_guardar:
+        al_guardar(ruta, resumen.hexdigest())
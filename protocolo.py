@@ -0,0 +1,437 @@
+"""Protocolo binario de tramas, común a cliente.py y servidor.py.
+
+Cada mensaje es una cabecera fija de 18 bytes seguida de 'longitud' bytes de carga:
+
+    magia(1) version(1) operacion(1) estado(1) flags(2) etiqueta(4) longitud(8)
+
+- magia: siempre MAGIA. Como no es un carácter ASCII, el servidor distingue por el primer byte
+  de la conexión si el cliente habla este protocolo o el de texto de siempre.
+- operacion: código del comando (OPERACIONES) u OP_DATOS para el contenido de un fichero.
+- estado: en las respuestas, ESTADO_OK o ESTADO_ERROR.
+- etiqueta: el servidor la copia en la respuesta, para poder emparejar peticiones y respuestas.
+- carga: en peticiones, los argumentos del comando separados por '\\n' (UTF-8); en respuestas,
+  el texto de la respuesta o el contenido del fichero.
+
+Con la longitud delante, una transferencia es una sola ida y vuelta: UPLOAD_FILE manda la
+petición y a continuación una trama OP_DATOS con el fichero; DOWNLOAD_FILE responde con una
+trama cuya carga es el fichero. No hacen falta ACK intermedios.
+
+Compresión: el cliente pregunta con CAPACIDADES qué algoritmos admite el servidor y marca sus
+peticiones con flags = algoritmo | nivel << 4. Las respuestas de texto largas (listados) vuelven
+comprimidas con esas flags. Un fichero comprimido no cabe en una trama con la longitud delante:
+viaja en tramas OP_DATOS (con las flags del algoritmo) terminadas con una vacía, y en las
+descargas la trama de respuesta lleva como carga el tamaño original (TAM_ORIGINAL).
+
+Sesiones: LOGIN devuelve un token. Cualquier petición puede llevarlo (flag FLAG_SESION y el
+token como primer argumento) para recuperar la sesión en otra conexión sin repetir LOGIN.
+
+Integridad: una descarga con FLAG_RESUMEN termina con una trama OP_DATOS más, con los 32 bytes
+del SHA-256 de lo enviado, que el servidor calcula según lo envía. La respuesta de UPLOAD_FILE
+incluye el SHA-256 de lo recibido. Así el cliente comprueba cada transferencia sin volver a
+leer el fichero ni pedir nada más.
+
+Directorios: UPLOAD_DIR y DOWNLOAD_DIR mueven un árbol entero como un tar generado sobre la
+marcha, en tramas OP_DATOS terminadas con una vacía (EscritorTramas / LectorTramas).
+"""
+import bz2
+import lzma
+import os
+import socket
+import struct
+import zlib
+from collections import namedtuple
+
+MAGIA = 0xC5
+VERSION = 1
+CABECERA = struct.Struct("!BBBBHIQ")
+
+# Códigos de operación de los comandos
+OPERACIONES = {
+    "LIST_FILES": 1,
+    "DOWNLOAD_FILE": 2,
+    "DELETE_FILE": 3,
+    "UPLOAD_FILE": 4,
+    "MOVE_FILE": 5,
+    "CREATE_DIR": 6,
+    "DELETE_DIR": 7,
+    "LIST_DIR": 8,
+    "HELP": 9,
+    "RENAME_FILE": 10,
+    "LOGIN": 11,
+    "SING_IN": 12,
+    "SHARE": 13,
+    "SHUTDOWN": 14,
+    "HASH": 15,
+    "UPLOAD_STATUS": 16,
+    "STAT": 17,
+    "UPLOAD_BEGIN": 18,
+    "UPLOAD_PART": 19,
+    "UPLOAD_COMMIT": 20,
+    "UPLOAD_ABORT": 21,
+    "FIRMAS": 22,
+    "UPLOAD_DELTA": 23,
+    "GC": 24,
+    "CAPACIDADES": 25,
+    "LOGOUT": 26,
+    "UPLOAD_DIR": 27,
+    "DOWNLOAD_DIR": 28,
+    "COPY_DIR": 29,
+    "DELETE_FILES": 30,
+    "TREE": 31,
+    "SEARCH": 32,
+    "STATS": 33,
+}
+NOMBRES = {codigo: nombre for nombre, codigo in OPERACIONES.items()}
+OP_DATOS = 0x80      # Contenido de un fichero
+OP_ERROR = 0xFF      # Respuesta a una trama que no se ha podido interpretar
+
+ESTADO_OK = 0
+ESTADO_ERROR = 1
+ESTADO_VERSION = 2   # El servidor no soporta la versión de la trama recibida
+
+# Tamaño máximo de la carga de una petición (argumentos); el contenido de ficheros no tiene límite
+MAX_ARGUMENTOS = 1 << 20
+
+# Compresión (campo flags): bits 0-3 el algoritmo y bits 4-7 el nivel (0 = el de por defecto)
+COMPRESORES = {"zlib": 1, "lzma": 2, "bz2": 3}
+MASCARA_COMPRESION = 0xFF
+MIN_COMPRIMIR = 1024        # Por debajo de este tamaño no compensa comprimir
+MAX_TROZO = 4 << 20         # Tamaño máximo de una trama de datos comprimidos
+TAM_ORIGINAL = struct.Struct("!Q")
+
+# Sesión (campo flags): la petición lleva como primer argumento el token que devolvió LOGIN
+FLAG_SESION = 0x100
+# Resumen (campo flags): el cliente quiere el SHA-256 de lo que descarga al final del contenido
+FLAG_RESUMEN = 0x200
+TAM_RESUMEN = 32            # Bytes de un SHA-256
+
+# Un contenido de hasta MAX_JUNTO bytes se manda en la misma escritura que su cabecera
+MAX_JUNTO = 64 << 10
+
+Cabecera = namedtuple("Cabecera", "version operacion estado flags etiqueta longitud")
+
+
+class ErrorProtocolo(Exception):
+    """La conexión ha recibido algo que no es una trama válida."""
+
+
+def cabecera(operacion, longitud, estado=ESTADO_OK, etiqueta=0, flags=0):
+    return CABECERA.pack(MAGIA, VERSION, operacion, estado, flags, etiqueta, longitud)
+
+
+def trama(operacion, carga=b"", estado=ESTADO_OK, etiqueta=0, flags=0):
+    """Devuelve la trama completa (cabecera y carga) lista para enviar."""
+    return cabecera(operacion, len(carga), estado, etiqueta, flags) + carga
+
+
+def es_error(texto):
+    """Indica si una respuesta de texto del servidor es un error."""
+    return texto.lstrip().upper().startswith(("ERROR", "RENAME_ERROR", "UNKNOWN_COMMAND"))
+
+
+def respuesta(operacion, texto, etiqueta=0, compresion=0):
+    """Trama de respuesta para una respuesta de texto, con el estado según su contenido.
+    Si el cliente admite compresión y el texto es largo, va comprimido."""
+    estado = ESTADO_ERROR if es_error(texto) else ESTADO_OK
+    carga = texto.encode("utf-8")
+    if compresion and len(carga) >= MIN_COMPRIMIR:
+        comp = compresor(compresion)
+        comprimida = comp.compress(carga) + comp.flush()
+        if len(comprimida) < len(carga):
+            return trama(operacion, comprimida, estado, etiqueta, compresion)
+    return trama(operacion, carga, estado, etiqueta)
+
+
+def texto_respuesta(cab, carga):
+    """Texto de una respuesta, descomprimido si hace falta."""
+    if cab.flags & MASCARA_COMPRESION:
+        carga = b"".join(descomprimir(descompresor(cab.flags), carga))
+    return carga.decode("utf-8", errors="replace")
+
+
+def flags_compresion(nombre, nivel=0):
+    return COMPRESORES[nombre] | (nivel & 0x0F) << 4
+
+
+def compresor(flags):
+    """Compresor incremental (compress/flush) para las flags de una trama."""
+    algoritmo, nivel = flags & 0x0F, (flags >> 4) & 0x0F
+    if algoritmo == COMPRESORES["zlib"]:
+        return zlib.compressobj(nivel or 6)
+    if algoritmo == COMPRESORES["lzma"]:
+        return lzma.LZMACompressor(preset=nivel or 6)
+    if algoritmo == COMPRESORES["bz2"]:
+        return bz2.BZ2Compressor(nivel or 9)
+    raise ErrorProtocolo(f"Error: algoritmo de compresión {algoritmo} desconocido.")
+
+
+def descompresor(flags):
+    algoritmo = flags & 0x0F
+    if algoritmo == COMPRESORES["zlib"]:
+        return zlib.decompressobj()
+    if algoritmo == COMPRESORES["lzma"]:
+        return lzma.LZMADecompressor()
+    if algoritmo == COMPRESORES["bz2"]:
+        return bz2.BZ2Decompressor()
+    raise ErrorProtocolo(f"Error: algoritmo de compresión {algoritmo} desconocido.")
+
+
+def descomprimir(d, datos, maximo=1 << 20):
+    """Descomprime datos en trozos de como mucho 'maximo' bytes, para que unos pocos bytes
+    muy comprimidos no se conviertan de golpe en gigas en memoria."""
+    try:
+        if hasattr(d, "unconsumed_tail"):   # zlib
+            while datos:
+                yield d.decompress(datos, maximo)
+                datos = d.unconsumed_tail
+        else:                               # lzma y bz2 guardan internamente lo pendiente
+            yield d.decompress(datos, maximo)
+            while not d.eof and not d.needs_input:
+                yield d.decompress(b"", maximo)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise ErrorProtocolo(f"Error: datos comprimidos incorrectos ({e}).")
+
+
+def comprimible(f, offset, tam, muestra=1 << 16):
+    """Indica si merece la pena comprimir tam bytes de f: comprime rápido tres muestras
+    (principio, mitad y final) y mira si ganan al menos un 10%. Así no se gasta CPU en
+    ficheros que ya vienen comprimidos (zip, jpg, vídeo...)."""
+    if tam < MIN_COMPRIMIR:
+        return False
+    total = comprimido = 0
+    for inicio in {offset, offset + max(tam // 2 - muestra // 2, 0), offset + max(tam - muestra, 0)}:
+        datos = os.pread(f.fileno(), min(muestra, tam), inicio)
+        total += len(datos)
+        comprimido += len(zlib.compress(datos, 1))
+    return total > 0 and comprimido < 0.9 * total
+
+
+def enviar_comprimido(sock, f, offset, tam, flags, avanzar=None, etiqueta=0, resumen=None):
+    """Envía tam bytes de f desde offset comprimidos en tramas OP_DATOS, terminadas con una
+    trama vacía. Lee el fichero por bloques: la memoria no depende del tamaño. Con resumen
+    (un objeto de hashlib) se resume de paso lo enviado, sin comprimir."""
+    comp = compresor(flags)
+    salida = bytearray()
+    enviado = 0
+    while enviado < tam:
+        datos = os.pread(f.fileno(), min(1 << 20, tam - enviado), offset + enviado)
+        if not datos:
+            break   # El fichero ha encogido: el receptor verá que faltan bytes
+        salida += comp.compress(datos)
+        if resumen is not None:
+            resumen.update(datos)
+        enviado += len(datos)
+        if avanzar:
+            avanzar(len(datos))
+        if len(salida) >= 1 << 18:
+            sock.sendall(trama(OP_DATOS, salida, etiqueta=etiqueta, flags=flags))
+            salida.clear()
+    salida += comp.flush()
+    sock.sendall(trama(OP_DATOS, salida, etiqueta=etiqueta, flags=flags) + cabecera(OP_DATOS, 0, etiqueta=etiqueta, flags=flags))
+    return enviado
+
+
+def recibir_comprimido(sock, f, cab, avanzar=None, resumen=None):
+    """Recibe en f el contenido comprimido que llega en tramas OP_DATOS hasta la vacía. cab es
+    la cabecera de la primera, ya leída. Devuelve los bytes (descomprimidos) escritos. Con
+    resumen (un objeto de hashlib) se resume de paso lo recibido."""
+    d = descompresor(cab.flags)
+    escritos = 0
+    while True:
+        if cab.operacion != OP_DATOS:
+            raise ErrorProtocolo("Error: se esperaba el contenido del fichero.")
+        if cab.longitud > MAX_TROZO:
+            raise ErrorProtocolo(f"Error: trama de {cab.longitud} bytes, el máximo es {MAX_TROZO}.")
+        if cab.longitud == 0:
+            return escritos
+        for trozo in descomprimir(d, recibir_exacto(sock, cab.longitud)):
+            f.write(trozo)
+            if resumen is not None:
+                resumen.update(trozo)
+            escritos += len(trozo)
+            if avanzar:
+                avanzar(len(trozo))
+        cab = recibir_cabecera(sock)
+        if cab is None:
+            raise ConnectionError("conexión cerrada a mitad de un fichero comprimido")
+
+
+def descartar_comprimido(sock, cab):
+    """Descarta el resto de un contenido comprimido (ver recibir_comprimido)."""
+    while cab is not None and cab.longitud:
+        descartar(sock, cab.longitud)
+        cab = recibir_cabecera(sock)
+
+
+class EscritorTramas:
+    """Objeto fichero de solo escritura: lo que se escribe viaja en tramas OP_DATOS (comprimido
+    si flags lo indica) y cerrar() manda la trama vacía que lo termina. Sirve para contenido
+    que se genera sobre la marcha y cuyo tamaño no se conoce de antemano."""
+
+    def __init__(self, sock, flags=0, etiqueta=0):
+        self.sock = sock
+        self.flags = flags & MASCARA_COMPRESION
+        self.etiqueta = etiqueta
+        self.comp = compresor(self.flags) if self.flags else None
+        self.salida = bytearray()
+        self.escritos = 0   # Bytes escritos, antes de comprimir
+
+    def write(self, datos):
+        self.salida += self.comp.compress(datos) if self.comp else datos
+        self.escritos += len(datos)
+        if len(self.salida) >= 1 << 18:
+            self._enviar()
+        return len(datos)
+
+    def _enviar(self):
+        if self.salida:
+            self.sock.sendall(trama(OP_DATOS, self.salida, etiqueta=self.etiqueta, flags=self.flags))
+            self.salida.clear()
+
+    def cerrar(self):
+        if self.comp:
+            self.salida += self.comp.flush()
+        self._enviar()
+        self.sock.sendall(cabecera(OP_DATOS, 0, etiqueta=self.etiqueta, flags=self.flags))
+
+
+class LectorTramas:
+    """Objeto fichero de solo lectura con el contenido de las tramas OP_DATOS que llegan por
+    sock hasta la vacía, descomprimido si vienen comprimidas (ver EscritorTramas)."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.d = None
+        self.trozos = iter(())
+        self.pendiente = b""
+        self.fin = False
+        self.leidos = 0     # Bytes leídos, ya descomprimidos
+
+    def read(self, n=-1):
+        partes = []
+        while n != 0 and not self.fin:
+            if not self.pendiente:
+                self._siguiente()
+                continue
+            trozo = self.pendiente if n < 0 else self.pendiente[:n]
+            self.pendiente = self.pendiente[len(trozo):]
+            partes.append(trozo)
+            if n > 0:
+                n -= len(trozo)
+                break   # Como un socket: devuelve lo que haya, sin esperar a tener n bytes
+        datos = b"".join(partes)
+        self.leidos += len(datos)
+        return datos
+
+    def _siguiente(self):
+        self.pendiente = next(self.trozos, b"")
+        if self.pendiente:
+            return
+        cab = recibir_cabecera(self.sock)
+        if cab is None:
+            raise ConnectionError("conexión cerrada a mitad de un contenido en tramas")
+        if cab.operacion != OP_DATOS:
+            raise ErrorProtocolo("Error: se esperaban tramas de datos.")
+        if cab.longitud > MAX_TROZO:
+            raise ErrorProtocolo(f"Error: trama de {cab.longitud} bytes, el máximo es {MAX_TROZO}.")
+        if cab.longitud == 0:
+            self.fin = True
+            return
+        carga = recibir_exacto(self.sock, cab.longitud)
+        if cab.flags & MASCARA_COMPRESION:
+            if self.d is None:
+                self.d = descompresor(cab.flags)
+            self.trozos = descomprimir(self.d, carga)
+        else:
+            self.pendiente = carga
+
+    def descartar(self):
+        """Lee y descarta lo que quede hasta la trama vacía."""
+        while not self.fin:
+            self.pendiente = b""
+            self.trozos = iter(())
+            cab = recibir_cabecera(self.sock)
+            if cab is None or cab.longitud == 0:
+                self.fin = True
+            else:
+                descartar(self.sock, cab.longitud)
+
+
+def argumentos(lista):
+    return "\n".join(lista).encode("utf-8")
+
+
+def leer_argumentos(carga):
+    if not carga:
+        return []
+    return carga.decode("utf-8", errors="replace").split("\n")
+
+
+def leer_cabecera(datos):
+    """Interpreta los bytes de una cabecera. Lanza ErrorProtocolo si no es una trama."""
+    magia, version, operacion, estado, flags, etiqueta, longitud = CABECERA.unpack(datos)
+    if magia != MAGIA:
+        raise ErrorProtocolo("Error: trama con marca inicial inválida.")
+    return Cabecera(version, operacion, estado, flags, etiqueta, longitud)
+
+
+def recibir_exacto(sock, n):
+    """Recibe exactamente n bytes. Lanza ConnectionError si la conexión se cierra antes."""
+    datos = bytearray(n)
+    vista = memoryview(datos)
+    recibido = 0
+    while recibido < n:
+        leidos = sock.recv_into(vista[recibido:])
+        if not leidos:
+            raise ConnectionError("conexión cerrada a mitad de una trama")
+        recibido += leidos
+    return bytes(datos)
+
+
+def recibir_cabecera(sock):
+    """Recibe la cabecera de la siguiente trama. Devuelve None si la conexión se ha cerrado."""
+    primero = sock.recv(1)
+    if not primero:
+        return None
+    return leer_cabecera(primero + recibir_exacto(sock, CABECERA.size - 1))
+
+
+def recibir_trama(sock, maximo=MAX_ARGUMENTOS):
+    """Recibe una trama completa y devuelve (cabecera, carga), o None si la conexión se ha cerrado."""
+    cab = recibir_cabecera(sock)
+    if cab is None:
+        return None
+    if cab.longitud > maximo:
+        raise ErrorProtocolo(f"Error: trama de {cab.longitud} bytes, el máximo es {maximo}.")
+    return cab, recibir_exacto(sock, cab.longitud)
+
+
+def recibir_resumen(sock):
+    """Recibe la trama con el SHA-256 (hex) que sigue a una descarga pedida con FLAG_RESUMEN."""
+    recibida = recibir_trama(sock, TAM_RESUMEN)
+    if recibida is None:
+        raise ConnectionError("conexión cerrada antes de recibir el SHA-256 de la descarga")
+    cab, carga = recibida
+    if cab.operacion != OP_DATOS or len(carga) != TAM_RESUMEN:
+        raise ErrorProtocolo("Error: se esperaba el SHA-256 de la descarga.")
+    return carga.hex()
+
+
+def sin_retardo(sock):
+    """Desactiva el algoritmo de Nagle (TCP_NODELAY) en una conexión. Con él, una respuesta
+    que sale en dos escrituras pequeñas (cabecera y contenido) espera a que el otro extremo
+    confirme la primera, y este retrasa la confirmación (delayed ACK) unos 40 ms."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass    # No es TCP (p. ej. un socket Unix en las pruebas)
+
+
+def descartar(sock, n, tam_buf=65536):
+    """Lee y descarta n bytes, para dejar la conexión al principio de la siguiente trama."""
+    buf = bytearray(min(n, tam_buf) or 1)
+    while n > 0:
+        leidos = sock.recv_into(buf, min(n, len(buf)))
+        if not leidos:
+            raise ConnectionError("conexión cerrada a mitad de una trama")
+        n -= leidos
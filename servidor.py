@@ -1,7 +1,41 @@
 import socket # Para usar sockets TCP
 import sys # Para admitir argumentos 
 import argparse as ap # Podemos importar módulos con nombre largo y darles un alias más corto
+import datetime
 import os
+import errno
+import fnmatch
+import hashlib
+import logging
+import re
+import secrets
+import select
+import selectors
+import signal
+import stat
+import shutil
+import sqlite3
+import threading
+import time
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import queue
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+try:
+    import fcntl    # flock para que varios procesos no se pisen al registrar usuarios
+except ImportError:
+    fcntl = None
+
+import protocolo # Protocolo binario de tramas compartido con cliente.py
+import delta # Subidas por diferencias (al estilo rsync)
+import directorios # Transferencia de directorios completos como un tar
+
+# Trazas de depuración (--depurar): cada comando recibido
+registro = logging.getLogger("servidor")
 
 #Información: los nombres de fichero se pueden usar como ruta para navegar entre ellos, es decir, si tenemos un fichero en la ruta raiz del programa solo debemos indicar su nombre:
 # UPLOAD_FILE fichero.txt
@@ -21,12 +55,118 @@ def leer_fichero(nombre_fichero):
 #--EXTRA--
 #Listar ficheros debería contener la ruta del directorio del usuario como argumento para usarse en listdir y que liste la ruta que indicas
 
+class CacheListados:
+    """Contenido de los directorios listados recientemente, para no recorrerlos otra vez.
+    Cada entrada guarda el mtime del directorio: si ha cambiado (se ha creado, borrado o
+    renombrado algo dentro) se vuelve a leer. Los comandos que modifican el disco invalidan
+    además los directorios afectados, por si el cambio cae en el mismo tick del reloj.
+    Es un LRU acotado por el número total de nombres guardados (0 = sin caché)."""
+
+    def __init__(self, max_nombres=500_000):
+        self.max_nombres = max_nombres
+        # ruta absoluta -> (mtime_ns, ficheros, directorios); los listados ordenados se guardan
+        # como (ruta, directorios, orden, filtro) -> (entrada de la que salen, nombres, ())
+        self.entradas = OrderedDict()
+        self.nombres = 0
+        self.cerrojo = threading.Lock()
+
+    def contenido(self, ruta):
+        """Devuelve (ficheros, directorios) de ruta. Lanza las excepciones de os.scandir."""
+        entrada = self._entrada(os.path.abspath(ruta))
+        return entrada[1], entrada[2]
+
+    def consultar(self, ruta, mtime):
+        """(ficheros, directorios) de ruta si ya están en la caché y al día, o None."""
+        with self.cerrojo:
+            entrada = self.entradas.get(os.path.abspath(ruta))
+            if entrada and entrada[0] == mtime:
+                return entrada[1], entrada[2]
+        return None
+
+    def ordenado(self, ruta, directorios, orden, filtro=None):
+        """Ficheros (o subdirectorios) de ruta que encajan con el patrón filtro, ordenados por
+        orden: 'nombre', 'tam' o 'mtime', con '-' delante para el orden inverso. El resultado
+        se guarda en la caché ligado al contenido del que sale, para no volver a ordenarlo en
+        cada página de un listado."""
+        clave = os.path.abspath(ruta)
+        base = self._entrada(clave)
+        clave_orden = (clave, directorios, orden, filtro)
+        with self.cerrojo:
+            entrada = self.entradas.get(clave_orden)
+            if entrada and entrada[0] is base:
+                self.entradas.move_to_end(clave_orden)
+                return entrada[1]
+
+        nombres = base[2] if directorios else base[1]
+        if filtro:
+            nombres = [n for n in nombres if fnmatch.fnmatchcase(n, filtro)]
+        campo = orden.lstrip('-')
+        if campo == 'nombre':
+            nombres = sorted(nombres, reverse=orden.startswith('-'))
+        else:
+            def valor(nombre):
+                try:
+                    st = os.stat(os.path.join(clave, nombre))
+                except OSError:
+                    return (0, nombre)
+                return (st.st_size if campo == 'tam' else st.st_mtime_ns, nombre)
+            nombres = sorted(nombres, key=valor, reverse=orden.startswith('-'))
+        nombres = tuple(nombres)
+        self._guardar(clave_orden, (base, nombres, ()))
+        return nombres
+
+    def _entrada(self, clave):
+        mtime = os.stat(clave).st_mtime_ns
+        with self.cerrojo:
+            entrada = self.entradas.get(clave)
+            if entrada and entrada[0] == mtime:
+                self.entradas.move_to_end(clave)
+                return entrada
+
+        # os.scandir da el tipo de cada entrada (d_type) sin un stat por fichero
+        ficheros, directorios = [], []
+        with os.scandir(clave) as entradas:
+            for e in entradas:
+                try:
+                    if e.is_file():
+                        ficheros.append(e.name)
+                    elif e.is_dir():
+                        directorios.append(e.name)
+                except OSError:
+                    pass
+        entrada = (mtime, tuple(ficheros), tuple(directorios))
+        self._guardar(clave, entrada)
+        return entrada
+
+    def _guardar(self, clave, entrada):
+        tam = len(entrada[1]) + len(entrada[2])
+        with self.cerrojo:
+            self._quitar(clave)
+            if tam > self.max_nombres:
+                return
+            self.entradas[clave] = entrada
+            self.nombres += tam
+            while self.nombres > self.max_nombres:
+                self._quitar(next(iter(self.entradas)))
+
+    def _quitar(self, clave):
+        entrada = self.entradas.pop(clave, None)
+        if entrada:
+            self.nombres -= len(entrada[1]) + len(entrada[2])
+
+    def invalidar(self, *rutas):
+        """Olvida los directorios afectados por un cambio en rutas (cada ruta y su padre)."""
+        with self.cerrojo:
+            for ruta in rutas:
+                clave = os.path.abspath(ruta)
+                self._quitar(clave)
+                self._quitar(os.path.dirname(clave))
+
+listados = CacheListados()
+
 def listar_ficheros(ruta="."):
-    #Listar ficheros, función listdir()
     try:
-        elementos = os.listdir(ruta)
-        # Filtrar solo los que sean archivos
-        archivos = [e for e in elementos if os.path.isfile(os.path.join(ruta, e))]
+        archivos, _ = listados.contenido(ruta)
         return "\n".join(archivos) if archivos else "No hay archivos en la ruta."
     except FileNotFoundError:
         return f"Error: La ruta '{ruta}' no existe."
@@ -39,6 +179,8 @@ def borrar_fichero(nombre_fichero):
     try:
         #Borrar fichero, función remove()
         os.remove(nombre_fichero)
+        listados.invalidar(nombre_fichero)
+        indice.actualizar(nombre_fichero)
         return "DELETED"
     except FileNotFoundError:
         return "ERROR"
@@ -49,122 +191,1539 @@ def borrar_fichero(nombre_fichero):
     
 
 
-def descargar_fichero(conn, fichero):
+def _enviar_fichero(conn, f, tam, offset=0, resumen=None):
+    """Envía tam bytes del fichero abierto f, empezando en offset, sin cargarlo en memoria.
+    socket.sendfile usa os.sendfile, con lo que el núcleo pasa los datos del fichero al socket
+    sin copiarlos a Python; donde no está disponible envía por bloques con un buffer fijo.
+    Con resumen (un objeto de hashlib) los datos tienen que pasar por Python para resumirlos:
+    se leen por bloques, se resumen y se envían, sin una segunda lectura del fichero."""
+    if resumen is None:
+        enviado = conn.sendfile(f, offset, tam)
+    else:
+        enviado = 0
+        while enviado < tam:
+            datos = os.pread(f.fileno(), min(1 << 20, tam - enviado), offset + enviado)
+            if not datos:
+                break
+            resumen.update(datos)
+            conn.sendall(datos)
+            enviado += len(datos)
+    metricas.enviados(enviado)
+    if enviado < tam:
+        # El fichero ha encogido mientras se enviaba: ya no podemos cumplir la longitud anunciada
+        raise ConnectionError("el fichero ha cambiado durante el envío")
+
+def _leer_contenido(f, tam, offset=0, resumen=None):
+    """Los tam bytes de f a partir de offset, para enviarlos junto con su cabecera (ficheros
+    pequeños, ver protocolo.MAX_JUNTO). Con resumen los resume de paso."""
+    datos = os.pread(f.fileno(), tam, offset)
+    if len(datos) < tam:
+        raise ConnectionError("el fichero ha cambiado durante el envío")
+    if resumen is not None:
+        resumen.update(datos)
+    metricas.enviados(tam)
+    return datos
+
+def _rango(tam_total, offset=0, longitud=None):
+    """Comprueba un rango [offset, offset+longitud) de un fichero de tam_total bytes y devuelve
+    cuántos bytes hay que enviar. Sin longitud, hasta el final. Lanza ValueError si no es válido."""
+    if offset > tam_total:
+        raise ValueError(f"Error: el offset {offset} está más allá del final del fichero ({tam_total} bytes).")
+    disponible = tam_total - offset
+    return disponible if longitud is None else min(longitud, disponible)
+
+def descargar_fichero(conn, fichero, offset=0, longitud=None):
     try:
         # Comprobar que existe
         if not os.path.isfile(fichero):
-            conn.sendall("ERROR".encode("ascii"))
+            conn.sendall(_respuesta_texto('DOWNLOAD_FILE', "ERROR"))
             return
 
-        # Leer archivo
         with open(fichero, "rb") as f:
-            contenido = f.read()
-
-        # Mandar tamaño del fichero (cadena)
-        tam = str(len(contenido))
-        conn.sendall(tam.encode("ascii"))
-
-        # Esperar ACK del cliente
-        ack = conn.recv(1024).decode("ascii")
-        if ack != "ACK":
-            conn.sendall("ERROR".encode("ascii"))
-            return
-
-        # Enviar contenido del fichero
-        conn.sendall(contenido)
+            # Mandar tamaño del fichero (o del rango pedido) como cadena
+            try:
+                tam = _rango(os.fstat(f.fileno()).st_size, offset, longitud)
+            except ValueError as e:
+                conn.sendall(_respuesta_texto('DOWNLOAD_FILE', str(e)))
+                return
+            conn.sendall(str(tam).encode("ascii"))
+
+            # Esperar ACK del cliente
+            ack = conn.recv(1024).decode("ascii")
+            if ack != "ACK":
+                conn.sendall(_respuesta_texto('DOWNLOAD_FILE', "ERROR"))
+                return
+
+            # Enviar contenido del fichero
+            _enviar_fichero(conn, f, tam, offset)
 
     except PermissionError:
-        conn.sendall(f"ERROR".encode("ascii"))
+        conn.sendall(_respuesta_texto('DOWNLOAD_FILE', "ERROR"))
+    except ConnectionError:
+        raise
     except Exception as e:
-        conn.sendall(f"ERROR".encode("ascii"))
-
-def subir_fichero(conn, fichero, dest_dir=None):
+        conn.sendall(_respuesta_texto('DOWNLOAD_FILE', "ERROR"))
+
+def descargar_fichero_trama(conn, fichero, etiqueta=0, offset=0, longitud=None, compresion=0, con_resumen=False):
+    """DOWNLOAD_FILE con el protocolo binario: una única trama de respuesta con el contenido
+    (o con el rango pedido). Si el cliente admite compresión y una muestra del fichero se deja
+    comprimir, el contenido va comprimido en tramas (ver protocolo.py). Con con_resumen
+    (FLAG_RESUMEN) detrás va una trama OP_DATOS con el SHA-256 de lo enviado."""
+    op = protocolo.OPERACIONES["DOWNLOAD_FILE"]
+    nombre = os.path.basename(fichero)
     try:
-        #Enviar primer ACK
-        conn.sendall("UPLOAD_ACK".encode("ascii"))
-        #Recibir tamaño del fichero
-        tam_str = conn.recv(1024).decode("ascii")
+        f = open(fichero, "rb")
+    except (FileNotFoundError, IsADirectoryError):
+        conn.sendall(_respuesta(op, f"Error: El fichero '{nombre}' no existe.", etiqueta))
+        return
+    except PermissionError:
+        conn.sendall(_respuesta(op, f"Error: Permisos insuficientes para leer '{nombre}'.", etiqueta))
+        return
+
+    with f:
+        st = os.fstat(f.fileno())
         try:
-            tam = int(tam_str)
-        except ValueError:
-            err = "Error: tamaño de fichero inválido."
-            conn.sendall(err.encode("ascii"))
-            return err
+            tam = _rango(st.st_size, offset, longitud)
+        except ValueError as e:
+            conn.sendall(_respuesta(op, str(e), etiqueta))
+            return
+        # Con FLAG_RESUMEN el SHA-256 se calcula según se envía, salvo que ya se conozca
+        resumen = _resumen_por_calcular(fichero, st, offset, tam, con_resumen)
+        junto = b""     # Lo que aún no se ha enviado: un fichero pequeño va en una sola escritura
+        if compresion and protocolo.comprimible(f, offset, tam):
+            conn.sendall(protocolo.trama(op, protocolo.TAM_ORIGINAL.pack(tam), etiqueta=etiqueta, flags=compresion))
+            metricas.enviados(protocolo.enviar_comprimido(conn, f, offset, tam, compresion, etiqueta=etiqueta, resumen=resumen))
+        elif tam <= protocolo.MAX_JUNTO:
+            junto = protocolo.cabecera(op, tam, etiqueta=etiqueta) + _leer_contenido(f, tam, offset, resumen)
+        else:
+            conn.sendall(protocolo.cabecera(op, tam, etiqueta=etiqueta))
+            _enviar_fichero(conn, f, tam, offset, resumen)
+        if resumen is not None:
+            conocido = resumen.hexdigest()
+            if offset == 0 and tam == st.st_size:
+                cache_resumenes.guardar(st, conocido)
+        elif con_resumen:
+            conocido = resumen_conocido(fichero, st)
+        if con_resumen:
+            junto += protocolo.trama(protocolo.OP_DATOS, bytes.fromhex(conocido), etiqueta=etiqueta)
+        if junto:
+            conn.sendall(junto)
+
+def _ruta_subida(fichero, dest_dir=None):
+    """Ruta donde guardar un fichero subido. Si ya existe, se usa <nombre-copiaX>."""
+    nombre = os.path.basename(fichero)
+
+    # Directorio destino (por defecto cwd)
+    if dest_dir:
+        os.makedirs(dest_dir, exist_ok=True)
+        ruta_salida = os.path.join(dest_dir, nombre)
+    else:
+        ruta_salida = nombre
+
+    # Si ya existe, renombrar como <nombre-copiaX>
+    if os.path.exists(ruta_salida):
+        base, ext = os.path.splitext(nombre)
+        candidato = f"{base}-copia{ext}"
+        contador = 1
+        while True:
+            if dest_dir:
+                candidato_path = os.path.join(dest_dir, candidato)
+            else:
+                candidato_path = candidato
+            if not os.path.exists(candidato_path):
+                ruta_salida = candidato_path
+                break
+            candidato = f"{base}-copia{contador}{ext}"
+            contador += 1
+    return ruta_salida
+
+class Ajustes:
+    """Parámetros de las transferencias, que se fijan desde la línea de comandos."""
+
+    def __init__(self):
+        self.tam_buf = 65536           # Buffer de recepción de ficheros
+        self.reservar = False          # Reservar en disco el tamaño anunciado antes de recibir
+        self.durabilidad = 'ninguna'   # ninguna | cierre | periodica
+        self.fsync_mib = 64            # Cada cuántos MiB hace fsync la durabilidad 'periodica'
+        self.hilos_arbol = 8           # Hilos que reparten la E/S de las operaciones recursivas
+
+ajustes = Ajustes()
+
+def _recibir_a_fichero(conn, f, tam, resumen=None):
+    """Recibe tam bytes de la conexión y los escribe en f (y los resume en resumen, un objeto
+    de hashlib, si se indica).
+    Devuelve los bytes recibidos, que son menos de tam si el cliente cierra la conexión antes.
+    Si falla la escritura sigue leyendo (y descartando) hasta tam, para no desincronizar la
+    conexión, y al terminar relanza el error.
+
+    Recibe con recv_into sobre un único buffer reutilizado, sin crear un objeto bytes por
+    bloque. Según 'ajustes' reserva antes el espacio en disco (posix_fallocate, evita
+    fragmentación y detecta pronto el disco lleno) y hace fsync al cerrar o cada N MiB."""
+    buf = bytearray(max(ajustes.tam_buf, 1))
+    vista = memoryview(buf)
+    error = None
+    reservado = False
+    if ajustes.reservar and tam > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            f.flush()
+            os.posix_fallocate(f.fileno(), f.tell(), tam)
+            reservado = True
+        except OSError as e:
+            # Sistemas de ficheros sin soporte: seguimos sin reservar. Sin espacio: error
+            if e.errno == errno.ENOSPC:
+                error = e
+
+    periodo = ajustes.fsync_mib << 20 if ajustes.durabilidad == 'periodica' else 0
+    sin_sync = 0
+    recibido = 0
+    while recibido < tam:
+        leidos = conn.recv_into(vista, min(len(buf), tam - recibido))
+        if not leidos:
+            break
+        if resumen is not None:
+            resumen.update(vista[:leidos])
+        if error is None:
+            try:
+                f.write(vista[:leidos])
+                sin_sync += leidos
+                if periodo and sin_sync >= periodo:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    sin_sync = 0
+            except OSError as e:
+                error = e
+        recibido += leidos
+    metricas.recibidos(recibido)
+    if reservado and recibido < tam:
+        # Quitamos la parte reservada que no ha llegado a escribirse
+        try:
+            f.flush()
+            f.truncate()
+        except OSError:
+            pass
+    if error is None and recibido == tam and ajustes.durabilidad != 'ninguna':
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+        except OSError as e:
+            error = e
+    if error is not None:
+        raise error
+    return recibido
+
+def _ruta_parcial(fichero, dest_dir=None):
+    """Fichero oculto donde se va guardando una subida hasta que se completa. Si la conexión
+    se corta se conserva, y la subida se puede reanudar desde donde se quedó."""
+    return os.path.join(dest_dir or "", "." + os.path.basename(fichero) + ".part")
+
+def nombre_reservado(ruta):
+    """Error si el nombre de ruta es el de un temporal del servidor (IndiceFicheros.TEMPORAL,
+    p. ej. '.x.part'), o None. Los temporales se escriben en su sitio: si un usuario pudiera
+    dar ese nombre a un fichero, una subida reanudada escribiría en él y en todos los enlaces
+    duros de su inodo (ver deduplicar)."""
+    nombre = os.path.basename(os.path.normpath(ruta))
+    if IndiceFicheros.TEMPORAL.match(nombre):
+        return f"Error: '{nombre}' es un nombre reservado para los ficheros temporales del servidor."
+    return None
+
+def _abrir_en_su_sitio(ruta):
+    """Abre un temporal de subida para escribir en él sin sustituirlo. Si tiene otros enlaces
+    duros (es un blob o un fichero compartido), escribir cambiaría también los demás."""
+    f = open(ruta, "r+b")
+    if os.fstat(f.fileno()).st_nlink > 1:
+        f.close()
+        raise ValueError(f"Error: '{os.path.basename(ruta)}' está enlazado con otros ficheros y no se puede escribir en él.")
+    return f
+
+def _abrir_parcial(fichero, dest_dir=None, offset=0):
+    """Abre el fichero parcial de una subida, listo para escribir a partir de offset.
+    Con offset 0 empieza de cero; si no, la subida parcial debe tener al menos offset bytes."""
+    if dest_dir:
+        os.makedirs(dest_dir, exist_ok=True)
+    ruta = _ruta_parcial(fichero, dest_dir)
+    if offset == 0:
+        # Uno nuevo: si ya había uno (quizá enlazado con otros ficheros), no se toca su inodo
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
+        return ruta, open(ruta, "xb")
+    f = _abrir_en_su_sitio(ruta)
+    tam = os.fstat(f.fileno()).st_size
+    if offset > tam:
+        f.close()
+        raise ValueError(f"Error: no se puede reanudar en el byte {offset}, la subida parcial tiene {tam} bytes.")
+    f.truncate(offset)
+    f.seek(offset)
+    return ruta, f
+
+def _resumen_inicial(f, offset):
+    """SHA-256 (objeto de hashlib) de los primeros offset bytes de f, lo que ya tenía una subida
+    que se reanuda, para seguir resumiendo lo que llega sin releer el fichero al terminar."""
+    resumen = hashlib.sha256()
+    leido = 0
+    while leido < offset:
+        datos = os.pread(f.fileno(), min(1 << 20, offset - leido), leido)
+        if not datos:
+            break
+        resumen.update(datos)
+        leido += len(datos)
+    return resumen
+
+def _error_subida(e, fichero):
+    if isinstance(e, ValueError):
+        return str(e)
+    if isinstance(e, FileNotFoundError):
+        return f"Error: no hay ninguna subida parcial de '{os.path.basename(fichero)}' que reanudar."
+    if isinstance(e, PermissionError):
+        return f"Error: permisos insuficientes para escribir '{fichero}'."
+    return f"Error al subir fichero: {e}"
+
+def _sha256_fichero(ruta, longitud=None):
+    """Resumen SHA-256 (hex) de los primeros 'longitud' bytes del fichero (todo si es None)."""
+    resumen = hashlib.sha256()
+    buf = bytearray(1 << 20)
+    vista = memoryview(buf)
+    pendiente = longitud
+    with open(ruta, "rb") as f:
+        while pendiente is None or pendiente > 0:
+            leidos = f.readinto(vista if pendiente is None else vista[:min(len(buf), pendiente)])
+            if not leidos:
+                break
+            resumen.update(vista[:leidos])
+            if pendiente is not None:
+                pendiente -= leidos
+    return resumen.hexdigest()
+
+class CacheResumenes:
+    """SHA-256 de los ficheros ya resumidos, por (dispositivo, inodo, tamaño, mtime_ns). El
+    servidor nunca modifica un fichero en su sitio: un inodo con el mismo tamaño y la misma
+    fecha tiene el mismo contenido, y los enlaces del almacén de contenidos (un mismo inodo)
+    comparten la entrada. Se llena con las subidas y descargas, que resumen los datos según
+    pasan, y HASH y STAT la consultan. LRU acotado (0 = sin caché)."""
+
+    def __init__(self, max_entradas=100_000):
+        self.max_entradas = max_entradas
+        self.entradas = OrderedDict()
+        self.cerrojo = threading.Lock()
+
+    @staticmethod
+    def clave(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def consultar(self, st):
+        """SHA-256 del fichero con ese os.stat_result, o None si no se conoce."""
+        clave = self.clave(st)
+        with self.cerrojo:
+            resumen = self.entradas.get(clave)
+            if resumen is not None:
+                self.entradas.move_to_end(clave)
+            return resumen
+
+    def guardar(self, st, resumen):
+        if not self.max_entradas or not resumen:
+            return
+        clave = self.clave(st)
+        with self.cerrojo:
+            self.entradas[clave] = resumen
+            self.entradas.move_to_end(clave)
+            while len(self.entradas) > self.max_entradas:
+                self.entradas.popitem(last=False)
+
+cache_resumenes = CacheResumenes()
+
+def resumen_conocido(ruta, st):
+    """SHA-256 de un fichero sin leerlo: de la caché o, si no ha cambiado desde que se
+    registró, del índice de ficheros. None si no se conoce."""
+    resumen = cache_resumenes.consultar(st)
+    if resumen is None:
+        resumen = indice.resumen(ruta, st)
+        cache_resumenes.guardar(st, resumen)
+    return resumen
+
+def resumen_completo(ruta):
+    """SHA-256 de un fichero completo, leyéndolo solo si no se conoce (y entonces se guarda)."""
+    st = os.stat(ruta)
+    resumen = resumen_conocido(ruta, st)
+    if resumen is None:
+        resumen = _sha256_fichero(ruta)
+        # Si ha cambiado mientras se leía, el resumen no corresponde a ninguna versión
+        if CacheResumenes.clave(os.stat(ruta)) == CacheResumenes.clave(st):
+            cache_resumenes.guardar(st, resumen)
+    return resumen
+
+def _resumen_por_calcular(ruta, st, offset, tam, con_resumen=False):
+    """Objeto de hashlib para resumir lo que se envía de un fichero, o None si no hace falta.
+    Solo se resume si el cliente lo pide (FLAG_RESUMEN) y no se conoce ya: resumir obliga a
+    pasar los datos por Python en vez de usar sendfile. Sin él, el SHA-256 del fichero entero
+    se calcula cuando se pida (HASH, ver resumen_completo) y entonces se guarda en la caché."""
+    if not con_resumen:
+        return None
+    if offset == 0 and tam == st.st_size and resumen_conocido(ruta, st):
+        return None
+    return hashlib.sha256()
+
+# Almacén de contenidos: los ficheros de los usuarios con el mismo contenido son enlaces duros a
+# un único blob, usuarios/.blobs/<sha256[:2]>/<sha256>. El número de enlaces del inodo
+# (st_nlink) hace de contador de referencias: un blob con st_nlink == 1 ya no lo usa nadie.
+# Compartir el inodo es seguro porque el servidor nunca modifica un fichero en su sitio: las
+# subidas se escriben aparte y sustituyen al fichero con os.replace.
+DIR_USUARIOS = os.path.join(".", "usuarios")
+DIR_BLOBS = os.path.join(DIR_USUARIOS, ".blobs")
+
+def _ruta_blob(resumen):
+    return os.path.join(DIR_BLOBS, resumen[:2], resumen)
+
+def deduplicar(ruta, resumen=None):
+    """Incorpora un fichero de un usuario al almacén: si ya hay un blob con el mismo contenido,
+    el fichero pasa a ser un enlace a él; si no, el propio fichero se convierte en el blob.
+    Si el sistema de ficheros no lo permite el fichero se queda como una copia normal.
+    Devuelve el SHA-256 del contenido, que queda en cache_resumenes, o None si no se ha
+    llegado a calcular."""
+    if os.path.abspath(ruta).startswith(os.path.abspath(DIR_USUARIOS) + os.sep):
+        resumen = _enlazar_blob(ruta, resumen)
+    if resumen:
+        try:
+            cache_resumenes.guardar(os.stat(ruta), resumen)
+        except OSError:
+            pass
+    return resumen
 
-        #Confirmar tamaño recibido
-        conn.sendall("UPLOAD_ACK".encode("ascii"))
+def _enlazar_blob(ruta, resumen):
+    """Sustituye el fichero por un enlace al blob de su contenido (o lo convierte en el blob).
+    Sin resumen, el fichero solo se lee si su SHA-256 no está en la caché ni en el índice."""
+    temporal = None
+    try:
+        resumen = resumen.lower() if resumen else resumen_completo(ruta)
+        blob = _ruta_blob(resumen)
+        if os.path.exists(blob) and os.path.samefile(blob, ruta):
+            return resumen      # Ya es un enlace al blob (p. ej. al compartirlo otra vez)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(ruta, blob)
+            return resumen
+        except FileExistsError:
+            pass
+        if os.path.samefile(blob, ruta):
+            return resumen
+        # Sustituimos el fichero por un enlace al blob de forma atómica
+        temporal = os.path.join(os.path.dirname(ruta), f".{os.path.basename(ruta)}.{secrets.token_hex(4)}.enlace")
+        os.link(blob, temporal)
+        os.replace(temporal, ruta)
+    except OSError:
+        # Sin enlaces duros (EXDEV, EMLINK, EPERM...) o el blob lo ha borrado el recolector
+        if temporal and os.path.exists(temporal):
+            os.remove(temporal)
+    return resumen
+
+def recolectar_blobs():
+    """GC: borra los blobs que ya no enlaza ningún fichero de usuario (st_nlink == 1)."""
+    borrados = liberados = 0
+    if not os.path.isdir(DIR_BLOBS):
+        return "SUCCESS: 0 blobs sin referencias borrados, 0 bytes liberados."
+    with os.scandir(DIR_BLOBS) as grupos:
+        for grupo in grupos:
+            if not grupo.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(grupo.path) as blobs:
+                for blob in blobs:
+                    st = blob.stat(follow_symlinks=False)
+                    if st.st_nlink == 1:
+                        try:
+                            os.remove(blob.path)
+                        except FileNotFoundError:
+                            continue
+                        borrados += 1
+                        liberados += st.st_size
+    return f"SUCCESS: {borrados} blobs sin referencias borrados, {liberados} bytes liberados."
+
+ESQUEMA_INDICE = """
+CREATE TABLE IF NOT EXISTS ficheros (
+    ruta TEXT PRIMARY KEY,      -- Relativa a DIR_USUARIOS: 'usuario/dir/fichero'
+    nombre TEXT NOT NULL,
+    tam INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT                 -- NULL si no se conoce
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ficheros_nombre ON ficheros (nombre);
+CREATE INDEX IF NOT EXISTS ficheros_tam ON ficheros (tam);
+CREATE INDEX IF NOT EXISTS ficheros_mtime ON ficheros (mtime_ns);
+CREATE INDEX IF NOT EXISTS ficheros_sha256 ON ficheros (sha256);
+"""
 
-        #Recibir datos hasta completar longitud
-        recibido = 0
-        nombre = os.path.basename(fichero)
+# El resumen se conserva mientras el tamaño y la fecha no cambien
+SQL_PONER_FICHERO = """
+INSERT INTO ficheros (ruta, nombre, tam, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (ruta) DO UPDATE SET
+    sha256 = CASE WHEN excluded.sha256 IS NOT NULL THEN excluded.sha256
+                  WHEN tam = excluded.tam AND mtime_ns = excluded.mtime_ns THEN sha256 END,
+    tam = excluded.tam,
+    mtime_ns = excluded.mtime_ns
+"""
 
-        # Directorio destino (por defecto cwd)
-        if dest_dir:
-            os.makedirs(dest_dir, exist_ok=True)
-            ruta_salida = os.path.join(dest_dir, nombre)
+class IndiceFicheros:
+    """Índice en SQLite de los ficheros de los usuarios (ruta, tamaño, fecha y, si se conoce,
+    SHA-256) para que SEARCH conteste con una consulta en lugar de recorrer el disco.
+    Al arrancar se reconcilia con el disco; después lo mantienen al día los comandos que
+    modifican ficheros, que llaman a actualizar con las rutas afectadas igual que invalidan
+    la caché de listados. Los ficheros temporales de las subidas no se indexan."""
+
+    TEMPORAL = re.compile(r"^\..*\.(part|delta|enlace|mover)$")
+
+    def __init__(self, fichero="indice.sqlite", raiz=DIR_USUARIOS):
+        self.fichero = fichero
+        self.raiz = raiz
+        self.bd = None
+        self.cerrojo = threading.Lock()   # Una sola conexión, compartida por todos los hilos
+
+    def _abrir(self):
+        if self.bd is None:
+            self.bd = sqlite3.connect(self.fichero, check_same_thread=False)
+            self.bd.execute("PRAGMA journal_mode=WAL")
+            # Con WAL no hace fsync en cada cambio; si se pierde alguno, se corrige al arrancar
+            self.bd.execute("PRAGMA synchronous=NORMAL")
+            self.bd.executescript(ESQUEMA_INDICE)
+        return self.bd
+
+    def cerrar(self):
+        """Cierra la conexión; se vuelve a abrir al usarse. Los procesos de --workers no pueden
+        heredar una conexión abierta de SQLite: el supervisor la cierra antes de crearlos."""
+        with self.cerrojo:
+            if self.bd is not None:
+                self.bd.close()
+                self.bd = None
+
+    def relativa(self, ruta):
+        """Ruta en el índice ('' para todo) o None si ruta no está bajo DIR_USUARIOS."""
+        rel = os.path.relpath(os.path.abspath(ruta), os.path.abspath(self.raiz))
+        if rel == ".":
+            return ""
+        if rel.startswith("."):
+            return None     # Fuera de DIR_USUARIOS ('..'), o en .blobs
+        return rel.replace(os.sep, "/")
+
+    def _recorrer(self, rel):
+        """(ruta, os.stat_result) de los ficheros regulares bajo rel en el disco."""
+        pila = [rel]
+        while pila:
+            actual = pila.pop()
+            try:
+                entradas = os.scandir(os.path.join(self.raiz, actual) if actual else self.raiz)
+            except OSError:
+                continue
+            with entradas:
+                for e in entradas:
+                    ruta = f"{actual}/{e.name}" if actual else e.name
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if actual or not e.name.startswith("."):
+                                pila.append(ruta)
+                        elif actual and e.is_file(follow_symlinks=False) and not self.TEMPORAL.match(e.name):
+                            yield ruta, e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+    def _sincronizar(self, bd, rel, resumenes):
+        """Pone al día en el índice rel: un fichero, o todo lo que hay bajo un directorio
+        (o lo que había, si ya no existe)."""
+        try:
+            st = os.lstat(os.path.join(self.raiz, rel) if rel else self.raiz)
+        except FileNotFoundError:
+            st = None
+        en_disco = {}
+        if st is not None and stat.S_ISREG(st.st_mode):
+            if "/" in rel and not self.TEMPORAL.match(os.path.basename(rel)):
+                en_disco[rel] = st
+        elif st is not None and stat.S_ISDIR(st.st_mode):
+            en_disco = dict(self._recorrer(rel))
+        # Lo guardado para rel y, si es un directorio, lo que cuelga de él
+        if rel:
+            guardados = bd.execute("SELECT ruta, tam, mtime_ns FROM ficheros WHERE ruta = ? OR (ruta >= ? AND ruta < ?)",
+                                   (rel, rel + "/", rel + "0")).fetchall()
         else:
-            ruta_salida = nombre
-
-        # Si ya existe, renombrar como <nombre-copiaX>
-        if os.path.exists(ruta_salida):
-            base, ext = os.path.splitext(nombre)
-            candidato = f"{base}-copia{ext}"
-            contador = 1
-            while True:
-                if dest_dir:
-                    candidato_path = os.path.join(dest_dir, candidato)
-                else:
-                    candidato_path = candidato
-                if not os.path.exists(candidato_path):
-                    ruta_salida = candidato_path
-                    nombre = os.path.basename(ruta_salida)
-                    break
-                candidato = f"{base}-copia{contador}{ext}"
-                contador += 1
-
-        with open(ruta_salida, "wb") as f:
-            while recibido < tam:
-                bloque = conn.recv(min(4096, tam - recibido))
-                if not bloque:
-                    err = "Error: conexión cerrada antes de recibir el fichero completo."
-                    conn.sendall(err.encode("ascii"))
-                    return err
-                f.write(bloque)
-                recibido += len(bloque)
-
-        #Confirmar recepción de datos
-        conn.sendall("DATA_RECEIVED\n".encode("ascii"))
-
-        #Mensaje final de éxito
-        response = f"SUCCESS: Fichero '{nombre}' subido correctamente.\n"
-        conn.sendall(response.encode("ascii"))
+            guardados = bd.execute("SELECT ruta, tam, mtime_ns FROM ficheros").fetchall()
+        borrar = [(ruta,) for ruta, _, _ in guardados if ruta not in en_disco]
+        conocidos = {ruta: (tam, mtime) for ruta, tam, mtime in guardados}
+        poner = [(ruta, ruta.rpartition("/")[2], st.st_size, st.st_mtime_ns, resumenes.get(ruta))
+                 for ruta, st in en_disco.items()
+                 if conocidos.get(ruta) != (st.st_size, st.st_mtime_ns) or ruta in resumenes]
+        bd.executemany("DELETE FROM ficheros WHERE ruta = ?", borrar)
+        bd.executemany(SQL_PONER_FICHERO, poner)
+        return len(en_disco), len(poner) + len(borrar)
+
+    def actualizar(self, *rutas, resumenes=None):
+        """Pone al día las rutas (ficheros o directorios, existan o no) tras un cambio en el
+        disco. resumenes: {ruta: sha256} de los ficheros cuyo contenido ya se conoce."""
+        resumenes = {self.relativa(r): v for r, v in (resumenes or {}).items() if v}
+        try:
+            with self.cerrojo, self._abrir() as bd:
+                for ruta in rutas:
+                    rel = self.relativa(ruta)
+                    if rel is not None:
+                        self._sincronizar(bd, rel, resumenes)
+        except sqlite3.Error as e:
+            # El índice no debe hacer fallar la operación; se corregirá al arrancar
+            print(f"Aviso: no se ha podido actualizar el índice de ficheros: {e}")
+
+    def guardar(self, ruta, resumen=None):
+        """Registra un fichero recién escrito, con su SHA-256 si se conoce."""
+        self.actualizar(ruta, resumenes={ruta: resumen})
+
+    def resumen(self, ruta, st):
+        """SHA-256 registrado de ruta si sigue teniendo el tamaño y la fecha de st, o None."""
+        rel = self.relativa(ruta)
+        if not rel:
+            return None
+        try:
+            with self.cerrojo:
+                fila = self._abrir().execute("SELECT sha256 FROM ficheros WHERE ruta = ? AND tam = ? AND mtime_ns = ?",
+                                             (rel, st.st_size, st.st_mtime_ns)).fetchone()
+        except sqlite3.Error:
+            return None
+        return fila[0] if fila else None
+
+    def reconciliar(self):
+        """Compara el índice con el disco y corrige las diferencias (al arrancar)."""
+        inicio = time.perf_counter()
+        with self.cerrojo, self._abrir() as bd:
+            ficheros, cambios = self._sincronizar(bd, "", {})
+        return f"{ficheros} ficheros, {cambios} cambios, {time.perf_counter() - inicio:.2f} s"
+
+    def buscar(self, prefijo, condiciones, valores, orden, limite):
+        """Filas (ruta, tam, mtime_ns) bajo prefijo ('' para todo) que cumplen las condiciones
+        SQL (con sus valores), ordenadas por orden, como mucho limite."""
+        sql = "SELECT ruta, tam, mtime_ns FROM ficheros"
+        if prefijo:
+            condiciones = ["ruta >= ? AND ruta < ?"] + condiciones
+            valores = [prefijo + "/", prefijo + "0"] + valores
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        sql += f" ORDER BY {orden} LIMIT ?"
+        with self.cerrojo:
+            return self._abrir().execute(sql, valores + [limite]).fetchall()
+
+indice = IndiceFicheros()
+
+def _completar_subida(ruta_parcial, fichero, dest_dir=None, resumen=None, calculado=None):
+    """Da por terminada una subida: si se indicó el SHA-256 esperado lo comprueba y mueve el
+    fichero parcial a su nombre definitivo. calculado es el SHA-256 de lo recibido, si se ha
+    ido resumiendo según llegaba; si no, se lee el fichero. Devuelve el mensaje para el
+    cliente, que incluye el SHA-256 para que compruebe que coincide con el suyo."""
+    if calculado is None:
+        calculado = _sha256_fichero(ruta_parcial)
+    if resumen and calculado != resumen.lower():
+        os.remove(ruta_parcial)
+        return "Error: el fichero subido no coincide con su resumen SHA-256, hay que subirlo de nuevo."
+    ruta_salida = _ruta_subida(fichero, dest_dir)
+    os.replace(ruta_parcial, ruta_salida)
+    listados.invalidar(ruta_salida)
+    indice.guardar(ruta_salida, deduplicar(ruta_salida, calculado))
+    return f"SUCCESS: Fichero '{os.path.basename(ruta_salida)}' subido correctamente (SHA-256 {calculado})."
+
+def estado_subida(fichero, dest_dir=None):
+    """UPLOAD_STATUS: bytes y SHA-256 de la subida parcial de un fichero, para que el cliente
+    compruebe que coincide con el principio de su copia antes de reanudar."""
+    ruta = _ruta_parcial(fichero, dest_dir)
+    try:
+        tam = os.path.getsize(ruta)
+        return f"SUCCESS: {tam} {_sha256_fichero(ruta, tam)}"
+    except FileNotFoundError:
+        return f"Error: no hay ninguna subida parcial de '{os.path.basename(fichero)}'."
+    except OSError as e:
+        return f"Error al consultar la subida parcial: {e}"
+
+def resumen_fichero(fichero, longitud=None):
+    """HASH: SHA-256 de un fichero (o de sus primeros 'longitud' bytes) y los bytes resumidos.
+    El del fichero entero sale de cache_resumenes sin leerlo si ya se conoce."""
+    if not os.path.isfile(fichero):
+        return f"Error: El fichero '{os.path.basename(fichero)}' no existe."
+    try:
+        tam = os.path.getsize(fichero)
+        if longitud is None or longitud >= tam:
+            return f"SUCCESS: {resumen_completo(fichero)} {tam}"
+        return f"SUCCESS: {_sha256_fichero(fichero, longitud)} {longitud}"
+    except PermissionError:
+        return f"Error: Permisos insuficientes para leer '{os.path.basename(fichero)}'."
+    except OSError as e:
+        return f"Error al calcular el resumen: {e}"
+
+def subir_fichero(conn, fichero, dest_dir=None, offset=0, resumen=None):
+    try:
+        ruta_parcial, f = _abrir_parcial(fichero, dest_dir, offset)
+    except (OSError, ValueError) as e:
+        msg = _error_subida(e, fichero)
+        conn.sendall(_respuesta_texto('UPLOAD_FILE', msg))
+        return msg
+    try:
+        with f:
+            #Enviar primer ACK
+            conn.sendall("UPLOAD_ACK".encode("ascii"))
+            #Recibir tamaño del fichero (lo que falta a partir de offset)
+            tam_str = conn.recv(1024).decode("ascii")
+            try:
+                tam = int(tam_str)
+            except ValueError:
+                err = "Error: tamaño de fichero inválido."
+                conn.sendall(_respuesta_texto('UPLOAD_FILE', err))
+                return err
+
+            #Confirmar tamaño recibido
+            conn.sendall("UPLOAD_ACK".encode("ascii"))
+
+            #Recibir datos hasta completar longitud, resumiéndolos según llegan
+            calculado = _resumen_inicial(f, offset)
+            if _recibir_a_fichero(conn, f, tam, calculado) < tam:
+                err = "Error: conexión cerrada antes de recibir el fichero completo."
+                conn.sendall(_respuesta_texto('UPLOAD_FILE', err))
+                return err
+
+        response = _completar_subida(ruta_parcial, fichero, dest_dir, resumen, calculado.hexdigest())
+        if protocolo.es_error(response):
+            conn.sendall(_respuesta_texto('UPLOAD_FILE', response))
+            return response
+
+        #Confirmar recepción de datos y mensaje final de éxito en un único envío, para que el
+        #cliente no lea solo la mitad y deje la otra mitad para el siguiente comando de la conexión
+        response += "\n"
+        conn.sendall(("DATA_RECEIVED\n" + response).encode("utf-8"))
         return response
 
     except PermissionError:
         msg = f"Error: permisos insuficientes para escribir '{fichero}'."
-        conn.sendall(msg.encode("ascii"))
+        conn.sendall(_respuesta_texto('UPLOAD_FILE', msg))
         return msg
     except Exception as e:
         msg = f"Error al subir fichero: {e}"
-        conn.sendall(msg.encode("ascii"))
+        conn.sendall(_respuesta_texto('UPLOAD_FILE', msg))
         return msg
 
+def subir_fichero_trama(conn, fichero, dest_dir=None, etiqueta=0, offset=0, resumen=None):
+    """UPLOAD_FILE con el protocolo binario: tras la petición llega una trama OP_DATOS con el
+    contenido (desde offset si se reanuda), o varias si viene comprimido, y se contesta con una
+    única trama de respuesta."""
+    op = protocolo.OPERACIONES["UPLOAD_FILE"]
+    cab = protocolo.recibir_cabecera(conn)
+    if cab is None:
+        raise ConnectionError("conexión cerrada antes de recibir el fichero")
+    if cab.operacion != protocolo.OP_DATOS:
+        raise protocolo.ErrorProtocolo("Error: se esperaba el contenido del fichero.")
+    comprimido = cab.flags & protocolo.MASCARA_COMPRESION
 
-def mover_fichero(fichero, destino):
     try:
-        #Abrir fichero y leer todo el contenido
-        with open(fichero, "rb") as f:
-            contenido = f.read()
+        ruta_parcial, f = _abrir_parcial(fichero, dest_dir, offset)
+    except (OSError, ValueError) as e:
+        # No se puede guardar: descartamos el contenido para dejar la conexión lista
+        if comprimido:
+            protocolo.descartar_comprimido(conn, cab)
+        else:
+            protocolo.descartar(conn, cab.longitud)
+        msg = _error_subida(e, fichero)
+        conn.sendall(_respuesta(op, msg, etiqueta))
+        return msg
+
+    try:
+        with f:
+            calculado = _resumen_inicial(f, offset)
+            if comprimido:
+                _recibir_comprimido(conn, f, cab, calculado)
+            else:
+                recibido = _recibir_a_fichero(conn, f, cab.longitud, calculado)
+                if recibido < cab.longitud:
+                    raise ConnectionError("conexión cerrada antes de recibir el fichero completo")
+        msg = _completar_subida(ruta_parcial, fichero, dest_dir, resumen, calculado.hexdigest())
+    except ConnectionError:
+        raise
+    except OSError as e:
+        msg = f"Error al subir fichero: {e}"
+    conn.sendall(_respuesta(op, msg, etiqueta))
+    return msg
+
+def _recibir_comprimido(conn, f, cab, resumen=None):
+    """Como _recibir_a_fichero, para un contenido comprimido (ver protocolo.recibir_comprimido).
+    Si falla la escritura descarta el resto de tramas antes de relanzar el error."""
+    try:
+        metricas.recibidos(protocolo.recibir_comprimido(conn, f, cab, resumen=resumen))
+        if ajustes.durabilidad != 'ninguna':
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError:
+        protocolo.descartar_comprimido(conn, protocolo.recibir_cabecera(conn))
+        raise
+
+
+class ResumenesSubida:
+    """SHA-256 de las subidas en paralelo calculado según llegan los trozos, para que
+    UPLOAD_COMMIT no tenga que volver a leer el fichero. SHA-256 solo admite los datos en
+    orden: el trozo que empieza donde acaba lo ya resumido se resume mientras se recibe, y los
+    que terminan antes se leen del fichero (aún en la caché de páginas) en cuanto se cierra el
+    hueco que los precede. Si dos trozos se solapan o uno falla a medias, esa subida deja de
+    resumirse y UPLOAD_COMMIT lee el fichero. Con --workers los trozos pueden llegar a otros
+    procesos, que también escriben en el fichero, y no se usa (activo = False).
+    Las subidas que nadie completa ni cancela se olvidan tras ttl segundos sin recibir trozos
+    y, si hay más de max_subidas, se olvidan las que llevan más tiempo sin recibirlos: su
+    UPLOAD_COMMIT, si llega, lee el fichero."""
+
+    def __init__(self, ttl=3600, max_subidas=1000):
+        self.activo = True
+        self.ttl = ttl
+        self.max_subidas = max_subidas
+        self.cerrojo = threading.Lock()
+        self.subidas = OrderedDict()    # ruta -> estado de la subida (ver empezar_subida)
+
+    def empezar_subida(self, ruta):
+        if not self.activo:
+            return
+        st = os.stat(ruta)
+        ahora = time.monotonic()
+        with self.cerrojo:
+            self._purgar(ahora)
+            self.subidas[ruta] = {
+                "inodo": (st.st_dev, st.st_ino),
+                "sha": hashlib.sha256(),
+                "hecho": 0,             # Bytes ya resumidos, desde el principio
+                "cabeza": False,        # Alguien está resumiendo a partir de 'hecho'
+                "terminados": {},       # offset -> fin de los trozos recibidos sin resumir
+                "en_curso": {},         # offset -> fin de los trozos que se están recibiendo
+                "caduca": ahora + self.ttl,
+            }
+
+    def _purgar(self, ahora):
+        """Olvida las subidas caducadas y, si no cabe una más, las más antiguas (con el cerrojo).
+        Al recibir trozos pasan al final: las caducadas y las más antiguas están al principio.
+        Una subida con trozos a medias no caduca, pero sí puede salir por el límite."""
+        while self.subidas:
+            ruta, estado = next(iter(self.subidas.items()))
+            if len(self.subidas) < self.max_subidas and (estado["caduca"] > ahora or estado["en_curso"]):
+                break
+            del self.subidas[ruta]
+
+    def empezar_trozo(self, ruta, offset, longitud):
+        """Registra un trozo que se va a recibir. Devuelve el objeto de hashlib en el que hay que
+        resumirlo mientras llega, o None si no le toca (o la subida no se está resumiendo)."""
+        with self.cerrojo:
+            estado = self.subidas.get(ruta)
+            if estado is None:
+                return None
+            self.subidas.move_to_end(ruta)
+            estado["caduca"] = time.monotonic() + self.ttl
+            fin = offset + longitud
+            rangos = [(0, estado["hecho"])] + list(estado["terminados"].items()) + list(estado["en_curso"].items())
+            if offset in estado["en_curso"] or any(offset < b and a < fin for a, b in rangos):
+                del self.subidas[ruta]     # Solapa con algo ya escrito
+                return None
+            estado["en_curso"][offset] = fin
+            if offset == estado["hecho"] and not estado["cabeza"]:
+                estado["cabeza"] = True
+                return estado["sha"]
+            return None
+
+    def terminar_trozo(self, ruta, offset, completo, resumido):
+        """Registra el final de un trozo (completo=False si ha fallado; resumido si se ha
+        resumido al recibirlo) y resume los siguientes que ya estén en el fichero."""
+        with self.cerrojo:
+            estado = self.subidas.get(ruta)
+            if estado is None:
+                return
+            fin = estado["en_curso"].pop(offset)
+            if not completo:
+                del self.subidas[ruta]
+                return
+            if resumido:
+                estado["hecho"] = fin
+                estado["cabeza"] = False
+            else:
+                estado["terminados"][offset] = fin
+            if estado["cabeza"] or estado["hecho"] not in estado["terminados"]:
+                return
+            estado["cabeza"] = True
+        try:
+            with open(ruta, "rb") as f:
+                while True:
+                    with self.cerrojo:
+                        inicio = estado["hecho"]
+                        fin = estado["terminados"].get(inicio)
+                        if fin is None or self.subidas.get(ruta) is not estado:
+                            estado["cabeza"] = False
+                            return
+                    self._resumir(f, estado["sha"], inicio, fin)
+                    with self.cerrojo:
+                        del estado["terminados"][inicio]
+                        estado["hecho"] = fin
+        except OSError:
+            with self.cerrojo:
+                self.subidas.pop(ruta, None)
+
+    def resumen(self, ruta):
+        """UPLOAD_COMMIT: SHA-256 (hex) de la subida completa, leyendo del fichero solo lo que
+        aún no se ha resumido, o None si hay que resumirla entera. La olvida."""
+        with self.cerrojo:
+            estado = self.subidas.pop(ruta, None)
+        if estado is None or estado["en_curso"] or estado["cabeza"]:
+            return None
+        st = os.stat(ruta)
+        if (st.st_dev, st.st_ino) != estado["inodo"]:
+            return None     # Lo han sustituido por otro fichero
+        with open(ruta, "rb") as f:
+            self._resumir(f, estado["sha"], estado["hecho"], st.st_size)
+        return estado["sha"].hexdigest()
+
+    def olvidar(self, ruta):
+        with self.cerrojo:
+            self.subidas.pop(ruta, None)
+
+    @staticmethod
+    def _resumir(f, sha, inicio, fin):
+        while inicio < fin:
+            datos = os.pread(f.fileno(), min(fin - inicio, 1 << 20), inicio)
+            if not datos:
+                raise OSError(f"el fichero termina antes del byte {fin}")
+            sha.update(datos)
+            inicio += len(datos)
+
+resumenes_subida = ResumenesSubida()
+
+def _ruta_subida_paralela(id_subida, dest_dir=None):
+    """Fichero oculto donde se ensamblan los trozos de una subida en paralelo."""
+    return os.path.join(dest_dir or "", f".subida-{id_subida}.part")
+
+def _comprobar_id_subida(id_subida):
+    # El identificador forma parte de una ruta: solo aceptamos los que genera el servidor
+    if not re.fullmatch(r"[0-9a-f]{32}", id_subida):
+        raise ValueError(f"Error: identificador de subida '{id_subida}' inválido.")
+
+def iniciar_subida_paralela(tam, dest_dir=None):
+    """UPLOAD_BEGIN: prepara una subida que llegará en trozos por varias conexiones.
+    Crea el fichero de ensamblado ya con su tamaño final y devuelve su identificador."""
+    id_subida = secrets.token_hex(16)
+    try:
+        if dest_dir:
+            os.makedirs(dest_dir, exist_ok=True)
+        with open(_ruta_subida_paralela(id_subida, dest_dir), "wb") as f:
+            f.truncate(tam)
+            if ajustes.reservar and tam > 0 and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, tam)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        raise
+        resumenes_subida.empezar_subida(_ruta_subida_paralela(id_subida, dest_dir))
+    except OSError as e:
+        return f"Error al preparar la subida: {e}"
+    return f"SUCCESS: {id_subida}"
+
+def subir_trozo_trama(conn, id_subida, offset, dest_dir=None, etiqueta=0):
+    """UPLOAD_PART: recibe un trozo de una subida en paralelo y lo escribe en su posición del
+    fichero de ensamblado. Cada conexión manda sus trozos de forma independiente."""
+    op = protocolo.OPERACIONES["UPLOAD_PART"]
+    cab = protocolo.recibir_cabecera(conn)
+    if cab is None:
+        raise ConnectionError("conexión cerrada antes de recibir el trozo")
+    if cab.operacion != protocolo.OP_DATOS:
+        raise protocolo.ErrorProtocolo("Error: se esperaba el contenido del trozo.")
+
+    try:
+        _comprobar_id_subida(id_subida)
+        f = _abrir_en_su_sitio(_ruta_subida_paralela(id_subida, dest_dir))
+        tam_total = os.fstat(f.fileno()).st_size
+        if offset + cab.longitud > tam_total:
+            f.close()
+            raise ValueError(f"Error: el trozo se sale del fichero ({tam_total} bytes).")
+    except (OSError, ValueError) as e:
+        protocolo.descartar(conn, cab.longitud)
+        if isinstance(e, FileNotFoundError):
+            msg = f"Error: no existe la subida '{id_subida}'."
+        else:
+            msg = _error_subida(e, id_subida)
+        conn.sendall(_respuesta(op, msg, etiqueta))
+        return msg
+
+    ruta = f.name
+    resumen = resumenes_subida.empezar_trozo(ruta, offset, cab.longitud)
+    completo = False
+    try:
+        with f:
+            f.seek(offset)
+            recibido = _recibir_a_fichero(conn, f, cab.longitud, resumen)
+        if recibido < cab.longitud:
+            raise ConnectionError("conexión cerrada antes de recibir el trozo completo")
+        completo = True
+        msg = f"SUCCESS: {recibido} bytes escritos en el offset {offset}."
+    except ConnectionError:
+        raise
+    except OSError as e:
+        msg = f"Error al subir el trozo: {e}"
+    finally:
+        # Antes de responder: el UPLOAD_COMMIT que llegue después ya encuentra el trozo resumido
+        resumenes_subida.terminar_trozo(ruta, offset, completo, resumen is not None)
+    conn.sendall(_respuesta(op, msg, etiqueta))
+    return msg
+
+def completar_subida_paralela(id_subida, fichero, dest_dir=None, resumen=None):
+    """UPLOAD_COMMIT: publica con su nombre definitivo (un único rename atómico) una subida en
+    paralelo cuyos trozos ya han llegado todos."""
+    try:
+        _comprobar_id_subida(id_subida)
+        ruta = _ruta_subida_paralela(id_subida, dest_dir)
+        # Lo normal es que los trozos ya estén resumidos y no haga falta leer el fichero
+        return _completar_subida(ruta, fichero, dest_dir, resumen, resumenes_subida.resumen(ruta))
+    except ValueError as e:
+        return str(e)
+    except FileNotFoundError:
+        return f"Error: no existe la subida '{id_subida}'."
+    except OSError as e:
+        return f"Error al completar la subida: {e}"
+
+def cancelar_subida_paralela(id_subida, dest_dir=None):
+    """UPLOAD_ABORT: descarta una subida en paralelo que no se va a completar."""
+    try:
+        _comprobar_id_subida(id_subida)
+        resumenes_subida.olvidar(_ruta_subida_paralela(id_subida, dest_dir))
+        os.remove(_ruta_subida_paralela(id_subida, dest_dir))
+        return f"SUCCESS: Subida '{id_subida}' cancelada."
+    except ValueError as e:
+        return str(e)
+    except FileNotFoundError:
+        return f"Error: no existe la subida '{id_subida}'."
+    except OSError as e:
+        return f"Error al cancelar la subida: {e}"
+
+def estado_fichero(fichero):
+    """STAT: tamaño en bytes y fecha de modificación (ns) de un fichero, y su SHA-256 si ya se
+    conoce (ver cache_resumenes). STAT nunca lee el contenido: para forzarlo está HASH."""
+    try:
+        st = os.stat(fichero)
+    except FileNotFoundError:
+        return f"Error: El fichero '{os.path.basename(fichero)}' no existe."
+    except OSError as e:
+        return f"Error al consultar el fichero: {e}"
+    if not stat.S_ISREG(st.st_mode):
+        return f"Error: '{os.path.basename(fichero)}' no es un fichero."
+    resumen = resumen_conocido(fichero, st)
+    return f"SUCCESS: {st.st_size} {st.st_mtime_ns}" + (f" {resumen}" if resumen else "")
+
+
+def _ruta_base(fichero, dest_dir=None):
+    """Fichero del servidor que actualiza una subida por diferencias: el mismo nombre que
+    tendría con UPLOAD_FILE, pero sin '-copiaX'."""
+    return os.path.join(dest_dir or "", os.path.basename(fichero))
+
+def firmas_fichero_trama(conn, fichero, dest_dir=None, etiqueta=0):
+    """FIRMAS: responde con las firmas de los bloques de la copia del servidor (ver delta.py),
+    para que el cliente calcule qué ha cambiado."""
+    op = protocolo.OPERACIONES["FIRMAS"]
+    nombre = os.path.basename(fichero)
+    try:
+        with open(_ruta_base(fichero, dest_dir), "rb") as f:
+            st = os.fstat(f.fileno())
+            carga = delta.firmas(f, st.st_size, st.st_mtime_ns)
+    except FileNotFoundError:
+        conn.sendall(_respuesta(op, f"Error: El fichero '{nombre}' no existe.", etiqueta))
+        return
+    except OSError as e:
+        conn.sendall(_respuesta(op, f"Error al leer el fichero '{nombre}': {e}", etiqueta))
+        return
+    conn.sendall(protocolo.trama(op, carga, etiqueta=etiqueta))
+    metricas.enviados(len(carga))
+
+def subir_delta_trama(conn, fichero, mtime_base, resumen, dest_dir=None, etiqueta=0):
+    """UPLOAD_DELTA: reconstruye una nueva versión del fichero a partir de la copia del servidor
+    y de las instrucciones del cliente (tramas OP_DATOS terminadas con una vacía). El resultado
+    se escribe aparte y solo sustituye a la copia, con un rename atómico, si su SHA-256 coincide.
+    mtime_base es la fecha de la copia de la que se sacaron las firmas."""
+    op = protocolo.OPERACIONES["UPLOAD_DELTA"]
+    ruta = _ruta_base(fichero, dest_dir)
+    nombre = os.path.basename(fichero)
+    temporal = os.path.join(os.path.dirname(ruta), f".{nombre}.{secrets.token_hex(4)}.delta")
+    base = destino = None
+    msg = None
+    try:
+        try:
+            base = open(ruta, "rb")
+            st = os.fstat(base.fileno())
+            if st.st_mtime_ns != mtime_base:
+                msg = f"Error: el fichero '{nombre}' ha cambiado en el servidor; hay que volver a pedir las firmas."
+            else:
+                destino = open(temporal, "xb")
+        except FileNotFoundError:
+            msg = f"Error: El fichero '{nombre}' no existe."
+        except OSError as e:
+            msg = f"Error al preparar la subida por diferencias: {e}"
+
+        # Las instrucciones llegan igualmente: hay que leerlas todas aunque haya un error
+        recibido = 0
+        while True:
+            recibida = protocolo.recibir_trama(conn, delta.MAX_TRAMA)
+            if recibida is None:
+                raise ConnectionError("conexión cerrada antes de recibir todas las diferencias")
+            cab, carga = recibida
+            if cab.operacion != protocolo.OP_DATOS:
+                raise protocolo.ErrorProtocolo("Error: se esperaban las diferencias del fichero.")
+            if not carga:
+                break
+            recibido += len(carga)
+            metricas.recibidos(len(carga))
+            if msg is None:
+                try:
+                    delta.aplicar(carga, base, destino, delta.tam_bloque(st.st_size), st.st_size)
+                except ValueError as e:
+                    msg = str(e)
+                except OSError as e:
+                    msg = f"Error al reconstruir el fichero: {e}"
+
+        if msg is None:
+            destino.flush()
+            if ajustes.durabilidad != 'ninguna':
+                os.fsync(destino.fileno())
+            destino.close()
+            if _sha256_fichero(temporal) != resumen.lower():
+                msg = "Error: el fichero reconstruido no coincide con su resumen SHA-256; súbelo completo."
+            else:
+                os.chmod(temporal, stat.S_IMODE(st.st_mode))
+                os.replace(temporal, ruta)
+                listados.invalidar(ruta)
+                indice.guardar(ruta, deduplicar(ruta, resumen))
+                msg = f"SUCCESS: Fichero '{nombre}' actualizado ({recibido} bytes de diferencias)."
+    finally:
+        if base:
+            base.close()
+        if destino:
+            destino.close()
+            if os.path.exists(temporal):
+                os.remove(temporal)
+    conn.sendall(_respuesta(op, msg, etiqueta))
+    return msg
+
+
+def subir_directorio_trama(conn, destino, dest_dir=None, etiqueta=0):
+    """UPLOAD_DIR: extrae en destino el tar que manda el cliente en tramas OP_DATOS (ver
+    directorios.py) según va llegando. Cada nombre del archivo se comprueba como cualquier
+    otra ruta del usuario y no puede salir de destino."""
+    op = protocolo.OPERACIONES["UPLOAD_DIR"]
+    entrada = protocolo.LectorTramas(conn)
+    ok, raiz, msg = _resolver_ruta_usuario(dest_dir, destino)
+
+    def resolver(nombre):
+        error = nombre_reservado(nombre)
+        return (False, "", error) if error else _resolver_ruta_usuario(raiz, nombre)
+
+    resumenes = {}
+
+    def al_guardar(ruta, resumen):
+        listados.invalidar(ruta)
+        resumenes[ruta] = deduplicar(ruta, resumen)
 
-        #Crear un fichero en el directorio destino indicado y escribir el contenido obtenido
+    try:
+        if ok:
+            try:
+                ficheros, dirs, omitidos = directorios.extraer(entrada, raiz, resolver, al_guardar, ajustes.durabilidad != 'ninguna')
+                msg = f"SUCCESS: {ficheros} ficheros y {dirs} directorios guardados en '{destino}'."
+                if omitidos:
+                    msg += f" Omitidas {omitidos} entradas que no son ficheros ni directorios."
+            except ValueError as e:
+                msg = str(e)
+            except OSError as e:
+                msg = f"Error al guardar el directorio: {e}"
+            listados.invalidar(raiz)
+            indice.actualizar(raiz, resumenes=resumenes)
+    finally:
+        # El tar termina antes que las tramas (relleno y trama vacía) o se ha cortado por un error
+        entrada.descartar()
+        metricas.recibidos(entrada.leidos)
+    conn.sendall(_respuesta(op, msg, etiqueta))
+    return msg
+
+
+def descargar_directorio_trama(conn, directorio, dest_dir=None, etiqueta=0, compresion=0):
+    """DOWNLOAD_DIR: responde y a continuación manda el directorio como un tar que se genera
+    mientras se envía, en tramas OP_DATOS (comprimidas con compresion) terminadas con una vacía."""
+    op = protocolo.OPERACIONES["DOWNLOAD_DIR"]
+    ok, ruta, msg = _resolver_ruta_usuario(dest_dir, directorio)
+    if ok and not os.path.isdir(ruta):
+        ok, msg = False, f"Error: El directorio '{directorio}' no existe."
+    if not ok:
+        conn.sendall(_respuesta(op, msg, etiqueta))
+        return msg
+    conn.sendall(_respuesta(op, f"SUCCESS: Enviando el directorio '{directorio}'.", etiqueta))
+    salida = protocolo.EscritorTramas(conn, compresion, etiqueta)
+    ficheros, dirs, total = directorios.empaquetar(ruta, salida)
+    salida.cerrar()
+    metricas.enviados(salida.escritos)
+    return f"SUCCESS: {ficheros} ficheros y {dirs} directorios enviados ({total} bytes)."
+
+
+# Operaciones recursivas (DELETE_DIR recursivo=1, COPY_DIR, DELETE_FILES, TREE). El árbol se
+# recorre con os.scandir y el trabajo de E/S (leer cada directorio, borrar o copiar ficheros)
+# se reparte entre los hilos de un pool; mientras tanto se va mandando el progreso al cliente.
+
+TAM_LOTE = 256          # Ficheros por tarea del pool
+INTERVALO_AVISOS = 0.5  # Segundos entre dos avisos de progreso
+
+_pool_arbol = None
+_cerrojo_pool = threading.Lock()
+
+def _pool():
+    global _pool_arbol
+    with _cerrojo_pool:
+        if _pool_arbol is None:
+            _pool_arbol = ThreadPoolExecutor(ajustes.hilos_arbol, thread_name_prefix="arbol")
+        return _pool_arbol
+
+
+class Emisor:
+    """Texto que una operación larga manda al cliente antes de su respuesta final: líneas de
+    resultado (TREE) y avisos de progreso. En el protocolo binario viajan según se generan en
+    tramas OP_DATOS con la etiqueta de la petición; en el de texto no hay tramas, así que las
+    líneas se juntan (hasta BYTES_PAGINA_TEXTO) con la respuesta y el progreso no se manda."""
+
+    def __init__(self, conn, sesion, orden, etiqueta=0):
+        self.conn = conn
+        self.sesion = sesion
+        self.orden = orden
+        self.etiqueta = etiqueta
+        self.salida = []
+        self.ocupado = 0
+        self.recortado = False
+        self.ultimo = time.monotonic()
+
+    def linea(self, texto):
+        self.ocupado += len(texto.encode("utf-8", errors="replace")) + 1
+        if self.sesion.binario:
+            self.salida.append(texto)
+            if self.ocupado >= 1 << 16:
+                self._enviar()
+        elif self.ocupado <= BYTES_PAGINA_TEXTO:
+            self.salida.append(texto)
+        else:
+            self.recortado = True
+
+    def progreso(self, texto):
+        ahora = time.monotonic()
+        if self.sesion.binario and ahora - self.ultimo >= INTERVALO_AVISOS:
+            self.ultimo = ahora
+            self.salida.append(f"PROGRESS: {texto}")
+            self._enviar()
+
+    def _enviar(self):
+        if self.salida:
+            carga = ("\n".join(self.salida)).encode("utf-8", errors="replace")
+            self.conn.sendall(protocolo.trama(protocolo.OP_DATOS, carga, etiqueta=self.etiqueta))
+            metricas.enviados(len(carga))
+            self.salida, self.ocupado = [], 0
+
+    def terminar(self, texto):
+        if self.sesion.binario:
+            self._enviar()
+        else:
+            if self.recortado:
+                self.salida.append("... (recortado; con el protocolo binario se recibe entero)")
+            texto = "\n".join([texto] + self.salida)
+        _responder(self.conn, self.sesion, self.orden, texto, self.etiqueta)
+
+
+def _escanear(directorio):
+    """Lee un directorio: (ficheros, subdirectorios), los ficheros como (nombre, lstat).
+    Todo lo que no es un directorio (enlaces simbólicos incluidos) cuenta como fichero."""
+    ficheros, subdirectorios = [], []
+    with os.scandir(directorio) as entradas:
+        for e in entradas:
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    subdirectorios.append(e.name)
+                else:
+                    ficheros.append((e.name, e.stat(follow_symlinks=False)))
+            except OSError:
+                continue    # Borrado mientras se leía
+    return ficheros, subdirectorios
+
+
+def _recorrer_arbol(raiz):
+    """Recorre en profundidad el árbol de raiz sin seguir enlaces: genera (ruta relativa,
+    ficheros, subdirectorios) de cada directorio, antes que los de su contenido y en orden
+    alfabético. Los subdirectorios se leen por adelantado en el pool mientras se procesa el
+    actual. Un subdirectorio que ya no se puede leer se salta; la raíz lanza la excepción."""
+    pool = _pool()
+    pila = [("", pool.submit(_escanear, raiz))]
+    while pila:
+        relativa, futuro = pila.pop()
+        try:
+            ficheros, subdirectorios = futuro.result()
+        except OSError:
+            if not relativa:
+                raise
+            continue
+        ficheros.sort()
+        subdirectorios.sort()
+        yield relativa, ficheros, subdirectorios
+        for nombre in reversed(subdirectorios):
+            hijo = f"{relativa}/{nombre}" if relativa else nombre
+            pila.append((hijo, pool.submit(_escanear, os.path.join(raiz, hijo))))
+
+
+class Lotes:
+    """Aplica funcion(*argumentos) a muchos elementos repartidos en lotes entre los hilos del
+    pool, sin esperar a que acabe uno para mandar el siguiente. Cuenta los hechos y los
+    errores (OSError) para el progreso y la respuesta final."""
+
+    def __init__(self, funcion, emisor, verbo):
+        self.funcion = funcion
+        self.emisor = emisor
+        self.verbo = verbo
+        self.lote = []
+        self.futuros = set()
+        self.hechos = 0
+        self.errores = 0
+        self.primer_error = None
+        self.cerrojo = threading.Lock()
+
+    def anadir(self, *argumentos):
+        self.lote.append(argumentos)
+        if len(self.lote) >= TAM_LOTE:
+            self._mandar()
+
+    def _mandar(self):
+        if self.lote:
+            self.futuros.add(_pool().submit(self._procesar, self.lote))
+            self.lote = []
+        self.futuros = {f for f in self.futuros if not f.done()}
+        self.emisor.progreso(f"{self.hechos} ficheros {self.verbo}")
+
+    def _procesar(self, lote):
+        hechos = errores = 0
+        primero = None
+        for argumentos in lote:
+            try:
+                self.funcion(*argumentos)
+                hechos += 1
+            except OSError as e:
+                errores += 1
+                primero = primero or e
+        with self.cerrojo:
+            self.hechos += hechos
+            self.errores += errores
+            self.primer_error = self.primer_error or primero
+
+    def esperar(self):
+        self._mandar()
+        while self.futuros:
+            _, self.futuros = wait(self.futuros, INTERVALO_AVISOS)
+            self.emisor.progreso(f"{self.hechos} ficheros {self.verbo}")
+
+    def resumen(self):
+        """' (N errores, el primero: ...)' si ha fallado algo, o ''."""
+        if not self.errores:
+            return ""
+        return f" ({self.errores} errores, el primero: {self.primer_error})"
+
+
+def borrar_arbol(ruta, emisor, patron=None, recursivo=True):
+    """Borra los ficheros de ruta (los que encajan con patron, si lo hay) y, con recursivo,
+    los de sus subdirectorios. Sin patrón borra también los directorios, empezando por los
+    más profundos: es el DELETE_DIR recursivo. Devuelve la respuesta."""
+    lotes = Lotes(os.remove, emisor, "borrados")
+    subdirs = []
+    try:
+        recorrido = _recorrer_arbol(ruta) if recursivo else [("", *_escanear(ruta))]
+        for relativa, ficheros, _ in recorrido:
+            directorio = os.path.join(ruta, relativa) if relativa else ruta
+            subdirs.append(directorio)
+            for nombre, _ in ficheros:
+                if patron is None or fnmatch.fnmatchcase(nombre, patron):
+                    lotes.anadir(os.path.join(directorio, nombre))
+    except FileNotFoundError:
+        return f"Error: El directorio '{ruta}' no existe."
+    except NotADirectoryError:
+        return f"Error: '{ruta}' no es un directorio."
+    except PermissionError:
+        return f"Error: No tienes permisos para acceder a '{ruta}'."
+    finally:
+        lotes.esperar()
+        listados.invalidar(*subdirs)
+        indice.actualizar(ruta)
+    if patron is not None:
+        return f"SUCCESS: {lotes.hechos} ficheros borrados{lotes.resumen()}."
+    borrados = 0
+    for directorio in reversed(subdirs):
+        try:
+            os.rmdir(directorio)
+            borrados += 1
+        except OSError as e:
+            lotes.errores += 1
+            lotes.primer_error = lotes.primer_error or e
+    if lotes.errores:
+        return f"Error: El directorio '{ruta}' no se ha borrado entero{lotes.resumen()}."
+    return f"SUCCESS: Directorio '{ruta}' eliminado ({lotes.hechos} ficheros y {borrados} directorios)."
+
+
+def _copiar_fichero(origen, destino, enlazar):
+    """Copia un fichero para COPY_DIR. Dentro de los directorios de usuario los ficheros no se
+    modifican nunca en su sitio (ver deduplicar), así que basta otro enlace duro al mismo
+    contenido; si no se puede, se copia sin pasar los datos por Python."""
+    if enlazar:
+        try:
+            os.link(origen, destino, follow_symlinks=False)
+            return
+        except OSError:
+            pass
+    with open(origen, "rb") as fo, open(destino, "xb") as fd:
+        tam = os.fstat(fo.fileno()).st_size
+        if _copiar_contenido(fo.fileno(), fd.fileno(), tam) != tam:
+            raise OSError(errno.EIO, f"'{origen}' ha cambiado durante la copia")
+    shutil.copystat(origen, destino)
+
+
+def copiar_arbol(origen, destino, emisor):
+    """COPY_DIR: copia el árbol de origen en destino, que no debe existir. Solo copia ficheros
+    regulares y directorios, y no los temporales de las subidas en curso (IndiceFicheros.TEMPORAL),
+    que se siguen escribiendo en su sitio. Devuelve la respuesta."""
+    if not os.path.isdir(origen):
+        return f"Error: El directorio '{origen}' no existe."
+    if os.path.lexists(destino):
+        return f"Error: La ruta '{destino}' ya existe."
+    base = os.path.abspath(origen)
+    if os.path.abspath(destino).startswith(base + os.sep):
+        return "Error: No se puede copiar un directorio dentro de sí mismo."
+    dir_usuarios = os.path.abspath(DIR_USUARIOS) + os.sep
+    enlazar = base.startswith(dir_usuarios) and os.path.abspath(destino).startswith(dir_usuarios)
+    lotes = Lotes(_copiar_fichero, emisor, "copiados")
+    dirs = omitidos = temporales = 0
+    try:
+        for relativa, ficheros, _ in _recorrer_arbol(origen):
+            dir_origen = os.path.join(origen, relativa) if relativa else origen
+            dir_destino = os.path.join(destino, relativa) if relativa else destino
+            os.mkdir(dir_destino)
+            dirs += 1
+            for nombre, st in ficheros:
+                if not stat.S_ISREG(st.st_mode):
+                    omitidos += 1
+                elif IndiceFicheros.TEMPORAL.match(nombre):
+                    temporales += 1
+                else:
+                    lotes.anadir(os.path.join(dir_origen, nombre), os.path.join(dir_destino, nombre), enlazar)
+    except PermissionError:
+        return f"Error: Permisos insuficientes para copiar '{origen}'."
+    except OSError as e:
+        return f"Error al copiar el directorio: {e}"
+    finally:
+        lotes.esperar()
+        listados.invalidar(destino)
+        indice.actualizar(destino)
+    texto = f"SUCCESS: Directorio '{origen}' copiado en '{destino}' ({lotes.hechos} ficheros y {dirs} directorios){lotes.resumen()}."
+    if omitidos:
+        texto += f" Omitidas {omitidos} entradas que no son ficheros regulares."
+    if temporales:
+        texto += f" Omitidos {temporales} ficheros temporales de subidas en curso."
+    return texto
+
+
+def arbol(ruta, emisor):
+    """TREE: una línea 'ruta_relativa<TAB>tamaño' por fichero y 'ruta_relativa/<TAB>total' por
+    directorio, con el total de su contenido (por eso cada directorio sale después de lo que
+    contiene). Devuelve la respuesta final con los totales."""
+    pila = []   # (ruta relativa, bytes) de los directorios abiertos, del más externo al actual
+    ficheros_total = directorios_total = 0
+
+    def cerrar_directorio():
+        relativa, total = pila.pop()
+        emisor.linea(f"{relativa or '.'}/\t{total}")
+        if pila:
+            pila[-1][1] += total
+
+    try:
+        for relativa, ficheros, _ in _recorrer_arbol(ruta):
+            # Se cierran los directorios anteriores que no contienen a este
+            while pila and pila[-1][0] and not relativa.startswith(pila[-1][0] + "/"):
+                cerrar_directorio()
+            total = 0
+            for nombre, st in ficheros:
+                emisor.linea(f"{relativa}/{nombre}\t{st.st_size}" if relativa else f"{nombre}\t{st.st_size}")
+                total += st.st_size
+            pila.append([relativa, total])
+            ficheros_total += len(ficheros)
+            directorios_total += 1
+            emisor.progreso(f"{ficheros_total} ficheros en {directorios_total} directorios")
+    except FileNotFoundError:
+        return f"Error: El directorio '{ruta}' no existe."
+    except NotADirectoryError:
+        return f"Error: '{ruta}' no es un directorio."
+    except PermissionError:
+        return f"Error: No tienes permisos para acceder a '{ruta}'."
+    total = 0
+    while pila:
+        total = pila[-1][1]
+        cerrar_directorio()
+    return f"SUCCESS: {ficheros_total} ficheros, {directorios_total} directorios, {total} bytes."
+
+
+def _copiar_contenido(origen, destino, tam):
+    """Copia tam bytes entre dos descriptores sin que los datos pasen por Python: con
+    copy_file_range (o sendfile si el núcleo no lo admite entre estos sistemas de ficheros) y,
+    como último recurso, por bloques de 1 MiB. La memoria usada no depende del tamaño."""
+    copiado = 0
+    for metodo in ("copy_file_range", "sendfile"):
+        if not hasattr(os, metodo):
+            continue
+        try:
+            os.lseek(destino, copiado, os.SEEK_SET)
+            while copiado < tam:
+                if metodo == "copy_file_range":
+                    n = os.copy_file_range(origen, destino, tam - copiado, copiado, copiado)
+                else:
+                    n = os.sendfile(destino, origen, copiado, tam - copiado)
+                if not n:
+                    return copiado
+                copiado += n
+            return copiado
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while copiado < tam:
+        datos = os.pread(origen, min(tam - copiado, 1 << 20), copiado)
+        if not datos:
+            break
+        copiado += os.pwrite(destino, datos, copiado)
+    return copiado
+
+def _mover(origen, destino):
+    """Mueve un fichero. En el mismo sistema de ficheros es un único rename (solo cambian los
+    metadatos). Entre dispositivos lo copia a un temporal junto al destino, lo coloca con un
+    rename atómico y después borra el original: el destino nunca queda a medias."""
+    try:
+        os.replace(origen, destino)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temporal = os.path.join(os.path.dirname(destino), f".{os.path.basename(destino)}.{secrets.token_hex(4)}.mover")
+    try:
+        with open(origen, "rb") as fo, open(temporal, "xb") as fd:
+            tam = os.fstat(fo.fileno()).st_size
+            if _copiar_contenido(fo.fileno(), fd.fileno(), tam) != tam:
+                raise OSError(errno.EIO, "el fichero ha cambiado durante la copia")
+            if ajustes.durabilidad != 'ninguna':
+                os.fsync(fd.fileno())
+        shutil.copystat(origen, temporal)
+        os.replace(temporal, destino)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    os.remove(origen)
+
+def mover_fichero(fichero, destino):
+    """Mueve un fichero al directorio destino sin leerlo cuando está en el mismo sistema de
+    ficheros (ver _mover)."""
+    try:
+        if os.path.isdir(fichero):
+            return f"Error al mover fichero: '{fichero}' es un directorio."
+        if not os.path.exists(fichero):
+            raise FileNotFoundError(fichero)
+        #Crear el directorio destino si no existe
         os.makedirs(destino, exist_ok=True)
         nombre = os.path.basename(fichero)
         ruta_destino = os.path.join(destino, nombre)
-        with open(ruta_destino, "wb") as f:
-            f.write(contenido)
-
-        #Borrar fichero de la ruta actual
-        os.remove(fichero)
+        _mover(fichero, ruta_destino)
+        listados.invalidar(fichero, ruta_destino)
+        indice.actualizar(fichero, ruta_destino)
         #Enviar mensaje SUCCESS
         response = f"SUCCESS: Fichero '{nombre}' movido a '{destino}'."
         return response
@@ -185,6 +1744,8 @@ def crear_directorio(nombre_direccion):
     try:
         # Crear el directorio
         os.mkdir(nombre_direccion)
+        listados.invalidar(nombre_direccion)
+        indice.actualizar(nombre_direccion)
         # Enviar mensaje SUCCESS
         response = f"SUCCESS: Directorio '{nombre_direccion}' creado correctamente."
     except PermissionError:
@@ -197,7 +1758,7 @@ def crear_directorio(nombre_direccion):
 def borrar_directorio(nombre_direccion):
     # Comprobar si existe
     if not os.path.exists(nombre_direccion):
-        response = "Error: El directorio '{nombre_direccion}' no existe."
+        response = f"Error: El directorio '{nombre_direccion}' no existe."
         return response
 
     # Comprobar si es realmente un directorio
@@ -213,6 +1774,8 @@ def borrar_directorio(nombre_direccion):
     try:
         # Eliminar el directorio
         os.rmdir(nombre_direccion)
+        listados.invalidar(nombre_direccion)
+        indice.actualizar(nombre_direccion)
         # Enviar mensaje SUCCESS
         response = f"SUCCESS: Directorio '{nombre_direccion}' eliminado correctamente."
     except PermissionError:
@@ -223,26 +1786,231 @@ def borrar_directorio(nombre_direccion):
     return response
 
 def listar_directorio(nombre_direccion):
-    #Comprobar si existe
-    if not os.path.exists(nombre_direccion):
-        response = f"Error: La ruta '{nombre_direccion}' no existe."
-        return response
-    if not os.path.isdir(nombre_direccion):
-        response = f"Error: '{nombre_direccion}' no es un directorio."
-        return response
-    #Leer todo el contenido de la misma
+    #Leer los subdirectorios (de la caché si el directorio no ha cambiado)
     try:
-        contenido = os.listdir(nombre_direccion)
-        directorios = [d for d in contenido if os.path.isdir(os.path.join(nombre_direccion, d))]
+        _, directorios = listados.contenido(nombre_direccion)
         if directorios:
             response = "Directorios en " + nombre_direccion + ":\n" + "\n".join(directorios)
         else:
             response = f"No hay subdirectorios en '{nombre_direccion}'."
+    except FileNotFoundError:
+        response = f"Error: La ruta '{nombre_direccion}' no existe."
+    except NotADirectoryError:
+        response = f"Error: '{nombre_direccion}' no es un directorio."
     except PermissionError:
         response = f"Error: No tienes permisos para acceder a '{nombre_direccion}'."
     #Enviar contenido
     return response
 
+OPCIONES_LISTADO = ('limite', 'cursor', 'orden', 'filtro', 'detalles')
+ORDENES_LISTADO = ('nombre', '-nombre', 'tam', '-tam', 'mtime', '-mtime')
+LIMITE_PAGINA = 1000        # Entradas por página si no se indica limite=
+MAX_LIMITE_PAGINA = 10_000
+BYTES_PAGINA_TEXTO = 60 << 10   # El cliente de texto recibe la respuesta con un solo recv
+
+
+def opciones_listado(argumentos):
+    """Separa la ruta de las opciones clave=valor de LIST_FILES / LIST_DIR.
+    Devuelve (ruta, opciones). Lanza ValueError si sobra algún argumento."""
+    ruta, opciones = None, {}
+    for arg in argumentos:
+        clave, igual, valor = arg.partition("=")
+        if igual and clave.lower() in OPCIONES_LISTADO:
+            opciones[clave.lower()] = valor
+        elif ruta is None:
+            ruta = arg
+        else:
+            raise ValueError(f"Error: argumento de listado no reconocido: '{arg}'.")
+    return ruta if ruta is not None else ".", opciones
+
+
+def _firma_listado(clave, directorios, orden, filtro):
+    # Liga el cursor al listado que lo generó: no vale para otra ruta, orden o filtro
+    return hashlib.blake2b(repr((clave, directorios, orden, filtro)).encode(), digest_size=4).hexdigest()
+
+
+def _leer_cursor(cursor, mtime, firma):
+    """Posición en la que sigue el listado. Lanza ValueError si el cursor no vale."""
+    try:
+        mtime_cursor, posicion, firma_cursor = cursor.split(".")
+        mtime_cursor, posicion = int(mtime_cursor, 16), int(posicion, 16)
+    except ValueError:
+        raise ValueError("Error: cursor de listado no válido.")
+    if firma_cursor != firma:
+        raise ValueError("Error: el cursor es de otro listado (ruta, orden o filtro distintos).")
+    if mtime_cursor != mtime:
+        raise ValueError("Error: el directorio ha cambiado desde la página anterior; vuelve a pedir el listado desde el principio.")
+    return posicion
+
+
+def _candidatos_disco(clave, mtime, directorios, filtro, inicio):
+    """Entradas (posición, nombre) desde inicio en el orden en que las devuelve el sistema de
+    ficheros. Si el directorio no está en la caché y es la primera página, se lee con
+    os.scandir a medida que se piden: la primera página de un directorio enorme no espera a
+    recorrerlo entero."""
+    cacheado = listados.consultar(clave, mtime)
+    if cacheado is None and inicio == 0:
+        posicion = 0
+        with os.scandir(clave) as entradas:
+            for e in entradas:
+                try:
+                    if not (e.is_dir() if directorios else e.is_file()):
+                        continue
+                except OSError:
+                    continue
+                if not filtro or fnmatch.fnmatchcase(e.name, filtro):
+                    yield posicion, e.name
+                posicion += 1
+        return
+    if cacheado is None:
+        cacheado = listados.contenido(clave)
+    todos = cacheado[1] if directorios else cacheado[0]
+    for posicion in range(inicio, len(todos)):
+        if not filtro or fnmatch.fnmatchcase(todos[posicion], filtro):
+            yield posicion, todos[posicion]
+
+
+def listar_pagina(ruta, directorios, opciones, max_bytes=protocolo.MAX_TROZO):
+    """LIST_FILES / LIST_DIR con opciones: devuelve una página del listado.
+    limite=N entradas como mucho (y max_bytes de respuesta); cursor= el de la página anterior;
+    orden=nombre|tam|mtime (con '-' delante, descendente; sin orden, el del disco, que es lo
+    más rápido); filtro=patrón al estilo de la shell (*.txt); detalles=1 añade tamaño y mtime.
+    La respuesta es "SUCCESS: <entradas> <cursor siguiente o ->" y una línea por entrada."""
+    try:
+        limite = int(opciones.get('limite', LIMITE_PAGINA))
+    except ValueError:
+        limite = 0
+    if not 1 <= limite <= MAX_LIMITE_PAGINA:
+        return f"Error: limite debe estar entre 1 y {MAX_LIMITE_PAGINA}."
+    orden = opciones.get('orden') or None
+    if orden is not None and orden not in ORDENES_LISTADO:
+        return f"Error: orden debe ser uno de {', '.join(ORDENES_LISTADO)}."
+    filtro = opciones.get('filtro') or None
+    detalles = opciones.get('detalles', '0').lower() in ('1', 'si', 'sí')
+
+    clave = os.path.abspath(ruta)
+    lineas = []
+    siguiente = None
+    try:
+        st = os.stat(clave)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(ruta)
+        firma = _firma_listado(clave, directorios, orden, filtro)
+        inicio = _leer_cursor(opciones['cursor'], st.st_mtime_ns, firma) if opciones.get('cursor') else 0
+        if orden:
+            nombres = listados.ordenado(clave, directorios, orden, filtro)
+            candidatos = ((i, nombres[i]) for i in range(inicio, len(nombres)))
+        else:
+            candidatos = _candidatos_disco(clave, st.st_mtime_ns, directorios, filtro, inicio)
+
+        ocupado = 64    # Margen para la primera línea
+        for posicion, nombre in candidatos:
+            if len(lineas) == limite:
+                siguiente = posicion
+                break
+            if detalles:
+                try:
+                    st_e = os.stat(os.path.join(clave, nombre))
+                except OSError:
+                    continue    # Borrado mientras se listaba
+                linea = f"{nombre}\t{st_e.st_size}\t{st_e.st_mtime_ns}"
+            else:
+                linea = nombre
+            ocupado += len(linea.encode("utf-8", errors="replace")) + 1
+            if lineas and ocupado > max_bytes:
+                siguiente = posicion    # No cabe: la página acaba antes y se sigue desde aquí
+                break
+            lineas.append(linea)
+    except ValueError as e:
+        return str(e)
+    except FileNotFoundError:
+        return f"Error: La ruta '{ruta}' no existe."
+    except NotADirectoryError:
+        return f"Error: '{ruta}' no es un directorio."
+    except PermissionError:
+        return f"Error: No tienes permisos para acceder a '{ruta}'."
+
+    cursor = f"{st.st_mtime_ns:x}.{siguiente:x}.{firma}" if siguiente is not None else "-"
+    return "\n".join([f"SUCCESS: {len(lineas)} {cursor}"] + lineas)
+
+OPCIONES_BUSQUEDA = ('nombre', 'ruta', 'min', 'max', 'desde', 'hasta', 'sha256', 'orden', 'limite')
+ORDENES_BUSQUEDA = {'ruta': 'ruta', 'nombre': 'nombre', 'tam': 'tam', 'mtime': 'mtime_ns'}
+
+
+def _tam_busqueda(texto):
+    """Tamaño de SEARCH en bytes, con K, M o G opcionales: '1500', '64K', '2G'."""
+    factor = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(texto[-1:].upper(), 1)
+    return int(texto[:-1] if factor > 1 else texto) * factor
+
+
+def _fecha_busqueda(texto):
+    """Fecha de SEARCH en ns: segundos desde 1970 o ISO 8601 ('2026-10-18', '2026-10-18T12:30')."""
+    if texto.isdigit():
+        return int(texto) * 10**9
+    return int(datetime.datetime.fromisoformat(texto).timestamp() * 10**9)
+
+
+def buscar_ficheros(argumentos, ruta_usuario, max_bytes):
+    """SEARCH: busca en el índice (ver IndiceFicheros) los ficheros por nombre (patrón con *, ?
+    y [...]), tamaño, fecha o SHA-256, sin recorrer el disco. Devuelve "SUCCESS: <n>" y una
+    línea 'ruta<TAB>tam<TAB>mtime_ns' por fichero, con las rutas relativas al directorio del
+    usuario (o a la del servidor sin sesión)."""
+    opciones = {}
+    for arg in argumentos:
+        clave, igual, valor = arg.partition("=")
+        if igual and clave.lower() in OPCIONES_BUSQUEDA:
+            opciones[clave.lower()] = valor
+        elif 'nombre' not in opciones:
+            opciones['nombre'] = arg
+        else:
+            return f"Error: argumento de búsqueda no reconocido: '{arg}'."
+
+    raiz = ruta_usuario or DIR_USUARIOS
+    ok, base, err = _resolver_ruta_usuario(ruta_usuario, opciones['ruta']) if 'ruta' in opciones else (True, raiz, "")
+    if not ok:
+        return err
+    prefijo = indice.relativa(base)
+    if prefijo is None:
+        return "Error: SEARCH solo busca dentro de los directorios de los usuarios."
+
+    condiciones, valores = [], []
+    try:
+        for clave, condicion, convertir in (('nombre', "nombre GLOB ?", str), ('sha256', "sha256 = ?", str.lower),
+                                             ('min', "tam >= ?", _tam_busqueda), ('max', "tam <= ?", _tam_busqueda),
+                                             ('desde', "mtime_ns >= ?", _fecha_busqueda), ('hasta', "mtime_ns <= ?", _fecha_busqueda)):
+            if clave in opciones:
+                condiciones.append(condicion)
+                valores.append(convertir(opciones[clave]))
+        limite = int(opciones.get('limite', LIMITE_PAGINA))
+    except ValueError:
+        return "Error: valor no válido en la búsqueda (tamaños como 1500 o 64K, fechas como 2026-10-18)."
+    if not 1 <= limite <= MAX_LIMITE_PAGINA:
+        return f"Error: limite debe estar entre 1 y {MAX_LIMITE_PAGINA}."
+    orden = opciones.get('orden', 'ruta')
+    if orden.lstrip('-') not in ORDENES_BUSQUEDA:
+        return f"Error: orden debe ser uno de {', '.join(ORDENES_BUSQUEDA)} (con '-' delante, descendente)."
+    columna = ORDENES_BUSQUEDA[orden.lstrip('-')]
+    sentido = " DESC" if orden.startswith('-') else ""
+
+    try:
+        # Una fila de más para saber si quedan resultados sin mostrar
+        filas = indice.buscar(prefijo, condiciones, valores, f"{columna}{sentido}, ruta{sentido}", limite + 1)
+    except sqlite3.Error as e:
+        return f"Error: no se ha podido consultar el índice ({e})."
+    hay_mas = len(filas) > limite
+    lineas = []
+    ocupado = 0
+    for ruta, tam, mtime_ns in filas[:limite]:
+        linea = f"{os.path.relpath(os.path.join(indice.raiz, ruta), raiz if ruta_usuario else '.')}\t{tam}\t{mtime_ns}"
+        ocupado += len(linea.encode("utf-8", errors="replace")) + 1
+        if ocupado > max_bytes:
+            hay_mas = True
+            break
+        lineas.append(linea)
+    cabecera = f"SUCCESS: {len(lineas)}" + (" (hay más; afina la búsqueda o sube limite=)" if hay_mas else "")
+    return "\n".join([cabecera] + lineas)
+
+
 def help():
     #Se debe enviar información de los comandos.
     comandos = """
@@ -252,21 +2020,28 @@ Comandos disponibles:
    - Apaga el servidor.
    - Uso: SHUTDOWN
 
-2. LIST_FILES [ruta]
+2. LIST_FILES [ruta] [opciones]
    - Lista solo los ficheros en la ruta indicada (por defecto la actual).
-   - Uso: LIST_FILES [ruta]
+   - Con opciones devuelve el listado por páginas: "SUCCESS: <entradas> <cursor>" y una
+     línea por entrada; el cursor se pasa en la petición siguiente ('-' si no hay más).
+     limite=N (por defecto 1000)    cursor=<cursor>    filtro=<patrón, p. ej. *.txt>
+     orden=nombre|tam|mtime (con '-' delante, descendente)    detalles=1 (tamaño y mtime)
+   - Uso: LIST_FILES [ruta] [limite=N] [cursor=C] [orden=O] [filtro=F] [detalles=1]
 
-3. DOWNLOAD_FILE <fichero>
-   - Descarga un fichero desde el servidor al cliente.
-   - Uso: DOWNLOAD_FILE <nombre_fichero>
+3. DOWNLOAD_FILE <fichero> [offset [longitud]]
+   - Descarga un fichero (o un rango de bytes) desde el servidor al cliente. El servidor
+     calcula el SHA-256 según lo envía y el cliente lo compara con el de lo recibido.
+   - Uso: DOWNLOAD_FILE <nombre_fichero> [offset [longitud]]
 
 4. DELETE_FILE <fichero>
    - Borra un fichero en el servidor.
    - Uso: DELETE_FILE <nombre_fichero>
 
-5. UPLOAD_FILE <fichero>
-   - Sube un fichero desde el cliente al servidor.
-   - Uso: UPLOAD_FILE <nombre_fichero>
+5. UPLOAD_FILE <fichero> [offset [sha256]]
+   - Sube un fichero desde el cliente al servidor. Con offset reanuda una subida cortada;
+     con sha256 el servidor comprueba el fichero completo antes de guardarlo. La respuesta
+     incluye el SHA-256 de lo recibido, que el cliente compara con el suyo.
+   - Uso: UPLOAD_FILE <nombre_fichero> [offset [sha256]]
 
 6. MOVE_FILE <fichero> <destino>
    - Mueve un fichero a un directorio destino.
@@ -276,13 +2051,15 @@ Comandos disponibles:
    - Crea un nuevo directorio en el servidor.
    - Uso: CREATE_DIR <nombre_directorio>
 
-8. DELETE_DIR <nombre>
-   - Borra un directorio en el servidor.
-   - Uso: DELETE_DIR <nombre_directorio>
+8. DELETE_DIR <nombre> [recursivo=1]
+   - Borra un directorio en el servidor. Sin recursivo=1 tiene que estar vacío; con él se
+     borra todo su contenido (necesita sesión).
+   - Uso: DELETE_DIR <nombre_directorio> [recursivo=1]
 
-9. LIST_DIR [ruta]
+9. LIST_DIR [ruta] [opciones]
    - Lista los subdirectorios en la ruta indicada (por defecto la actual).
-   - Uso: LIST_DIR [ruta]
+   - Admite las mismas opciones de paginación que LIST_FILES.
+   - Uso: LIST_DIR [ruta] [limite=N] [cursor=C] [orden=O] [filtro=F] [detalles=1]
 
 10. RENAME_FILE <fichero> <nuevo_nombre>
     - Renombra un fichero existente.
@@ -291,6 +2068,84 @@ Comandos disponibles:
 11. HELP
     - Muestra esta ayuda.
     - Uso: HELP
+
+12. HASH <fichero> [longitud]
+    - Devuelve el SHA-256 del fichero (o de sus primeros 'longitud' bytes). Si el fichero
+      no ha cambiado desde que se subió, descargó o resumió, sale al instante de la caché.
+    - Uso: HASH <nombre_fichero> [longitud]
+
+13. UPLOAD_STATUS <fichero>
+    - Bytes y SHA-256 de la subida parcial de un fichero, para reanudarla.
+    - Uso: UPLOAD_STATUS <nombre_fichero>
+
+14. STAT <fichero>
+    - Tamaño en bytes y fecha de modificación (ns) de un fichero, y su SHA-256 si el
+      servidor ya lo conoce (sin leer el fichero).
+    - Uso: STAT <nombre_fichero>
+
+15. UPLOAD_BEGIN / UPLOAD_PART / UPLOAD_COMMIT / UPLOAD_ABORT
+    - Subida de un fichero en trozos por varias conexiones a la vez (solo protocolo binario).
+    - Uso: UPLOAD_BEGIN <tamaño> -> id; UPLOAD_PART <id> <offset> (+ datos);
+           UPLOAD_COMMIT <id> <nombre_fichero> [sha256]; UPLOAD_ABORT <id>
+
+16. FIRMAS / UPLOAD_DELTA
+    - Actualiza un fichero que ya está en el servidor enviando solo lo que ha cambiado
+      (solo protocolo binario; el cliente lo usa con --delta).
+    - Uso: FIRMAS <nombre_fichero> -> firmas de sus bloques;
+           UPLOAD_DELTA <nombre_fichero> <mtime_base> <sha256> (+ instrucciones)
+
+17. GC
+    - Borra del almacén de contenidos (usuarios/.blobs) los blobs que ya no usa ningún fichero.
+    - Uso: GC
+
+18. CAPACIDADES
+    - Algoritmos de compresión que admite el servidor (el cliente lo usa con --compresion).
+    - Uso: CAPACIDADES
+
+19. LOGIN <usuario> <contrasenia> / LOGOUT
+    - LOGIN abre una sesión y devuelve un token (TOKEN <token>). Cualquier comando puede
+      llevarlo para recuperar la sesión en otra conexión sin repetir LOGIN: en el protocolo
+      de texto, '@<token>' delante del comando. Caduca tras un tiempo sin usarse.
+    - LOGOUT cierra la sesión y anula su token.
+    - Uso: LOGIN <usuario> <contrasenia>; @<token> <comando> [args]; LOGOUT
+
+20. UPLOAD_DIR <directorio> / DOWNLOAD_DIR <directorio>
+    - Sube o descarga un directorio entero (ficheros y subdirectorios) en una sola petición,
+      como un tar que se genera y se extrae sobre la marcha. Solo con el protocolo binario.
+    - Uso: UPLOAD_DIR <directorio>; DOWNLOAD_DIR <directorio>
+
+21. COPY_DIR <origen> <destino>
+    - Copia un directorio con todo su contenido en el servidor (destino no debe existir),
+      salvo las subidas que estén a medias. Necesita sesión.
+    - Uso: COPY_DIR <directorio_origen> <directorio_destino>
+
+22. DELETE_FILES <ruta/patrón> [recursivo=1]
+    - Borra los ficheros cuyo nombre encaja con el patrón (*, ?, [...]); con recursivo=1
+      también en los subdirectorios. Necesita sesión.
+    - Uso: DELETE_FILES <ruta/patrón> [recursivo=1]; p. ej. DELETE_FILES docs/*.tmp
+
+23. TREE [ruta]
+    - Todo el árbol de la ruta: 'ruta<TAB>tamaño' por fichero y 'ruta/<TAB>total' por
+      directorio, con lo que ocupa su contenido.
+    - Uso: TREE [ruta]
+
+24. SEARCH [patrón] [opciones]
+    - Busca ficheros en el índice del servidor, sin recorrer el disco: por nombre (patrón
+      con *, ? y [...]), tamaño, fecha de modificación o SHA-256. Devuelve una línea
+      'ruta<TAB>tamaño<TAB>mtime_ns' por fichero.
+      ruta=<directorio>    min=/max=<tamaño, p. ej. 64K o 2G>    sha256=<resumen>
+      desde=/hasta=<fecha, p. ej. 2026-10-18 o segundos desde 1970>
+      orden=ruta|nombre|tam|mtime (con '-' delante, descendente)    limite=N (por defecto 1000)
+    - Uso: SEARCH [patrón] [ruta=D] [min=T] [max=T] [desde=F] [hasta=F] [sha256=H] [orden=O] [limite=N]
+
+25. STATS [prometheus]
+    - Métricas del servidor desde que arrancó: peticiones, errores y latencia (media, p50 y
+      p99 en ms) por comando, bytes recibidos y enviados, conexiones abiertas y en cola.
+      Con 'prometheus', en el formato de texto de Prometheus (histogramas incluidos).
+    - Uso: STATS [prometheus]
+
+Las operaciones recursivas (DELETE_DIR recursivo=1, COPY_DIR, DELETE_FILES, TREE) mandan
+su progreso mientras trabajan con el protocolo binario.
 """
     return comandos
 def renombrar_fichero(fichero, nuevo_nombre):
@@ -299,8 +2154,10 @@ def renombrar_fichero(fichero, nuevo_nombre):
         if not os.path.isfile(fichero):
             return "RENAME_ERROR"
 
-        # Renombrar el fichero
-        os.rename(fichero, nuevo_nombre)
+        # Renombrar el fichero (si el nuevo nombre está en otro dispositivo, se mueve)
+        _mover(fichero, nuevo_nombre)
+        listados.invalidar(fichero, nuevo_nombre)
+        indice.actualizar(fichero, nuevo_nombre)
         return "RENAMED"
     except FileNotFoundError:
         return "RENAME_ERROR"
@@ -325,45 +2182,125 @@ def _resolver_ruta_usuario(ruta_usuario, ruta_rel):
 
 # --EXTRA--
 
-def obtener_usuarios():
-    """Lee usuarios desde usuarios.txt.
-    Formato por línea: usuario,contrasenia
-    Devuelve: list[dict] con claves 'usuario' y 'contrasenia'
-    """
-    lista_usuarios = []
-    try:
-        # Asegurar fichero
-        if not os.path.exists("usuarios.txt"):
-            with open("usuarios.txt", "a", encoding="utf-8"):
+class AlmacenUsuarios:
+    """Usuarios registrados, indexados en un diccionario usuario -> contraseña.
+    usuarios.txt (una línea 'usuario,contrasenia' por usuario) se lee entero una sola vez; en
+    cada consulta basta un stat para ver si otro proceso lo ha cambiado y, como solo se añaden
+    líneas al final, se lee únicamente lo añadido. Si el fichero se ha sustituido o ha
+    encogido, se vuelve a leer entero. Los registros se serializan con un cerrojo entre
+    hilos y con flock entre procesos, y cada uno es una única escritura en modo append."""
+
+    def __init__(self, fichero="usuarios.txt"):
+        self.fichero = fichero
+        self.usuarios = {}
+        self.firma = None       # (inodo, tamaño, mtime_ns) del fichero ya leído
+        self.leido = 0          # Bytes leídos hasta el final de la última línea completa
+        self.pendiente = None   # Usuario de una última línea sin '\n' (se vuelve a leer)
+        self.cerrojo = threading.Lock()
+
+    def contrasenia(self, usuario):
+        """Contraseña de usuario, o None si no está registrado."""
+        with self.cerrojo:
+            self._actualizar()
+            return self.usuarios.get(usuario)
+
+    def existe(self, usuario):
+        return self.contrasenia(usuario) is not None
+
+    def registrar(self, usuario, contrasenia):
+        """Añade el usuario al fichero. Devuelve False si ya estaba registrado."""
+        with self.cerrojo, self._abrir_bloqueado("ab") as f:
+            self._actualizar()
+            if usuario in self.usuarios:
+                return False
+            # Si la última línea no termina en '\n', la nuestra no debe quedar pegada a ella
+            separador = "\n" if self.pendiente is not None else ""
+            f.write(f"{separador}{usuario},{contrasenia}\n".encode("utf-8"))
+            f.flush()
+            self._actualizar()
+            return True
+
+    def compactar(self):
+        """Reescribe el fichero con una línea por usuario, sin líneas vacías, incorrectas ni
+        repetidas. Devuelve el número de usuarios."""
+        with self.cerrojo, self._abrir_bloqueado("ab"):
+            self._actualizar()
+            temporal = f"{self.fichero}.{secrets.token_hex(4)}.tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                f.writelines(f"{u},{c}\n" for u, c in self.usuarios.items())
+            os.replace(temporal, self.fichero)
+            self.firma = None
+            self._actualizar()
+            return len(self.usuarios)
+
+    @contextmanager
+    def _abrir_bloqueado(self, modo):
+        """Abre el fichero con flock exclusivo. Si otro proceso lo ha sustituido (compactar)
+        mientras esperábamos el cerrojo, abre el nuevo."""
+        while True:
+            f = open(self.fichero, modo)
+            if fcntl is None:
+                break
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.fichero).st_ino:
+                    break
+            except FileNotFoundError:
                 pass
+            f.close()
+        with f:
+            yield f
 
-        with open("usuarios.txt", "r", encoding="utf-8") as fUsuarios:
-            for linea in fUsuarios.read().splitlines():
-                if not linea.strip():
-                    continue
-                partes = linea.strip().split(",", 1)
-                if len(partes) != 2:
-                    continue
-                usuario, contrasenia = partes[0].strip(), partes[1].strip()
-                lista_usuarios.append({"usuario": usuario, "contrasenia": contrasenia})
-    except Exception as e:
-        # En caso de error devolvemos lista vacía (evita romper el servidor)
-        print(f"Error leyendo usuarios.txt: {e}")
-        return []
-    return lista_usuarios
+    def _actualizar(self):
+        # Llamar con el cerrojo tomado
+        try:
+            st = os.stat(self.fichero)
+        except FileNotFoundError:
+            self.usuarios, self.firma, self.leido, self.pendiente = {}, None, 0, None
+            return
+        firma = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if firma == self.firma:
+            return
+        if self.firma is None or st.st_ino != self.firma[0] or st.st_size < self.leido:
+            self.usuarios, self.leido, self.pendiente = {}, 0, None
+        if self.pendiente is not None:
+            # La línea sin terminar se lee otra vez: puede que estuviera a medio escribir
+            self.usuarios.pop(self.pendiente, None)
+            self.pendiente = None
+        try:
+            with open(self.fichero, "rb") as f:
+                f.seek(self.leido)
+                datos = f.read()
+        except OSError as e:
+            print(f"Error leyendo {self.fichero}: {e}")
+            return
+        completo = datos.rfind(b"\n") + 1
+        for linea in datos.decode("utf-8", errors="replace").splitlines(keepends=True):
+            partes = linea.strip().split(",", 1)
+            if len(partes) != 2 or not partes[0].strip():
+                continue
+            usuario = partes[0].strip()
+            if usuario in self.usuarios:
+                continue    # Como antes, vale la primera línea de cada usuario
+            self.usuarios[usuario] = partes[1].strip()
+            if not linea.endswith("\n"):
+                self.pendiente = usuario
+        self.leido += completo
+        self.firma = firma
+
+usuarios = AlmacenUsuarios()
 
 def iniciar_sesion(usuario, contrasenia):
     """Valida credenciales y devuelve (ok: bool, ruta_usuario: str, msg: str)."""
-    usuarios = obtener_usuarios()
-    for u in usuarios:
-        if u.get("usuario") == usuario:
-            if u.get("contrasenia") == contrasenia:
-                base_dir = os.path.join(".", "usuarios")
-                ruta = os.path.join(base_dir, usuario)
-                os.makedirs(ruta, exist_ok=True)
-                return True, ruta, f"SUCCESS: Sesión iniciada como '{usuario}'."
-            return False, "", "ERROR: Contraseña incorrecta."
-    return False, "", "ERROR: Usuario no registrado."
+    guardada = usuarios.contrasenia(usuario)
+    if guardada is None:
+        return False, "", "ERROR: Usuario no registrado."
+    if not secrets.compare_digest(guardada.encode("utf-8"), contrasenia.encode("utf-8")):
+        return False, "", "ERROR: Contraseña incorrecta."
+    base_dir = os.path.join(".", "usuarios")
+    ruta = os.path.join(base_dir, usuario)
+    os.makedirs(ruta, exist_ok=True)
+    return True, ruta, f"SUCCESS: Sesión iniciada como '{usuario}'."
 
 
 def registrar_usuario(usuario, contrasenia, confirmacion):
@@ -372,19 +2309,13 @@ def registrar_usuario(usuario, contrasenia, confirmacion):
         return "ERROR: Usuario y contraseña obligatorios."
     if contrasenia != confirmacion:
         return "ERROR: La contraseña y la confirmación no coinciden."
-
-    usuarios = obtener_usuarios()
-    if any(u.get("usuario") == usuario for u in usuarios):
-        return "ERROR: Ese usuario ya está registrado."
-
-    # Asegurar fichero
-    if not os.path.exists("usuarios.txt"):
-        with open("usuarios.txt", "a", encoding="utf-8"):
-            pass
+    if usuario.startswith(".") or any(c in usuario for c in "/\\,\n") or "\n" in contrasenia:
+        # Los nombres con punto inicial están reservados (p. ej. el almacén usuarios/.blobs)
+        return "ERROR: El nombre de usuario no puede empezar por '.' ni contener '/' o ','."
 
     try:
-        with open("usuarios.txt", "a", encoding="utf-8") as f:
-            f.write(f"{usuario},{contrasenia}\n")
+        if not usuarios.registrar(usuario, contrasenia):
+            return "ERROR: Ese usuario ya está registrado."
 
         base_dir = os.path.join(".", "usuarios")
         ruta = os.path.join(base_dir, usuario)
@@ -396,7 +2327,7 @@ def registrar_usuario(usuario, contrasenia, confirmacion):
 
 
 def compartir_fichero(fichero, usuario_destino, ruta_usuario_origen):
-    """Comparte (copia) un fichero desde el usuario logueado al directorio del usuario destino.
+    """Comparte un fichero desde el usuario logueado al directorio del usuario destino.
     - fichero: nombre/ruta relativa del fichero dentro del directorio del usuario origen
     - usuario_destino: usuario receptor
     - ruta_usuario_origen: ruta del directorio del usuario origen (sesión actual)
@@ -405,8 +2336,7 @@ def compartir_fichero(fichero, usuario_destino, ruta_usuario_origen):
         return "ERROR: Debes iniciar sesión antes de usar SHARE."
 
     # Validar receptor existe
-    usuarios = obtener_usuarios()
-    if not any(u.get("usuario") == usuario_destino for u in usuarios):
+    if not usuarios.existe(usuario_destino):
         return "ERROR: El usuario destino no existe."
 
     base_dir = os.path.join(".", "usuarios")
@@ -437,10 +2367,16 @@ def compartir_fichero(fichero, usuario_destino, ruta_usuario_origen):
         nombre = os.path.basename(destino)
 
     try:
-        with open(origen, "rb") as f:
-            contenido = f.read()
-        with open(destino, "wb") as f:
-            f.write(contenido)
+        # El fichero compartido es un enlace más al mismo blob: no ocupa espacio ni hay que
+        # copiar nada. Si no se pueden usar enlaces duros, se copia sin cargarlo en memoria.
+        resumen = deduplicar(origen)
+        try:
+            os.link(origen, destino)
+        except OSError:
+            shutil.copyfile(origen, destino)
+        listados.invalidar(destino)
+        # deduplicar puede haber cambiado el origen por un enlace al blob (con otra fecha)
+        indice.actualizar(origen, destino, resumenes={origen: resumen, destino: resumen})
         return f"SUCCESS: Fichero compartido como '{nombre}' en el directorio de '{usuario_destino}'."
     except PermissionError:
         return "ERROR: Permisos insuficientes para compartir el fichero."
@@ -448,6 +2384,1560 @@ def compartir_fichero(fichero, usuario_destino, ruta_usuario_origen):
         return f"ERROR: No se pudo compartir el fichero ({e})."
 
 
+class Sesion:
+    """Estado de sesión de una conexión: usuario autenticado y su directorio personal.
+    Cada conexión tiene la suya, así los clientes concurrentes no se pisan la sesión."""
+
+    def __init__(self):
+        self.usuario = None
+        self.ruta = ''
+        self.binario = False    # True si la conexión usa el protocolo de tramas
+        self.compresion = 0     # Flags de compresión que admite el cliente en la petición actual
+        self.resumen = False    # La petición actual pide el SHA-256 de lo que descarga (FLAG_RESUMEN)
+        self.token = None       # Token de la sesión (LOGIN), para cerrarla con LOGOUT
+        self.rechazo = None     # Error del token de la petición actual, si no era válido
+
+
+class Sesiones:
+    """Sesiones abiertas con LOGIN, indexadas por un token opaco. Con el token, un cliente
+    recupera su sesión en cualquier conexión sin repetir LOGIN (ni consultar usuarios.txt).
+    Una sesión caduca tras ttl segundos sin usarse y, si hay más de max_sesiones, se
+    descartan las usadas hace más tiempo (LRU)."""
+
+    def __init__(self, ttl=3600, max_sesiones=10_000):
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+        self.tokens = OrderedDict()     # token -> (usuario, ruta, instante de caducidad)
+        self.cerrojo = threading.Lock()
+
+    def crear(self, usuario, ruta):
+        token = secrets.token_urlsafe(24)
+        ahora = time.monotonic()
+        with self.cerrojo:
+            self.tokens[token] = (usuario, ruta, ahora + self.ttl)
+            # Al usarse pasan al final: las caducadas y las menos usadas están al principio
+            while self.tokens:
+                primero, (_, _, caduca) = next(iter(self.tokens.items()))
+                if caduca > ahora and len(self.tokens) <= self.max_sesiones:
+                    break
+                del self.tokens[primero]
+        return token
+
+    def consultar(self, token):
+        """(usuario, ruta) de la sesión, o None si el token no existe o ha caducado."""
+        ahora = time.monotonic()
+        with self.cerrojo:
+            entrada = self.tokens.get(token)
+            if entrada is None:
+                return None
+            if entrada[2] <= ahora:
+                del self.tokens[token]
+                return None
+            self.tokens[token] = (entrada[0], entrada[1], ahora + self.ttl)
+            self.tokens.move_to_end(token)
+            return entrada[0], entrada[1]
+
+    def cerrar(self, token):
+        with self.cerrojo:
+            self.tokens.pop(token, None)
+
+sesiones = Sesiones()
+
+
+ESQUEMA_SESIONES = """
+CREATE TABLE IF NOT EXISTS sesiones (
+    clave BLOB PRIMARY KEY,     -- SHA-256 del token: el fichero no guarda los tokens
+    usuario TEXT NOT NULL,
+    ruta TEXT NOT NULL,
+    caduca REAL NOT NULL        -- time.time() a partir del que deja de valer
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sesiones_caduca ON sesiones (caduca);
+"""
+
+
+class SesionesCompartidas:
+    """Como Sesiones, pero en una base de datos SQLite que comparten los procesos de --workers:
+    el token que da LOGIN en un proceso vale en las conexiones que atienden los demás, y
+    sobrevive a que el supervisor reinicie el proceso. Cada proceso abre su propia conexión
+    la primera vez que la usa. Solo se consulta al presentar un token (normalmente una vez
+    por conexión), no en cada petición."""
+
+    def __init__(self, fichero, ttl=3600, max_sesiones=10_000):
+        self.fichero = fichero
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+        self.bd = None
+        self.cerrojo = threading.Lock()
+
+    def _abrir(self):
+        if self.bd is None:
+            self.bd = sqlite3.connect(self.fichero, timeout=30, check_same_thread=False)
+            self.bd.execute("PRAGMA journal_mode=WAL")
+            # Si se pierde la base de datos, se pierden las sesiones: no hace falta fsync
+            self.bd.execute("PRAGMA synchronous=OFF")
+            self.bd.executescript(ESQUEMA_SESIONES)
+        return self.bd
+
+    @staticmethod
+    def _clave(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def crear(self, usuario, ruta):
+        token = secrets.token_urlsafe(24)
+        ahora = time.time()
+        with self.cerrojo, self._abrir() as bd:
+            bd.execute("DELETE FROM sesiones WHERE caduca <= ?", (ahora,))
+            bd.execute("INSERT INTO sesiones VALUES (?, ?, ?, ?)", (self._clave(token), usuario, ruta, ahora + self.ttl))
+            sobran = bd.execute("SELECT count(*) FROM sesiones").fetchone()[0] - self.max_sesiones
+            if sobran > 0:
+                # Las que caducan antes son las usadas hace más tiempo
+                bd.execute("DELETE FROM sesiones WHERE clave IN (SELECT clave FROM sesiones ORDER BY caduca LIMIT ?)", (sobran,))
+        return token
+
+    def consultar(self, token):
+        """(usuario, ruta) de la sesión, o None si el token no existe o ha caducado."""
+        clave = self._clave(token)
+        ahora = time.time()
+        with self.cerrojo, self._abrir() as bd:
+            fila = bd.execute("SELECT usuario, ruta, caduca FROM sesiones WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                return None
+            if fila[2] <= ahora:
+                bd.execute("DELETE FROM sesiones WHERE clave = ?", (clave,))
+                return None
+            bd.execute("UPDATE sesiones SET caduca = ? WHERE clave = ?", (ahora + self.ttl, clave))
+        return fila[0], fila[1]
+
+    def cerrar(self, token):
+        with self.cerrojo, self._abrir() as bd:
+            bd.execute("DELETE FROM sesiones WHERE clave = ?", (self._clave(token),))
+
+    def borrar(self):
+        """Elimina la base de datos (al apagar el supervisor)."""
+        for sufijo in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.fichero + sufijo)
+            except FileNotFoundError:
+                pass
+
+
+def _separar_token(data_list, flags=None):
+    """Quita de la petición el token de sesión, si lo lleva: en el protocolo de texto va
+    delante del comando como '@token'; en el de tramas es el primer argumento y la trama
+    lleva FLAG_SESION (flags es None en el de texto). Devuelve (data_list, token o None)."""
+    if flags is None:
+        if len(data_list) > 1 and data_list[0].startswith('@'):
+            return data_list[1:], data_list[0][1:]
+    elif flags & protocolo.FLAG_SESION and len(data_list) > 1:
+        return [data_list[0]] + data_list[2:], data_list[1]
+    return data_list, None
+
+
+def _usar_token(sesion, token):
+    """Recupera en la conexión la sesión del token. Si no es válido, la petición se rechaza
+    (sesion.rechazo) en lugar de ejecutarse sin sesión, fuera del directorio del usuario."""
+    if token is None:
+        return
+    datos = sesiones.consultar(token)
+    if datos is None:
+        sesion.rechazo = "ERROR: Sesión caducada o no válida; vuelve a hacer LOGIN."
+        return
+    sesion.usuario, sesion.ruta = datos
+    sesion.token = token
+
+
+def _enviar(conn, texto):
+    """Envía una respuesta de texto al cliente."""
+    conn.sendall(texto.encode("utf-8"))
+
+
+def ejecutar_comando(data_list, sesion):
+    """Ejecuta un comando que no transfiere ficheros y devuelve la respuesta (str).
+    DOWNLOAD_FILE y UPLOAD_FILE necesitan la conexión y se atienden en atender_transferencia."""
+    orden = data_list[0].upper()     #La orden se corresponde con la primera palabra (convertimos en mayuscula)
+    if sesion.rechazo:
+        texto, sesion.rechazo = sesion.rechazo, None
+        return texto
+    ruta_usuario = sesion.ruta
+
+    if orden == 'SHUTDOWN':
+        # El motor que atiende la conexión es quien apaga el servidor
+        print("Servidor apagándose por orden del cliente.")
+        return "Servidor apagandose...\n"
+
+    elif orden in ('LIST_FILES', 'LIST_DIR'):
+        # Si hay sesión, por defecto listamos el directorio del usuario ('.' relativo a él)
+        try:
+            ruta, opciones = opciones_listado(data_list[1:])
+        except ValueError as e:
+            return str(e)
+        if ruta_usuario:
+            ok, ruta, err = _resolver_ruta_usuario(ruta_usuario, ruta)
+            if not ok:
+                return err
+        if opciones:
+            # Listado por páginas (ver listar_pagina)
+            max_bytes = protocolo.MAX_TROZO if sesion.binario else BYTES_PAGINA_TEXTO
+            return listar_pagina(ruta, orden == 'LIST_DIR', opciones, max_bytes)
+        return listar_ficheros(ruta) if orden == 'LIST_FILES' else listar_directorio(ruta)
+
+    elif orden == 'DELETE_FILE':
+        if len(data_list) > 1:
+            fichero = data_list[1]   # nombre o ruta del fichero a borrar
+            if ruta_usuario:
+                ok, fich_res, err = _resolver_ruta_usuario(ruta_usuario, fichero)
+                return borrar_fichero(fich_res) if ok else err
+            return borrar_fichero(fichero)
+        return "ERROR"
+
+    elif orden == 'MOVE_FILE':
+        if len(data_list) > 2:
+            fichero = data_list[1]
+            destino = data_list[2]
+            if nombre_reservado(fichero):
+                return nombre_reservado(fichero)
+            if ruta_usuario:
+                ok1, fich_res, err1 = _resolver_ruta_usuario(ruta_usuario, fichero)
+                ok2, dest_res, err2 = _resolver_ruta_usuario(ruta_usuario, destino)
+                if not ok1:
+                    return err1
+                if not ok2:
+                    return err2
+                return mover_fichero(fich_res, dest_res)
+            return mover_fichero(fichero, destino)
+        return "Error: Debes especificar fichero y destino."
+
+    elif orden == 'CREATE_DIR':
+        if len(data_list) > 1:
+            nombre = data_list[1]
+            if ruta_usuario:
+                ok, ruta_res, err = _resolver_ruta_usuario(ruta_usuario, nombre)
+                return crear_directorio(ruta_res) if ok else err
+            return crear_directorio(nombre)
+        return "Error: Debes especificar un nombre de directorio."
+
+    elif orden == 'DELETE_DIR':
+        if len(data_list) > 1:
+            nombre = data_list[1]
+            if ruta_usuario:
+                ok, ruta_res, err = _resolver_ruta_usuario(ruta_usuario, nombre)
+                return borrar_directorio(ruta_res) if ok else err
+            return borrar_directorio(nombre)
+        return "ERROR: Debes especificar un nombre de directorio."
+
+    elif orden == 'HELP':
+        return help()
+
+    elif orden == 'RENAME_FILE':
+        if len(data_list) < 3:
+            return "RENAME_ERROR"
+        fichero = data_list[1]
+        nuevo_nombre = data_list[2]
+        if nombre_reservado(fichero) or nombre_reservado(nuevo_nombre):
+            return "RENAME_ERROR"
+        if ruta_usuario:
+            ok1, fich_res, err1 = _resolver_ruta_usuario(ruta_usuario, fichero)
+            ok2, nuevo_res, err2 = _resolver_ruta_usuario(ruta_usuario, nuevo_nombre)
+            if not ok1:
+                return err1
+            if not ok2:
+                return err2
+            return renombrar_fichero(fich_res, nuevo_res)
+        return renombrar_fichero(fichero, nuevo_nombre)
+
+    elif orden == 'HASH':
+        if len(data_list) < 2:
+            return "Error: Uso HASH <fichero> [longitud]."
+        try:
+            longitud = _entero(data_list, 2)
+        except ValueError as e:
+            return str(e)
+        ok, fichero, err = _resolver_ruta_usuario(ruta_usuario, data_list[1])
+        return resumen_fichero(fichero, longitud) if ok else err
+
+    elif orden == 'UPLOAD_STATUS':
+        if len(data_list) < 2:
+            return "Error: Uso UPLOAD_STATUS <fichero>."
+        return estado_subida(data_list[1], ruta_usuario if ruta_usuario else None)
+
+    elif orden == 'GC':
+        return recolectar_blobs()
+
+    elif orden == 'CAPACIDADES':
+        return "SUCCESS: " + " ".join(protocolo.COMPRESORES)
+
+    elif orden == 'STAT':
+        if len(data_list) < 2:
+            return "Error: Uso STAT <fichero>."
+        ok, fichero, err = _resolver_ruta_usuario(ruta_usuario, data_list[1])
+        return estado_fichero(fichero) if ok else err
+
+    elif orden == 'SEARCH':
+        max_bytes = protocolo.MAX_TROZO if sesion.binario else BYTES_PAGINA_TEXTO
+        return buscar_ficheros(data_list[1:], ruta_usuario, max_bytes)
+
+    elif orden == 'STATS':
+        if len(data_list) == 1:
+            return metricas.resumen()
+        if data_list[1].lower() == 'prometheus':
+            return "SUCCESS: formato de texto de Prometheus\n" + metricas.prometheus()
+        return "Error: Uso STATS [prometheus]."
+
+    elif orden == 'UPLOAD_BEGIN':
+        try:
+            tam = _entero(data_list, 1)
+        except ValueError as e:
+            return str(e)
+        if tam is None:
+            return "Error: Uso UPLOAD_BEGIN <tamaño>."
+        return iniciar_subida_paralela(tam, ruta_usuario if ruta_usuario else None)
+
+    elif orden == 'UPLOAD_COMMIT':
+        if len(data_list) < 3:
+            return "Error: Uso UPLOAD_COMMIT <id> <fichero> [sha256]."
+        resumen = data_list[3] if len(data_list) > 3 else None
+        if nombre_reservado(data_list[2]):
+            return nombre_reservado(data_list[2])
+        return completar_subida_paralela(data_list[1], data_list[2], ruta_usuario if ruta_usuario else None, resumen)
+
+    elif orden == 'UPLOAD_ABORT':
+        if len(data_list) < 2:
+            return "Error: Uso UPLOAD_ABORT <id>."
+        return cancelar_subida_paralela(data_list[1], ruta_usuario if ruta_usuario else None)
+
+    elif orden == 'LOGIN':
+        if len(data_list) < 3:
+            return "ERROR: Uso LOGIN <usuario> <contrasenia>."
+        usr = data_list[1]
+        pwd = data_list[2]
+        ok, ruta, msg = iniciar_sesion(usr, pwd)
+        if ok:
+            sesion.usuario = usr
+            sesion.ruta = ruta
+            # Con el token el cliente recupera la sesión en otras conexiones sin repetir LOGIN
+            sesion.token = sesiones.crear(usr, ruta)
+            msg += f" TOKEN {sesion.token}"
+        return msg
+
+    elif orden == 'LOGOUT':
+        if sesion.token:
+            sesiones.cerrar(sesion.token)
+        sesion.usuario, sesion.ruta, sesion.token = None, '', None
+        return "SUCCESS: Sesión cerrada."
+
+    elif orden == 'SING_IN':
+        if len(data_list) < 4:
+            return "ERROR: Uso SING_IN <usuario> <contrasenia> <confirmacion>."
+        usr = data_list[1]
+        pwd = data_list[2]
+        conf = data_list[3]
+        return registrar_usuario(usr, pwd, conf)
+
+    elif orden == 'SHARE':
+        if len(data_list) < 3:
+            return "ERROR: Uso SHARE <fichero> <usuario_destino>."
+        if not ruta_usuario:
+            return "ERROR: Debes iniciar sesión antes de usar SHARE."
+        fichero = data_list[1]
+        usr_dest = data_list[2]
+        if nombre_reservado(fichero):
+            return nombre_reservado(fichero)
+        return compartir_fichero(fichero, usr_dest, ruta_usuario)
+
+    return "UNKNOWN_COMMAND"
+
+
+def _responder(conn, sesion, orden, texto, etiqueta=0):
+    """Envía una respuesta de texto en el protocolo que use la conexión."""
+    if sesion.binario:
+        conn.sendall(_respuesta(protocolo.OPERACIONES.get(orden, protocolo.OP_ERROR), texto, etiqueta, sesion.compresion))
+    else:
+        conn.sendall(_respuesta_texto(orden, texto))
+
+
+def _entero(data_list, posicion, defecto=None):
+    """Argumento numérico opcional (entero >= 0). Lanza ValueError si no lo es."""
+    if len(data_list) <= posicion:
+        return defecto
+    try:
+        valor = int(data_list[posicion])
+    except ValueError:
+        valor = -1
+    if valor < 0:
+        raise ValueError(f"Error: '{data_list[posicion]}' no es un número de bytes válido.")
+    return valor
+
+
+def _descartar_datos(conn, sesion):
+    """En el protocolo binario el contenido de un UPLOAD_FILE llega detrás de la petición
+    aunque esta sea incorrecta; lo descartamos para dejar la conexión lista."""
+    if sesion.binario:
+        cab = protocolo.recibir_cabecera(conn)
+        if cab is not None and cab.flags & protocolo.MASCARA_COMPRESION:
+            protocolo.descartar_comprimido(conn, cab)
+        elif cab is not None:
+            protocolo.descartar(conn, cab.longitud)
+
+
+def _descartar_diferencias(conn):
+    """Descarta las tramas de un UPLOAD_DELTA incorrecto, hasta la vacía que las termina."""
+    while True:
+        cab = protocolo.recibir_cabecera(conn)
+        if cab is None or cab.longitud == 0:
+            return
+        protocolo.descartar(conn, cab.longitud)
+
+
+def atender_transferencia(conn, data_list, sesion, etiqueta=0):
+    """Atiende DOWNLOAD_FILE, UPLOAD_FILE y UPLOAD_PART, que además de la respuesta mueven
+    el contenido del fichero por la conexión.
+    DOWNLOAD_FILE <fichero> [offset [longitud]] descarga un rango del fichero,
+    UPLOAD_FILE <fichero> [offset [sha256]] reanuda una subida parcial a partir de offset y
+    UPLOAD_PART <id> <offset> escribe un trozo de una subida en paralelo (ver UPLOAD_BEGIN).
+    FIRMAS y UPLOAD_DELTA forman la subida por diferencias (ver delta.py).
+    UPLOAD_DIR y DOWNLOAD_DIR mueven un directorio entero como un tar (ver directorios.py).
+    Las operaciones recursivas (COMANDOS_ARBOL) mandan su progreso (ver atender_arbol)."""
+    orden = data_list[0].upper()
+    ruta_usuario = sesion.ruta
+
+    if sesion.rechazo:
+        texto, sesion.rechazo = sesion.rechazo, None
+        if orden in ('UPLOAD_FILE', 'UPLOAD_PART'):
+            _descartar_datos(conn, sesion)
+        elif orden in ('UPLOAD_DELTA', 'UPLOAD_DIR') and sesion.binario:
+            _descartar_diferencias(conn)
+        _responder(conn, sesion, orden, texto, etiqueta)
+        return
+
+    if orden == 'DOWNLOAD_FILE':
+        if len(data_list) < 2:
+            _responder(conn, sesion, orden, "Error: Debes especificar el fichero a descargar.", etiqueta)
+            return
+        try:
+            offset = _entero(data_list, 2, 0)
+            longitud = _entero(data_list, 3)
+        except ValueError as e:
+            _responder(conn, sesion, orden, str(e), etiqueta)
+            return
+        # Sin sesión la ruta se usa tal cual
+        ok, fichero, err = _resolver_ruta_usuario(ruta_usuario, data_list[1])
+        if not ok:
+            _responder(conn, sesion, orden, err, etiqueta)
+        elif sesion.binario:
+            descargar_fichero_trama(conn, fichero, etiqueta, offset, longitud, sesion.compresion, sesion.resumen)
+        else:
+            descargar_fichero(conn, fichero, offset, longitud)
+
+    elif orden == 'UPLOAD_FILE':
+        if len(data_list) < 2:
+            _descartar_datos(conn, sesion)
+            _responder(conn, sesion, orden, "Error: Debes especificar un nombre de fichero.", etiqueta)
+            return
+        try:
+            offset = _entero(data_list, 2, 0)
+        except ValueError as e:
+            _descartar_datos(conn, sesion)
+            _responder(conn, sesion, orden, str(e), etiqueta)
+            return
+        fichero = data_list[1]
+        resumen = data_list[3] if len(data_list) > 3 else None
+        if nombre_reservado(fichero):
+            _descartar_datos(conn, sesion)
+            _responder(conn, sesion, orden, nombre_reservado(fichero), etiqueta)
+            return
+        # Guardar en el directorio del usuario si hay sesión
+        dest_dir = ruta_usuario if ruta_usuario else None
+        if sesion.binario:
+            subir_fichero_trama(conn, fichero, dest_dir, etiqueta, offset, resumen)
+        else:
+            subir_fichero(conn, fichero, dest_dir, offset, resumen)
+
+    elif orden == 'UPLOAD_PART':
+        if not sesion.binario:
+            _responder(conn, sesion, orden, "Error: UPLOAD_PART necesita el protocolo binario.", etiqueta)
+            return
+        try:
+            offset = _entero(data_list, 2)
+        except ValueError as e:
+            _descartar_datos(conn, sesion)
+            _responder(conn, sesion, orden, str(e), etiqueta)
+            return
+        if offset is None:
+            _descartar_datos(conn, sesion)
+            _responder(conn, sesion, orden, "Error: Uso UPLOAD_PART <id> <offset>.", etiqueta)
+            return
+        subir_trozo_trama(conn, data_list[1], offset, ruta_usuario if ruta_usuario else None, etiqueta)
+
+    elif orden in ('FIRMAS', 'UPLOAD_DELTA'):
+        if not sesion.binario:
+            _responder(conn, sesion, orden, f"Error: {orden} necesita el protocolo binario.", etiqueta)
+            return
+        dest_dir = ruta_usuario if ruta_usuario else None
+        if orden == 'FIRMAS':
+            if len(data_list) < 2:
+                _responder(conn, sesion, orden, "Error: Uso FIRMAS <fichero>.", etiqueta)
+            else:
+                firmas_fichero_trama(conn, data_list[1], dest_dir, etiqueta)
+            return
+        try:
+            mtime_base = _entero(data_list, 2)
+        except ValueError:
+            mtime_base = None
+        if mtime_base is None or len(data_list) < 4:
+            _descartar_diferencias(conn)
+            _responder(conn, sesion, orden, "Error: Uso UPLOAD_DELTA <fichero> <mtime_base> <sha256>.", etiqueta)
+            return
+        if nombre_reservado(data_list[1]):
+            _descartar_diferencias(conn)
+            _responder(conn, sesion, orden, nombre_reservado(data_list[1]), etiqueta)
+            return
+        subir_delta_trama(conn, data_list[1], mtime_base, data_list[3], dest_dir, etiqueta)
+
+    elif orden in COMANDOS_ARBOL:
+        atender_arbol(conn, data_list, sesion, etiqueta)
+
+    elif orden in ('UPLOAD_DIR', 'DOWNLOAD_DIR'):
+        if not sesion.binario:
+            _responder(conn, sesion, orden, f"Error: {orden} necesita el protocolo binario.", etiqueta)
+            return
+        dest_dir = ruta_usuario if ruta_usuario else None
+        if len(data_list) < 2:
+            if orden == 'UPLOAD_DIR':
+                _descartar_diferencias(conn)
+            _responder(conn, sesion, orden, f"Error: Uso {orden} <directorio>.", etiqueta)
+        elif orden == 'UPLOAD_DIR':
+            subir_directorio_trama(conn, data_list[1], dest_dir, etiqueta)
+        else:
+            descargar_directorio_trama(conn, data_list[1], dest_dir, etiqueta, sesion.compresion)
+
+
+def atender_arbol(conn, data_list, sesion, etiqueta=0):
+    """Atiende las operaciones recursivas, que mandan su progreso por la conexión (ver Emisor):
+    DELETE_DIR <directorio> recursivo=1, COPY_DIR <origen> <destino>,
+    DELETE_FILES <ruta/patrón> [recursivo=1] y TREE [ruta].
+    Las que borran o copian árboles necesitan sesión y solo actúan dentro del directorio del
+    usuario: sin sesión las rutas se usan tal cual y podrían ser cualquiera del servidor."""
+    orden = data_list[0].upper()
+    emisor = Emisor(conn, sesion, orden, etiqueta)
+    argumentos = [a for a in data_list[1:] if a.lower() != 'recursivo=1']
+    recursivo = len(argumentos) < len(data_list) - 1
+    if orden == 'DELETE_DIR' and not recursivo:
+        emisor.terminar(ejecutar_comando(data_list, sesion))
+        return
+    if orden != 'TREE' and not sesion.ruta:
+        emisor.terminar(f"Error: Debes iniciar sesión antes de usar {orden}.")
+        return
+    necesarios = {'DELETE_DIR': 1, 'COPY_DIR': 2, 'DELETE_FILES': 1, 'TREE': 0}[orden]
+    if len(argumentos) < necesarios:
+        emisor.terminar(f"Error: Faltan argumentos; consulta HELP para el uso de {orden}.")
+        return
+
+    patron = None
+    if orden == 'DELETE_FILES':
+        # El patrón va en el último componente: 'docs/*.tmp' borra los .tmp de docs
+        directorio, patron = os.path.split(argumentos[0])
+        if not patron or any(c in directorio for c in '*?['):
+            emisor.terminar("Error: Uso DELETE_FILES <ruta/patrón>; el patrón solo puede ir en el nombre.")
+            return
+        argumentos = [directorio or '.']
+    rutas = []
+    for ruta in argumentos[:max(necesarios, 1)] or ['.']:
+        ok, ruta_abs, err = _resolver_ruta_usuario(sesion.ruta, ruta)
+        if ok and orden != 'TREE':
+            # También sin enlaces simbólicos de por medio que lleven fuera del usuario
+            base = os.path.realpath(sesion.ruta)
+            real = os.path.realpath(ruta_abs)
+            if real != base and not real.startswith(base + os.sep):
+                ok, err = False, "ERROR: Ruta inválida (fuera del directorio del usuario)."
+        if not ok:
+            emisor.terminar(err)
+            return
+        rutas.append(ruta_abs)
+
+    if orden == 'DELETE_DIR':
+        raiz = os.path.abspath(sesion.ruta or '.')
+        if os.path.abspath(rutas[0]) == raiz:
+            emisor.terminar("Error: No se puede borrar el directorio raíz.")
+            return
+        emisor.terminar(borrar_arbol(rutas[0], emisor))
+    elif orden == 'DELETE_FILES':
+        emisor.terminar(borrar_arbol(rutas[0], emisor, patron, recursivo))
+    elif orden == 'COPY_DIR':
+        emisor.terminar(copiar_arbol(rutas[0], rutas[1], emisor))
+    else:
+        emisor.terminar(arbol(rutas[0], emisor))
+
+
+# Comandos que necesitan la conexión, además de la respuesta, y se atienden en atender_transferencia
+COMANDOS_ARBOL = ('DELETE_DIR', 'COPY_DIR', 'DELETE_FILES', 'TREE')
+COMANDOS_TRANSFERENCIA = ('DOWNLOAD_FILE', 'UPLOAD_FILE', 'UPLOAD_PART', 'FIRMAS', 'UPLOAD_DELTA', 'UPLOAD_DIR', 'DOWNLOAD_DIR') + COMANDOS_ARBOL
+# Comandos que no tocan ficheros ni SQLite: el motor asyncio los ejecuta en el bucle de eventos
+COMANDOS_INMEDIATOS = ('HELP', 'CAPACIDADES', 'STATS', 'SHUTDOWN')
+
+
+class Conexiones:
+    """Registro de las conexiones abiertas que están esperando su siguiente comando.
+    Al apagar el servidor se cierran para no esperar a que venza su tiempo de inactividad."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inactivas = set()
+        self._cerrando = False
+
+    @contextmanager
+    def espera(self, conn):
+        """Marca la conexión como inactiva mientras se espera el siguiente comando."""
+        with self._lock:
+            if self._cerrando:
+                # El servidor se está apagando: la conexión no recibirá más comandos
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            else:
+                self._inactivas.add(conn)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._inactivas.discard(conn)
+
+    def cerrar_inactivas(self):
+        with self._lock:
+            self._cerrando = True
+            for conn in self._inactivas:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._inactivas.clear()
+
+
+# Límites (en segundos) de las cubetas del histograma de latencias: potencias de 2 desde
+# 0,1 ms hasta ~52 s, más una última sin límite. Así la cubeta sale de un bit_length.
+LIMITES_LATENCIA = tuple(0.0001 * 2 ** i for i in range(20))
+NS_CUBETA = 100_000     # 0,1 ms, el primer límite, en nanosegundos
+LOTE_METRICAS = 256     # Peticiones que un hilo apunta antes de sumarlas a sus contadores
+
+
+class ContadoresHilo:
+    """Contadores de un hilo (ver Metricas): comando -> [nanosegundos, errores, bytes
+    recibidos, bytes enviados, cubetas...], las peticiones aún sin sumar y [bytes recibidos,
+    bytes enviados] del contenido de las transferencias (sin comprimir). Solo escribe en ellos
+    su hilo; lock protege las sumas frente a quien los lee."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.comandos = {}
+        self.pendientes = []
+        self.contenido = [0, 0]
+
+    @staticmethod
+    def fila(comandos, comando):
+        f = comandos.get(comando)
+        if f is None:
+            # Con el protocolo de texto llega cualquier palabra: las desconocidas van juntas
+            if comando not in protocolo.OPERACIONES:
+                comando = 'UNKNOWN_COMMAND'
+            f = comandos.setdefault(comando, [0] * (len(LIMITES_LATENCIA) + 5))
+        return f
+
+    @staticmethod
+    def sumar(comandos, peticiones):
+        ultima = len(LIMITES_LATENCIA)
+        for comando, ns, recibidos, enviados in peticiones:
+            f = comandos.get(comando) or ContadoresHilo.fila(comandos, comando)
+            f[0] += ns
+            f[2] += recibidos
+            f[3] += enviados
+            cubeta = (ns // NS_CUBETA).bit_length()
+            f[4 + (cubeta if cubeta < ultima else ultima)] += 1
+
+    def acumular(self):
+        """Suma las peticiones pendientes a los contadores (desde el propio hilo)."""
+        with self.lock:
+            self.sumar(self.comandos, self.pendientes)
+            self.pendientes.clear()
+
+    def leer(self):
+        """Copia de los contadores, con las peticiones pendientes sumadas (desde cualquier
+        hilo): (comandos, contenido)."""
+        with self.lock:
+            comandos = {comando: list(f) for comando, f in self.comandos.items()}
+            peticiones = self.pendientes[:]
+        self.sumar(comandos, peticiones)
+        return comandos, list(self.contenido)
+
+
+class Metricas:
+    """Contadores del servidor que se consultan con STATS o se vuelcan a un fichero en el
+    formato de texto de Prometheus (--metricas): peticiones, errores e histograma de latencias
+    por comando, bytes recibidos y enviados, conexiones abiertas y en cola.
+
+    Apuntar una petición tiene que costar muy poco frente a atenderla. Cada hilo tiene sus
+    propios contadores y apunta sus peticiones en una lista; cada LOTE_METRICAS las suma de
+    una vez (el mismo código sobre datos en caché, mucho más barato que sumar una a una entre
+    petición y petición). Solo esa suma y las lecturas (STATS o el volcado) toman el cerrojo
+    del hilo. La memoria no crece con las peticiones: por comando hay un contador por cubeta."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._hilos = []            # ContadoresHilo de cada hilo que ha apuntado algo
+        self.conexiones = 0         # Conexiones abiertas
+        self.cola = 0               # Conexiones o transferencias esperando un hilo libre
+        self.inicio = time.time()
+        self.worker = None          # Número del proceso con --workers: cada uno cuenta lo suyo
+
+    def _propios(self):
+        """Contadores del hilo actual."""
+        try:
+            return self._local.propios
+        except AttributeError:
+            propios = self._local.propios = ContadoresHilo()
+            with self._lock:
+                self._hilos.append(propios)
+            return propios
+
+    def peticion(self, comando, ns, recibidos=0, enviados=0):
+        """Apunta una petición atendida en ns nanosegundos (de time.perf_counter_ns), con los
+        bytes de la petición y de su respuesta (el contenido de las transferencias lo apuntan
+        ellas)."""
+        try:
+            pendientes = self._local.pendientes
+        except AttributeError:
+            pendientes = self._local.pendientes = self._propios().pendientes
+        pendientes.append((comando, ns, recibidos, enviados))
+        if len(pendientes) >= LOTE_METRICAS:
+            self._local.propios.acumular()
+
+    def error(self, comando):
+        """Apunta que la respuesta a un comando ha sido un error."""
+        propios = self._propios()
+        with propios.lock:
+            propios.fila(propios.comandos, comando)[1] += 1
+
+    def recibidos(self, n):
+        self._propios().contenido[0] += n
+
+    def enviados(self, n):
+        self._propios().contenido[1] += n
+
+    def conexion(self, n):
+        """Suma n (1 al abrir, -1 al cerrar) a las conexiones abiertas."""
+        with self._lock:
+            self.conexiones += n
+
+    def encolar(self, n):
+        """Suma n (1 al encolar, -1 al empezar) a lo que espera un hilo libre."""
+        with self._lock:
+            self.cola += n
+
+    def _sumar(self):
+        """Suma los contadores de todos los hilos: ({comando: fila}, recibidos, enviados)."""
+        with self._lock:
+            hilos = list(self._hilos)
+        total = {}
+        recibidos = enviados = 0
+        for propios in hilos:
+            comandos, contenido = propios.leer()
+            recibidos += contenido[0]
+            enviados += contenido[1]
+            for comando, fila in comandos.items():
+                recibidos += fila[2]
+                enviados += fila[3]
+                suma = total.get(comando)
+                total[comando] = list(fila) if suma is None else [a + b for a, b in zip(suma, fila)]
+        return total, recibidos, enviados
+
+    @staticmethod
+    def cuantil(cubetas, q):
+        """Estimación del cuantil q (0-1) a partir de las cubetas del histograma, interpolando
+        dentro de la cubeta en la que cae (como histogram_quantile de Prometheus)."""
+        objetivo = q * sum(cubetas)
+        acumulado = 0
+        for i, n in enumerate(cubetas):
+            if n and acumulado + n >= objetivo:
+                if i == len(LIMITES_LATENCIA):
+                    return LIMITES_LATENCIA[-1]  # Más allá del último límite no sabemos cuánto
+                inferior = LIMITES_LATENCIA[i - 1] if i else 0.0
+                return inferior + (LIMITES_LATENCIA[i] - inferior) * (objetivo - acumulado) / n
+            acumulado += n
+        return 0.0
+
+    def resumen(self):
+        """Respuesta de STATS: totales y, por comando, peticiones, errores y latencias en ms."""
+        comandos, recibidos, enviados = self._sumar()
+        segundos = max(time.time() - self.inicio, 1e-9)
+        peticiones = sum(sum(fila[4:]) for fila in comandos.values())
+        errores = sum(fila[1] for fila in comandos.values())
+        lineas = [f"SUCCESS: {peticiones} peticiones ({errores} con error) en {segundos:.0f} s, "
+                  f"{peticiones / segundos:.1f}/s; {self.conexiones} conexiones abiertas, {self.cola} en cola; "
+                  f"{recibidos} bytes recibidos ({recibidos / segundos / (1 << 20):.2f} MiB/s), "
+                  f"{enviados} enviados ({enviados / segundos / (1 << 20):.2f} MiB/s)"
+                  + (f"; solo el worker {self.worker}" if self.worker is not None else ""),
+                  "comando\tpeticiones\terrores\tmedia_ms\tp50_ms\tp99_ms"]
+        for comando, fila in sorted(comandos.items()):
+            cubetas = fila[4:]
+            n = sum(cubetas)
+            media = fila[0] / n / 1e9 if n else 0.0
+            lineas.append(f"{comando}\t{n}\t{fila[1]}\t{media * 1000:.3f}\t"
+                          f"{self.cuantil(cubetas, 0.5) * 1000:.3f}\t{self.cuantil(cubetas, 0.99) * 1000:.3f}")
+        return "\n".join(lineas)
+
+    def prometheus(self):
+        """Las métricas en el formato de texto de Prometheus (versión 0.0.4)."""
+        comandos, recibidos, enviados = self._sumar()
+        comandos = sorted(comandos.items())
+        # Con --workers cada proceso vuelca lo suyo con la etiqueta worker, para poder sumarlos
+        w = f'worker="{self.worker}"' if self.worker is not None else ""
+        sin_comando = f"{{{w}}}" if w else ""
+        et = {c: f'{{comando="{c}"{"," + w if w else ""}}}' for c, _ in comandos}
+        lineas = [
+            "# HELP servidor_peticiones_total Peticiones atendidas por comando.",
+            "# TYPE servidor_peticiones_total counter",
+        ]
+        lineas += [f'servidor_peticiones_total{et[c]} {sum(f[4:])}' for c, f in comandos]
+        lineas += [
+            "# HELP servidor_errores_total Peticiones respondidas con un error, por comando.",
+            "# TYPE servidor_errores_total counter",
+        ]
+        lineas += [f'servidor_errores_total{et[c]} {f[1]}' for c, f in comandos]
+        lineas += [
+            "# HELP servidor_latencia_segundos Tiempo que se tarda en atender cada petición.",
+            "# TYPE servidor_latencia_segundos histogram",
+        ]
+        for comando, fila in comandos:
+            acumulado = 0
+            for limite, n in zip([f"{l:g}" for l in LIMITES_LATENCIA] + ["+Inf"], fila[4:]):
+                acumulado += n
+                lineas.append(f'servidor_latencia_segundos_bucket{et[comando][:-1]},le="{limite}"}} {acumulado}')
+            lineas.append(f'servidor_latencia_segundos_sum{et[comando]} {fila[0] / 1e9:.6f}')
+            lineas.append(f'servidor_latencia_segundos_count{et[comando]} {acumulado}')
+        lineas += [
+            "# HELP servidor_bytes_recibidos_total Bytes de comandos y contenidos recibidos (sin comprimir).",
+            "# TYPE servidor_bytes_recibidos_total counter",
+            f"servidor_bytes_recibidos_total{sin_comando} {recibidos}",
+            "# HELP servidor_bytes_enviados_total Bytes de respuestas y contenidos enviados (sin comprimir).",
+            "# TYPE servidor_bytes_enviados_total counter",
+            f"servidor_bytes_enviados_total{sin_comando} {enviados}",
+            "# HELP servidor_conexiones Conexiones abiertas.",
+            "# TYPE servidor_conexiones gauge",
+            f"servidor_conexiones{sin_comando} {self.conexiones}",
+            "# HELP servidor_cola Conexiones o transferencias esperando un hilo libre.",
+            "# TYPE servidor_cola gauge",
+            f"servidor_cola{sin_comando} {self.cola}",
+            "# HELP servidor_inicio_segundos Hora de arranque del servidor (segundos desde 1970).",
+            "# TYPE servidor_inicio_segundos gauge",
+            f"servidor_inicio_segundos{sin_comando} {self.inicio:.3f}",
+        ]
+        return "\n".join(lineas) + "\n"
+
+    def volcar(self, fichero):
+        """Escribe prometheus() en fichero de forma atómica (temporal y os.replace), para que
+        quien lo lea (p. ej. el textfile collector de node_exporter) nunca lo vea a medias."""
+        temporal = f"{fichero}.{os.getpid()}.tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(temporal, fichero)
+
+
+metricas = Metricas()
+
+def volcar_metricas(fichero, intervalo, apagado):
+    """Hilo que vuelca las métricas en fichero cada intervalo segundos hasta que se activa
+    apagado (un threading.Event), y una última vez al terminar."""
+    while not apagado.wait(intervalo):
+        try:
+            metricas.volcar(fichero)
+        except OSError as e:
+            print("Error al volcar las métricas:", e)
+    try:
+        metricas.volcar(fichero)
+    except OSError as e:
+        print("Error al volcar las métricas:", e)
+
+
+def _respuesta(op, texto, etiqueta=0, compresion=0):
+    """protocolo.respuesta, apuntando en las métricas si es un error."""
+    trama = protocolo.respuesta(op, texto, etiqueta, compresion)
+    if trama[3] == protocolo.ESTADO_ERROR:  # El byte del estado (ver protocolo.CABECERA)
+        metricas.error(protocolo.NOMBRES.get(op, ''))
+    return trama
+
+
+def _respuesta_texto(orden, texto):
+    """La respuesta codificada para el protocolo de texto, apuntando si es un error."""
+    if protocolo.es_error(texto):
+        metricas.error(orden)
+    return texto.encode("utf-8")
+
+
+def _leer_comando(data):
+    """Convierte lo recibido en (lista de palabras del comando, token de sesión o None). El
+    token se comprueba aparte con _usar_token: puede ser una consulta a SQLite (--workers)."""
+    data_str=data.decode("ascii", errors="ignore") #Convertir de binario a string con data.decode(codificación, errores) en codificación ascii e ignorando errores de conversión
+    data_list, token = _separar_token(data_str.split())  #Convierte cada palabra de la cadena en un vector
+    registro.debug("Got command: %s", " ".join(data_list))
+    return data_list, token
+
+
+def _leer_peticion(cab, carga):
+    """Convierte una trama de petición en (lista de palabras del comando, token o None)."""
+    data_list = [protocolo.NOMBRES.get(cab.operacion, "")] + protocolo.leer_argumentos(carga)
+    data_list, token = _separar_token(data_list, cab.flags)
+    registro.debug("Got command: %s", " ".join(data_list))
+    return data_list, token
+
+
+def _error_version(cab):
+    texto = f"Error: versión de protocolo {cab.version} no soportada (el servidor usa la {protocolo.VERSION})."
+    return protocolo.trama(cab.operacion, texto.encode("utf-8"), protocolo.ESTADO_VERSION, cab.etiqueta)
+
+
+def _atender_texto(conn, sesion, tam_buf, conexiones, ceder=False):
+    """Bucle de comandos del protocolo de texto. Devuelve True si se pidió SHUTDOWN.
+    Con ceder vuelve (devolviendo None) en cuanto no queda nada por leer, en vez de esperar."""
+    while True:
+        if ceder and not _hay_datos(conn):
+            return None
+        with conexiones.espera(conn):
+            data=conn.recv(tam_buf) # Recibimos datos -> recv(tamaño del buffer)
+        if not data: # Si no se reciben datos --> se ha desconectado
+            return False
+
+        data_list, token = _leer_comando(data)
+        _usar_token(sesion, token)
+        if not data_list:
+            _enviar(conn, "UNKNOWN_COMMAND")
+            continue
+
+        orden = data_list[0].upper()
+        inicio = time.perf_counter_ns()
+        respuesta = b""
+        if orden in COMANDOS_TRANSFERENCIA:
+            atender_transferencia(conn, data_list, sesion)
+        else:
+            respuesta = _respuesta_texto(orden, ejecutar_comando(data_list, sesion))
+            conn.sendall(respuesta)
+        metricas.peticion(orden, time.perf_counter_ns() - inicio, len(data), len(respuesta))
+        if orden == 'SHUTDOWN':
+            return True
+
+
+def _compresion_admitida(flags):
+    """Flags de compresión de una petición, o 0 si el algoritmo no es uno de los nuestros."""
+    flags &= protocolo.MASCARA_COMPRESION
+    return flags if (flags & 0x0F) in protocolo.COMPRESORES.values() else 0
+
+
+def _hay_datos(conn):
+    """Indica si ya ha llegado algo más por la conexión (sin esperar)."""
+    return bool(select.select([conn], [], [], 0)[0])
+
+
+MAX_SALIDA = 64 << 10   # Bytes de respuestas acumuladas antes de enviarlas aunque queden peticiones
+
+
+def _atender_tramas(conn, sesion, conexiones, ceder=False):
+    """Bucle de comandos del protocolo binario. Devuelve True si se pidió SHUTDOWN.
+    Si el cliente manda peticiones seguidas sin esperar las respuestas (cliente.py --lote),
+    las respuestas de texto se acumulan mientras haya más peticiones esperando y se envían
+    juntas: menos llamadas a send y menos paquetes pequeños. Con ceder vuelve (devolviendo
+    None) en cuanto no queda nada por leer, en vez de esperar la siguiente petición."""
+    salida = bytearray()
+    try:
+        while True:
+            pendiente = not (salida or ceder) or _hay_datos(conn)
+            if salida and (len(salida) >= MAX_SALIDA or not pendiente):
+                conn.sendall(salida)
+                salida.clear()
+            if ceder and not pendiente:
+                return None
+            with conexiones.espera(conn):
+                cab = protocolo.recibir_cabecera(conn)
+            if cab is None:
+                return False
+            if cab.version != protocolo.VERSION:
+                salida += _error_version(cab)
+                return False
+            if cab.longitud > protocolo.MAX_ARGUMENTOS:
+                raise protocolo.ErrorProtocolo("Error: petición demasiado grande.")
+
+            data_list, token = _leer_peticion(cab, protocolo.recibir_exacto(conn, cab.longitud))
+            _usar_token(sesion, token)
+            orden = data_list[0]
+            sesion.compresion = _compresion_admitida(cab.flags)
+            sesion.resumen = bool(cab.flags & protocolo.FLAG_RESUMEN)
+            inicio = time.perf_counter_ns()
+            respuesta = b""
+            if orden in COMANDOS_TRANSFERENCIA:
+                if salida:
+                    conn.sendall(salida)
+                    salida.clear()
+                atender_transferencia(conn, data_list, sesion, cab.etiqueta)
+            else:
+                respuesta = _respuesta(cab.operacion, ejecutar_comando(data_list, sesion), cab.etiqueta, sesion.compresion)
+                salida += respuesta
+            metricas.peticion(orden, time.perf_counter_ns() - inicio, protocolo.CABECERA.size + cab.longitud, len(respuesta))
+            if orden == 'SHUTDOWN':
+                return True
+    finally:
+        if salida:
+            try:
+                conn.sendall(salida)
+            except OSError:
+                pass
+
+
+def _atender(conn, addr, sesion, tam_buf, conexiones, detectar=True, ceder=False):
+    """Atiende los comandos que llegan por una conexión. Con detectar, el primer byte indica
+    si el cliente usa el protocolo de texto o el de tramas (si no, ya lo dice sesion.binario).
+    Devuelve True si el cliente ha pedido apagar el servidor, False si la conexión ha terminado
+    y None si, con ceder, no queda nada por leer y la conexión sigue abierta."""
+    try:
+        if detectar:
+            with conexiones.espera(conn):
+                primero = conn.recv(1, socket.MSG_PEEK)
+            if not primero:
+                return False
+            sesion.binario = primero[0] == protocolo.MAGIA
+        if sesion.binario:
+            return _atender_tramas(conn, sesion, conexiones, ceder)
+        return _atender_texto(conn, sesion, tam_buf, conexiones, ceder)
+
+    except socket.timeout:
+        print(f"Conexión {addr[0]}: {addr[1]} cerrada por inactividad")
+        return False
+    except protocolo.ErrorProtocolo as e:
+        print(e)
+        try:
+            conn.sendall(protocolo.trama(protocolo.OP_ERROR, str(e).encode("utf-8"), protocolo.ESTADO_ERROR))
+        except OSError:
+            pass
+        return False
+    except (ConnectionError, BrokenPipeError):
+        print('Error: conexión cerrada en el otro extremo')
+        return False
+
+
+def atender_conexion(conn, addr, sesion, tam_buf, conexiones=None, inactividad=None):
+    """Atiende los comandos que llegan por una conexión persistente hasta que el cliente la
+    cierra o pasan 'inactividad' segundos sin recibir nada.
+    Devuelve True si el cliente ha pedido apagar el servidor."""
+    print(f"Aceptado un cliente con (IP, puerto)-> {addr[0]}: {addr[1]}" )
+    if conexiones is None:
+        conexiones = Conexiones()
+    conn.settimeout(inactividad)
+    protocolo.sin_retardo(conn)
+    metricas.conexion(1)
+    try:
+        return _atender(conn, addr, sesion, tam_buf, conexiones)
+    finally:
+        #Cerrar conexión -> close()
+        metricas.conexion(-1)
+        conn.close()
+
+
+def servir_secuencial(servidor, tam_buf, inactividad=None):
+    """Motor no concurrente: atiende las conexiones de una en una.
+    Mantiene una única sesión para todo el servidor, como hacía la versión original.
+    Mientras un cliente mantenga su conexión abierta, el resto espera."""
+    sesion = Sesion()
+    shutdown = False # Variable flag que controla si queremos finalizar el servidor. En el caso de que reciba 'shutdown' terminará su ejecución.
+    while not shutdown:
+        # 4. Aceptamos cliente accept()
+        conn, addr = servidor.accept()
+        shutdown = atender_conexion(conn, addr, sesion, tam_buf, inactividad=inactividad)
+
+
+# Motor hilos: conexiones abiertas como mucho (sin contar las que esperan en el backlog).
+# _hay_datos usa select, que no admite descriptores por encima de 1023.
+MAX_CONEXIONES = 512
+# Segundos que una petición a medias puede tener ocupado un hilo sin que llegue nada más
+PLAZO_PETICION = 30
+
+
+def servir_hilos(servidor, tam_buf, hilos, cola, inactividad=None):
+    """Motor concurrente: reparte las peticiones entre un pool acotado de hilos.
+    Las conexiones abiertas sin nada que leer no ocupan hilo: esperan en un selector del hilo
+    principal (junto con accept) y pasan al pool cuando llega algo. El hilo atiende todas las
+    peticiones que haya seguidas y devuelve la conexión al selector. Como mucho hay 'hilos'
+    conexiones atendiéndose y 'cola' esperando hilo; las demás con datos esperan su turno
+    fuera del pool. Cada conexión tiene su propia Sesion.
+    SIGTERM (p. ej. del supervisor de --workers) apaga el servidor igual que SHUTDOWN.
+    Devuelve True si se ha apagado con SHUTDOWN."""
+    apagado = threading.Event()
+    shutdown = threading.Event()
+    plazas = threading.BoundedSemaphore(hilos + cola)
+    conexiones = Conexiones()
+    selector = selectors.DefaultSelector()
+    abiertas = {}                   # conn -> [addr, Sesion, cierre por inactividad (None si no está en el selector), protocolo detectado]
+    listas = deque()                # Conexiones con algo que leer a la espera de plaza en el pool
+    devueltas = queue.SimpleQueue() # (conn, resultado) que los hilos devuelven al hilo principal
+    despertador, aviso = socket.socketpair()
+    plazo = min(inactividad, PLAZO_PETICION) if inactividad else PLAZO_PETICION
+
+    def tarea(conn, addr, sesion, detectar):
+        metricas.encolar(-1)
+        resultado = False
+        try:
+            if not apagado.is_set():
+                resultado = _atender(conn, addr, sesion, tam_buf, conexiones, detectar, ceder=True)
+            if resultado:
+                shutdown.set()
+                apagado.set()
+                conexiones.cerrar_inactivas()
+        finally:
+            plazas.release()
+            devueltas.put((conn, resultado))
+            aviso.send(b"\0")
+
+    def cerrar(conn):
+        del abiertas[conn]
+        metricas.conexion(-1)
+        conn.close()
+
+    def esperar(conn):
+        """Vuelve a dejar la conexión en el selector hasta que llegue algo."""
+        abiertas[conn][2] = time.monotonic() + inactividad if inactividad else None
+        selector.register(conn, selectors.EVENT_READ)
+
+    def repartir():
+        while listas and plazas.acquire(blocking=False):
+            conn = listas.popleft()
+            addr, sesion, _, detectado = abiertas[conn]
+            abiertas[conn][3] = True
+            metricas.encolar(1)
+            pool.submit(tarea, conn, addr, sesion, not detectado)
+
+    signal.signal(signal.SIGTERM, lambda *_: apagado.set())
+
+    servidor.setblocking(False)
+    selector.register(servidor, selectors.EVENT_READ)
+    selector.register(despertador, selectors.EVENT_READ)
+    escuchando = True
+    revision = time.monotonic()
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='conexion') as pool:
+        # Timeout en select() para poder comprobar periódicamente si se ha pedido SHUTDOWN
+        while not apagado.is_set():
+            for clave, _ in selector.select(timeout=0.5):
+                if clave.fileobj is servidor:
+                    try:
+                        conn, addr = servidor.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    print(f"Aceptado un cliente con (IP, puerto)-> {addr[0]}: {addr[1]}" )
+                    conn.settimeout(plazo)
+                    protocolo.sin_retardo(conn)
+                    metricas.conexion(1)
+                    abiertas[conn] = [addr, Sesion(), None, False]
+                    esperar(conn)
+                elif clave.fileobj is despertador:
+                    despertador.recv(4096)
+                else:
+                    selector.unregister(clave.fileobj)
+                    abiertas[clave.fileobj][2] = None
+                    listas.append(clave.fileobj)
+            while not devueltas.empty():
+                conn, resultado = devueltas.get()
+                if resultado is None and not apagado.is_set():
+                    esperar(conn)
+                else:
+                    cerrar(conn)
+            repartir()
+
+            ahora = time.monotonic()
+            if inactividad and ahora - revision >= 0.5:
+                revision = ahora
+                for conn, (addr, _, cierre, _) in list(abiertas.items()):
+                    if cierre is not None and cierre <= ahora:
+                        print(f"Conexión {addr[0]}: {addr[1]} cerrada por inactividad")
+                        selector.unregister(conn)
+                        cerrar(conn)
+            # Con demasiadas conexiones abiertas, las nuevas esperan en el backlog del socket
+            if escuchando != (len(abiertas) < MAX_CONEXIONES):
+                escuchando = not escuchando
+                if escuchando:
+                    selector.register(servidor, selectors.EVENT_READ)
+                else:
+                    selector.unregister(servidor)
+        conexiones.cerrar_inactivas()
+    while not devueltas.empty():
+        devueltas.get()
+    for conn in list(abiertas):
+        cerrar(conn)
+    selector.close()
+    despertador.close()
+    aviso.close()
+    return shutdown.is_set()
+
+
+async def _esperar_datos(loop, conn):
+    """Espera a que haya algo que leer en la conexión (o a que se cierre) sin consumirlo."""
+    legible = loop.create_future()
+    loop.add_reader(conn.fileno(), lambda: legible.done() or legible.set_result(None))
+    try:
+        await legible
+    finally:
+        loop.remove_reader(conn.fileno())
+
+
+async def _recibir_exacto_async(loop, conn, n):
+    datos = bytearray()
+    while len(datos) < n:
+        bloque = await loop.sock_recv(conn, n - len(datos))
+        if not bloque:
+            raise ConnectionError("conexión cerrada a mitad de una trama")
+        datos += bloque
+    return bytes(datos)
+
+
+async def _transferir_async(loop, conn, data_list, sesion, token, etiqueta=0):
+    """Ejecuta atender_transferencia en el executor, con el socket en modo bloqueante (y antes
+    comprueba allí el token, ver _ejecutar_async)."""
+
+    def transferir():
+        metricas.encolar(-1)
+        _usar_token(sesion, token)
+        atender_transferencia(conn, data_list, sesion, etiqueta)
+
+    conn.setblocking(True)
+    metricas.encolar(1)
+    try:
+        await loop.run_in_executor(None, transferir)
+    finally:
+        conn.setblocking(False)
+
+
+async def _ejecutar_async(loop, orden, sesion, token, responder):
+    """Recupera la sesión del token y ejecuta responder(), que construye la respuesta de un
+    comando. Los COMANDOS_INMEDIATOS sin token se ejecutan en el bucle de eventos; el resto lee
+    ficheros o consulta SQLite (HASH, SHARE, SEARCH, listados, los tokens con --workers...) y
+    va al executor para no detener al resto de conexiones."""
+    if orden in COMANDOS_INMEDIATOS and token is None:
+        return responder()
+
+    def ejecutar():
+        metricas.encolar(-1)
+        _usar_token(sesion, token)
+        return responder()
+
+    metricas.encolar(1)
+    return await loop.run_in_executor(None, ejecutar)
+
+
+async def _atender_texto_async(loop, conn, sesion, tam_buf, conexiones, inactividad):
+    while True:
+        with conexiones.espera(conn):
+            data = await asyncio.wait_for(loop.sock_recv(conn, tam_buf), inactividad)
+        if not data:
+            return False
+
+        data_list, token = _leer_comando(data)
+        if not data_list:
+            await loop.sock_sendall(conn, "UNKNOWN_COMMAND".encode("utf-8"))
+            continue
+
+        orden = data_list[0].upper()
+        inicio = time.perf_counter_ns()
+        respuesta = b""
+        if orden in COMANDOS_TRANSFERENCIA:
+            await _transferir_async(loop, conn, data_list, sesion, token)
+        else:
+            respuesta = await _ejecutar_async(loop, orden, sesion, token, lambda: _respuesta_texto(orden, ejecutar_comando(data_list, sesion)))
+            await loop.sock_sendall(conn, respuesta)
+        metricas.peticion(orden, time.perf_counter_ns() - inicio, len(data), len(respuesta))
+        if orden == 'SHUTDOWN':
+            return True
+
+
+async def _atender_tramas_async(loop, conn, sesion, conexiones, inactividad):
+    while True:
+        with conexiones.espera(conn):
+            primero = await asyncio.wait_for(loop.sock_recv(conn, 1), inactividad)
+        if not primero:
+            return False
+        cab = protocolo.leer_cabecera(primero + await _recibir_exacto_async(loop, conn, protocolo.CABECERA.size - 1))
+        if cab.version != protocolo.VERSION:
+            await loop.sock_sendall(conn, _error_version(cab))
+            return False
+        if cab.longitud > protocolo.MAX_ARGUMENTOS:
+            raise protocolo.ErrorProtocolo("Error: petición demasiado grande.")
+
+        data_list, token = _leer_peticion(cab, await _recibir_exacto_async(loop, conn, cab.longitud))
+        orden = data_list[0]
+        sesion.compresion = _compresion_admitida(cab.flags)
+        sesion.resumen = bool(cab.flags & protocolo.FLAG_RESUMEN)
+        inicio = time.perf_counter_ns()
+        respuesta = b""
+        if orden in COMANDOS_TRANSFERENCIA:
+            await _transferir_async(loop, conn, data_list, sesion, token, cab.etiqueta)
+        else:
+            respuesta = await _ejecutar_async(loop, orden, sesion, token,
+                                              lambda: _respuesta(cab.operacion, ejecutar_comando(data_list, sesion),
+                                                                 cab.etiqueta, sesion.compresion))
+            await loop.sock_sendall(conn, respuesta)
+        metricas.peticion(orden, time.perf_counter_ns() - inicio, protocolo.CABECERA.size + cab.longitud, len(respuesta))
+        if orden == 'SHUTDOWN':
+            return True
+
+
+async def atender_conexion_async(conn, addr, sesion, tam_buf, conexiones, inactividad=None):
+    """Versión asyncio de atender_conexion. Solo los COMANDOS_INMEDIATOS se ejecutan en el bucle
+    de eventos; el resto de comandos y las transferencias (E/S de ficheros y SQLite bloqueantes)
+    se hacen en un hilo del executor."""
+    loop = asyncio.get_running_loop()
+    print(f"Aceptado un cliente con (IP, puerto)-> {addr[0]}: {addr[1]}" )
+    metricas.conexion(1)
+    try:
+        with conexiones.espera(conn):
+            await asyncio.wait_for(_esperar_datos(loop, conn), inactividad)
+        primero = conn.recv(1, socket.MSG_PEEK)
+        if not primero:
+            return False
+        sesion.binario = primero[0] == protocolo.MAGIA
+        if sesion.binario:
+            return await _atender_tramas_async(loop, conn, sesion, conexiones, inactividad)
+        return await _atender_texto_async(loop, conn, sesion, tam_buf, conexiones, inactividad)
+
+    except asyncio.TimeoutError:
+        print(f"Conexión {addr[0]}: {addr[1]} cerrada por inactividad")
+        return False
+    except protocolo.ErrorProtocolo as e:
+        print(e)
+        try:
+            await loop.sock_sendall(conn, protocolo.trama(protocolo.OP_ERROR, str(e).encode("utf-8"), protocolo.ESTADO_ERROR))
+        except OSError:
+            pass
+        return False
+    except (ConnectionError, BrokenPipeError):
+        print('Error: conexión cerrada en el otro extremo')
+        return False
+    finally:
+        metricas.conexion(-1)
+        conn.close()
+
+
+async def _servir_asyncio(servidor, tam_buf, hilos, inactividad):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='transferencia'))
+    apagado = asyncio.Event()
+    shutdown = False
+    tareas = set()
+    conexiones = Conexiones()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, apagado.set)
+    except NotImplementedError:
+        pass    # Windows
+
+    async def atender(conn, addr):
+        nonlocal shutdown
+        if await atender_conexion_async(conn, addr, Sesion(), tam_buf, conexiones, inactividad):
+            shutdown = True
+            apagado.set()
+
+    async def aceptar():
+        while True:
+            conn, addr = await loop.sock_accept(servidor)
+            conn.setblocking(False)
+            protocolo.sin_retardo(conn)
+            tarea = loop.create_task(atender(conn, addr))
+            tareas.add(tarea)
+            tarea.add_done_callback(tareas.discard)
+
+    aceptador = loop.create_task(aceptar())
+    await apagado.wait()
+    aceptador.cancel()
+    # Cerramos las conexiones inactivas y dejamos terminar las que estaban en curso
+    conexiones.cerrar_inactivas()
+    if tareas:
+        await asyncio.gather(*tareas, return_exceptions=True)
+    return shutdown
+
+
+def servir_asyncio(servidor, tam_buf, hilos, inactividad=None):
+    """Motor asyncio: un único bucle de eventos atiende todas las conexiones, de modo que una
+    conexión abierta cuesta una corrutina en lugar de un hilo. 'hilos' acota el executor
+    donde se hacen las transferencias de ficheros. SIGTERM apaga el servidor igual que
+    SHUTDOWN. Devuelve True si se ha apagado con SHUTDOWN."""
+    # Con miles de conexiones el límite de descriptores por defecto (1024) se queda corto
+    try:
+        import resource
+        blando, duro = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if duro == resource.RLIM_INFINITY or blando < duro:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (duro, duro))
+    except (ImportError, ValueError, OSError):
+        pass
+    servidor.setblocking(False)
+    return asyncio.run(_servir_asyncio(servidor, tam_buf, hilos, inactividad))
+
+
+def servir(servidor, args, fichero_metricas=None):
+    """Atiende las conexiones del socket servidor con el motor de --engine hasta que se apaga.
+    Con fichero_metricas vuelca en él las métricas cada --intervalo_metricas segundos.
+    Devuelve True si se ha apagado con SHUTDOWN."""
+    # Volcado periódico de las métricas, p. ej. para el textfile collector de node_exporter
+    fin_metricas = threading.Event()
+    volcador = None
+    if fichero_metricas:
+        volcador = threading.Thread(target=volcar_metricas, args=(fichero_metricas, max(args.intervalo_metricas, 0.1), fin_metricas), daemon=True)
+        volcador.start()
+    try:
+        if args.engine == 'hilos':
+            return servir_hilos(servidor, args.tam_buf, args.hilos, args.cola, args.inactividad)
+        if args.engine == 'asyncio':
+            return servir_asyncio(servidor, args.tam_buf, args.hilos, args.inactividad)
+        servir_secuencial(servidor, args.tam_buf, args.inactividad)
+        return True
+    finally:
+        if volcador:
+            fin_metricas.set()
+            volcador.join()
+
+
+def socket_servidor(ip, puerto, cola, reuseport=False):
+    """Socket TCP escuchando en (ip, puerto). Con reuseport (SO_REUSEPORT) varios procesos
+    pueden abrir cada uno el suyo en el mismo puerto y el núcleo reparte entre ellos las
+    conexiones entrantes. Con cola None solo se liga, sin escuchar."""
+    servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    servidor.bind((ip, puerto))
+    if cola is not None:
+        servidor.listen(cola)
+    return servidor
+
+
+def admite_reuseport():
+    """Indica si el sistema permite SO_REUSEPORT en un socket TCP."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        return False
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as prueba:
+        try:
+            prueba.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except OSError:
+            return False
+    return True
+
+
+def trabajador(numero, args, compartido=None):
+    """Cuerpo de cada proceso de --workers: abre su propio socket con SO_REUSEPORT (o usa el
+    compartido que ha abierto el supervisor) y lo atiende como un servidor de un solo proceso.
+    Si recibe SHUTDOWN se lo avisa al supervisor, que apaga a los demás."""
+    # Ctrl+C llega a todo el grupo de procesos: el que apaga los workers es el supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    metricas.worker = numero
+    metricas.inicio = time.time()
+    resumenes_subida.activo = False
+    servidor = compartido or socket_servidor(args.ip, args.puerto, socket.SOMAXCONN, reuseport=True)
+    fichero_metricas = None
+    if args.metricas:
+        base, extension = os.path.splitext(args.metricas)
+        fichero_metricas = f"{base}-{numero}{extension}"
+    print(f"Worker {numero} (pid {os.getpid()}) esperando conexiones por el puerto {args.puerto}")
+    if servir(servidor, args, fichero_metricas):
+        os.kill(os.getppid(), signal.SIGTERM)
+    servidor.close()
+
+
+class Supervisor:
+    """--workers N: N procesos, cada uno con su bucle de accept y su motor (hilos o asyncio),
+    para que el trabajo de CPU (resúmenes, compresión, interpretar las peticiones) se reparta
+    entre varios núcleos en lugar de competir por un único GIL. Con SO_REUSEPORT cada proceso
+    abre su propio socket en el puerto y el núcleo reparte las conexiones; si el sistema no lo
+    admite, comparten un socket que abre el supervisor antes de crearlos.
+
+    El supervisor solo vigila: reinicia los procesos que terminan sin que se haya pedido
+    (con una espera creciente si fallan nada más arrancar) y, cuando uno recibe SHUTDOWN o el
+    supervisor recibe SIGTERM o SIGINT, manda SIGTERM a todos. Cada uno deja terminar lo que
+    estaba atendiendo, como con SHUTDOWN; pasados PLAZO_APAGADO segundos se matan."""
+
+    PLAZO_APAGADO = 30
+    ARRANQUE_FALLIDO = 1.0      # Un proceso que termina antes de esto ha fallado al arrancar
+    MAX_ESPERA = 10.0           # Espera máxima antes de reintentar un arranque fallido
+
+    def __init__(self, args):
+        self.args = args
+        self.procesos = {}          # número -> multiprocessing.Process
+        self.arrancado = {}         # número -> time.monotonic() del último arranque
+        self.fallos = {}            # número -> arranques fallidos seguidos
+        self.pendientes = {}        # número -> time.monotonic() a partir del que se reinicia
+        self.compartido = None
+        self.apagando = False
+        self.contexto = multiprocessing.get_context("fork")
+
+    def abrir(self):
+        """Comprueba que el puerto está libre y decide cómo se reparten las conexiones."""
+        if admite_reuseport():
+            # Solo ligado, sin escuchar: no recibe conexiones, únicamente comprueba el puerto
+            socket_servidor(self.args.ip, self.args.puerto, None, reuseport=True).close()
+            return "SO_REUSEPORT, un socket por proceso"
+        self.compartido = socket_servidor(self.args.ip, self.args.puerto, socket.SOMAXCONN)
+        return "sin SO_REUSEPORT, un socket compartido"
+
+    def arrancar(self, numero):
+        sys.stdout.flush()      # Si no, cada proceso hereda y vuelve a escribir lo pendiente
+        proceso = self.contexto.Process(target=trabajador, args=(numero, self.args, self.compartido),
+                                        name=f"worker-{numero}", daemon=True)
+        proceso.start()
+        self.procesos[numero] = proceso
+        self.arrancado[numero] = time.monotonic()
+
+    def parar(self, *_):
+        self.apagando = True
+
+    def terminado(self, numero):
+        """Un proceso ha terminado sin que se haya pedido: se programa su reinicio."""
+        proceso = self.procesos.pop(numero)
+        proceso.join()
+        if time.monotonic() - self.arrancado[numero] < self.ARRANQUE_FALLIDO:
+            self.fallos[numero] = self.fallos.get(numero, 0) + 1
+        else:
+            self.fallos[numero] = 0
+        espera = min(0.1 * 2 ** self.fallos[numero], self.MAX_ESPERA) if self.fallos[numero] else 0
+        print(f"Worker {numero} (pid {proceso.pid}) terminado con código {proceso.exitcode}; se reinicia"
+              + (f" en {espera:.1f} s" if espera else ""))
+        self.pendientes[numero] = time.monotonic() + espera
+
+    def ejecutar(self):
+        signal.signal(signal.SIGTERM, self.parar)
+        signal.signal(signal.SIGINT, self.parar)
+        for numero in range(1, self.args.workers + 1):
+            self.arrancar(numero)
+        try:
+            while not self.apagando:
+                listos = multiprocessing.connection.wait([p.sentinel for p in self.procesos.values()], timeout=0.5)
+                if self.apagando:
+                    break   # SHUTDOWN en un worker: avisa con SIGTERM antes de terminar
+                for numero, proceso in list(self.procesos.items()):
+                    if proceso.sentinel in listos:
+                        self.terminado(numero)
+                ahora = time.monotonic()
+                for numero, cuando in list(self.pendientes.items()):
+                    if cuando <= ahora:
+                        del self.pendientes[numero]
+                        self.arrancar(numero)
+        finally:
+            self.apagar()
+
+    def apagar(self):
+        for proceso in self.procesos.values():
+            if proceso.is_alive():
+                proceso.terminate()
+        limite = time.monotonic() + self.PLAZO_APAGADO
+        for numero, proceso in self.procesos.items():
+            proceso.join(max(limite - time.monotonic(), 0))
+            if proceso.is_alive():
+                print(f"Worker {numero} (pid {proceso.pid}) no ha terminado en {self.PLAZO_APAGADO} s; se mata")
+                proceso.kill()
+                proceso.join()
+        if self.compartido:
+            self.compartido.close()
+
+
 if __name__ == '__main__':
 
     #--EXTRA--
@@ -459,23 +3949,77 @@ if __name__ == '__main__':
     """
 
     # Definimos el parseador. Por convenio, los argumentos opcionales se encabezan con '--'
-    parser = ap.ArgumentParser(prog=sys.argv[0], description='Un servidor no concurrente TCP de hola mundo')
+    parser = ap.ArgumentParser(prog=sys.argv[0], description='Un servidor TCP de ficheros')
     parser.add_argument('--ip', help='IP del servidor', default='0.0.0.0')
     parser.add_argument('--puerto', type=int, help='Puerto TCP de salida', default=5005, choices=range(1024,65535), metavar='1024-65535') 
-    parser.add_argument('--tam_buf', type=int, help='Longitud del buffer interno', default=4096) # Buffer corto para que responda antes
+    parser.add_argument('--tam_buf', type=int, help='Longitud del buffer interno (también el de recepción de ficheros)', default=65536)
+    parser.add_argument('--reservar', action='store_true', help='Reservar en disco el tamaño de cada fichero subido antes de recibirlo (posix_fallocate)')
+    parser.add_argument('--durabilidad', help='Cuándo hacer fsync de los ficheros subidos: ninguna, cierre (al terminar) o periodica (cada --fsync_mib MiB)', default='ninguna', choices=('ninguna', 'cierre', 'periodica'))
+    parser.add_argument('--fsync_mib', type=int, help='MiB recibidos entre fsync con --durabilidad periodica', default=64)
+    parser.add_argument('--cache_listados', type=int, help='Nombres de fichero que guarda como mucho la caché de listados (0 = sin caché)', default=500_000)
+    parser.add_argument('--ttl_sesion', type=float, help='Segundos sin usarse tras los que caduca el token de una sesión', default=3600)
+    parser.add_argument('--max_sesiones', type=int, help='Sesiones abiertas como mucho (se descartan las usadas hace más tiempo)', default=10_000)
+    parser.add_argument('--metricas', help='Fichero donde volcar periódicamente las métricas (STATS) en el formato de texto de Prometheus')
+    parser.add_argument('--intervalo_metricas', type=float, help='Segundos entre dos volcados de --metricas', default=15)
+    parser.add_argument('--indice', help='Base de datos SQLite con el índice de ficheros de los usuarios (SEARCH)', default='indice.sqlite')
+    parser.add_argument('--compactar_usuarios', action='store_true', help='Al arrancar, reescribe usuarios.txt sin líneas vacías, incorrectas ni repetidas')
+    parser.add_argument('--engine', help='Motor del servidor: secuencial (una conexión cada vez), hilos (pool concurrente) o asyncio (bucle de eventos)', default='secuencial', choices=('secuencial', 'hilos', 'asyncio'))
+    parser.add_argument('--hilos', type=int, help='Número de hilos del pool (motor hilos) o del executor de transferencias (motor asyncio)', default=8)
+    parser.add_argument('--cola', type=int, help='Conexiones con peticiones a la espera de un hilo libre (motor hilos)', default=32)
+    parser.add_argument('--hilos_arbol', type=int, help='Hilos que reparten la E/S de las operaciones recursivas (DELETE_DIR recursivo=1, COPY_DIR, DELETE_FILES, TREE)', default=8)
+    parser.add_argument('--inactividad', type=float, help='Segundos sin recibir comandos tras los que se cierra una conexión persistente', default=300)
+    parser.add_argument('--workers', type=int, help='Procesos que atienden el puerto, cada uno con el motor de --engine (hilos o asyncio), para repartir la CPU entre varios núcleos', default=1)
+    parser.add_argument('--depurar', action='store_true', help='Mostrar cada comando recibido (trazas de depuración)')
     
     # Parseamos los argumentos de acuerdo al parser
     args = parser.parse_args(sys.argv[1:])  #parseamos lo que viene de la línea de comandos desde el 1
+    if args.workers < 1:
+        parser.error("--workers tiene que ser al menos 1")
+    if args.workers > 1:
+        if args.engine == 'secuencial':
+            # El motor secuencial comparte una única sesión entre todas las conexiones
+            parser.error("--workers necesita --engine hilos o asyncio")
+        if "fork" not in multiprocessing.get_all_start_methods():
+            parser.error("--workers necesita un sistema con fork (Linux, macOS)")
+        # Los procesos comparten las sesiones: el token de LOGIN vale en cualquiera de ellos
+        descriptor, fichero_sesiones = tempfile.mkstemp(prefix="sesiones-", suffix=".sqlite")
+        os.close(descriptor)
+        sesiones = SesionesCompartidas(fichero_sesiones)
+    if args.depurar:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    ajustes.tam_buf = args.tam_buf
+    ajustes.reservar = args.reservar
+    ajustes.durabilidad = args.durabilidad
+    ajustes.fsync_mib = args.fsync_mib
+    ajustes.hilos_arbol = max(args.hilos_arbol, 1)
+    listados.max_nombres = args.cache_listados
+    sesiones.ttl = args.ttl_sesion
+    sesiones.max_sesiones = args.max_sesiones
+    indice.fichero = args.indice
+
+    if args.compactar_usuarios:
+        print("Usuarios registrados:", usuarios.compactar())
+
+    # Al arrancar se limpian los blobs que hayan quedado sin referencias
+    print("Almacén de contenidos:", recolectar_blobs())
+    # Y el índice de ficheros se pone al día con lo que haya cambiado sin pasar por el servidor
+    print("Índice de ficheros:", indice.reconciliar())
 
     #--EXTRA--
 
-    #Información para actividad extra: Se debería controlar con una ruta de usuario para saber si se ha iniciado sesión, o no, y en que directorio personal guardar los mensajes.
-    #Puedes usar esta variable
-
-    usuario_actual = None
-    ruta_usuario = ''
+    #Información para actividad extra: la sesión (usuario y ruta de usuario) vive en un objeto Sesion por conexión.
+    #Al principio la ruta está vacía para indicar al usuario que debe iniciar sesión antes de realizar cualquier otra acción
 
-    #Al principio debería estar vacía para indicar al usuario que debe iniciar sesión antes de realizar cualquier otra acción
+    if args.workers > 1:
+        indice.cerrar()
+        supervisor = Supervisor(args)
+        try:
+            print(f"Servidor configurado con {args.workers} workers ({supervisor.abrir()}), esperando conexiones por el puerto", args.puerto)
+            supervisor.ejecutar()
+        finally:
+            sesiones.borrar()
+        print('Cerrando el servidor')
+        sys.exit(0)
 
     #INICIALIZACIÓN DEL SOCKET
     # Inicializacmos el servidor: empezamos a esperar conexiones. Para más información consulte: https://wiki.python.org/moin/HowTo/Sockets
@@ -487,217 +4031,14 @@ if __name__ == '__main__':
     # 2. Lo ligamos a una IP y puerto -> bind(ip, port)
     
     servidor.bind((args.ip, args.puerto))
-    # 3. Podemos encolar hasta una solicitud -> listen(cantidad de conexiones en cola)
-    servidor.listen(1)
-
-    shutdown = False # Variable flag que controla si queremos finalizar el servidor. En el caso de que reciba 'shutdown' terminará su ejecución.
+    # 3. Encolamos solicitudes -> listen(cantidad de conexiones en cola). El motor secuencial solo admite una.
+    servidor.listen(1 if args.engine == 'secuencial' else socket.SOMAXCONN)
 
     print ("Servidor configurado, esperando conexiones por el puerto", args.puerto)
 
-    
-    
-    while not shutdown:
-        # 4. Aceptamos cliente accept()
-        conn, addr = servidor.accept()
-        print(f"Aceptado un cliente con (IP, puerto)-> {addr[0]}: {addr[1]}" )
-
-        try:
-            data=conn.recv(args.tam_buf) # Recibimos datos -> recv(tamaño del buffer)
-            if not data: # Si no se reciben datos --> se ha desconectado
-                break
-            
-            data_str=data.decode("ascii", errors="ignore") #Convertir de binario a string con data.decode(codificación, errores) en codificación ascii e ignorando errores de conversión
-
-            data_list = data_str.split()#Convierte cada palabra de la cadena en un vector 
-
-            print ('Got command:', data_str)
-
-            orden = data_list[0].upper()     #La orden se corresponde con la primera palabra (convertimos en mayuscula)
-            
-            #AYUDA PARA REALIZAR LOS BLOQUES DE CÓDIGO DE COMANDOS
-            #Aquí entramos en la elección para que el servidor ejecute la orden que se solicita, usar la función send(mensaje).
-            #El mensaje previamente deberia estar codificado en ascii con la función encode(codificación).
-            #Previamente al envío de datos, se debe comprobar los errores, de haber alguno, la información que tiene que enviar el servidor es de un error para que el cliente interprete la información.
-
-            #--EXTRA--
-            #Deberiamos encapsular esto dentro de otro bloque donde se compruebe si el usuario ha iniciado sesión con la variable que se dió anteriormente.
-            if orden == 'SHUTDOWN':
-
-                #Cambiar el estado del server a shutdown
-                shutdown = True
-                conn.sendall(b"Servidor apagandose...\n")
-                print("Servidor apagándose por orden del cliente.")
-                conn.close()
-                break
-                
-            elif (orden == 'LIST_FILES'):
-                # Si hay sesión, por defecto listamos el directorio del usuario
-                ruta = data_list[1] if len(data_list) > 1 else (ruta_usuario if ruta_usuario else ".")
-                if ruta_usuario:
-                    ok, ruta_res, err = _resolver_ruta_usuario(ruta_usuario, ruta)
-                    response = listar_ficheros(ruta_res) if ok else err
-                else:
-                    response = listar_ficheros(ruta)
-                conn.sendall(response.encode("ascii"))
-
-            elif orden == 'DOWNLOAD_FILE':
-                if len(data_list) > 1:
-                    fichero = data_list[1]
-                    if ruta_usuario:
-                        ok, fich_res, err = _resolver_ruta_usuario(ruta_usuario, fichero)
-                        if not ok:
-                            conn.sendall(err.encode("ascii"))
-                        else:
-                            descargar_fichero(conn, fich_res)
-                    else:
-                        descargar_fichero(conn, fichero)
-                else:
-                    response = "Error: Debes especificar el fichero a descargar."
-                    conn.sendall(response.encode("ascii"))
-
-            elif orden == 'DELETE_FILE':
-                if len(data_list) > 1:
-                    fichero = data_list[1]   # nombre o ruta del fichero a borrar
-                    if ruta_usuario:
-                        ok, fich_res, err = _resolver_ruta_usuario(ruta_usuario, fichero)
-                        response = borrar_fichero(fich_res) if ok else err
-                    else:
-                        response = borrar_fichero(fichero)
-                    conn.sendall(response.encode("ascii"))
-                else:
-                    response = "ERROR"
-                    conn.sendall(response.encode("ascii"))
-
-            elif orden == 'UPLOAD_FILE':
-                if len(data_list) > 1:
-                    fichero = data_list[1]
-                    # Guardar en el directorio del usuario si hay sesión
-                    dest_dir = ruta_usuario if ruta_usuario else None
-                    subir_fichero(conn, fichero, dest_dir=dest_dir)
-                else:
-                    response = "Error: Debes especificar un nombre de fichero."
-                    conn.sendall(response.encode("ascii"))
-
-            elif orden == 'MOVE_FILE':
-                if len(data_list) > 2:
-                    fichero = data_list[1]
-                    destino = data_list[2]
-                    if ruta_usuario:
-                        ok1, fich_res, err1 = _resolver_ruta_usuario(ruta_usuario, fichero)
-                        ok2, dest_res, err2 = _resolver_ruta_usuario(ruta_usuario, destino)
-                        if not ok1:
-                            conn.sendall(err1.encode("ascii"))
-                        elif not ok2:
-                            conn.sendall(err2.encode("ascii"))
-                        else:
-                            response = mover_fichero(fich_res, dest_res)
-                            conn.sendall(response.encode("ascii"))
-                    else:
-                        response = mover_fichero(fichero, destino)
-                        conn.sendall(response.encode("ascii"))
-                else:
-                    response = "Error: Debes especificar fichero y destino."
-                    conn.sendall(response.encode("ascii"))
-
-            elif orden == 'CREATE_DIR':
-                if len(data_list) > 1:
-                    nombre = data_list[1]
-                    if ruta_usuario:
-                        ok, ruta_res, err = _resolver_ruta_usuario(ruta_usuario, nombre)
-                        response = crear_directorio(ruta_res) if ok else err
-                    else:
-                        response = crear_directorio(nombre)
-                else:
-                    response = "Error: Debes especificar un nombre de directorio."
-                conn.sendall(response.encode("ascii"))
-
-            elif orden == 'DELETE_DIR':
-                if len(data_list) > 1:
-                    nombre = data_list[1]
-                    if ruta_usuario:
-                        ok, ruta_res, err = _resolver_ruta_usuario(ruta_usuario, nombre)
-                        response = borrar_directorio(ruta_res) if ok else err
-                    else:
-                        response = borrar_directorio(nombre)
-                else:
-                    response = "ERROR: Debes especificar un nombre de directorio."
-                conn.sendall(response.encode("ascii"))
-
-            elif orden == 'LIST_DIR':
-                ruta = data_list[1] if len(data_list) > 1 else (ruta_usuario if ruta_usuario else ".")
-                if ruta_usuario:
-                    ok, ruta_res, err = _resolver_ruta_usuario(ruta_usuario, ruta)
-                    response = listar_directorio(ruta_res) if ok else err
-                else:
-                    response = listar_directorio(ruta)
-                conn.sendall(response.encode("ascii"))
+    servir(servidor, args, args.metricas)
 
-            elif orden == 'HELP':
-                conn.sendall(help().encode())
-
-            elif orden == 'RENAME_FILE':
-                if len(data_list) < 3:
-                    response = "RENAME_ERROR"
-                    conn.sendall(response.encode("ascii"))
-                else:
-                    fichero = data_list[1]
-                    nuevo_nombre = data_list[2]
-                    if ruta_usuario:
-                        ok1, fich_res, err1 = _resolver_ruta_usuario(ruta_usuario, fichero)
-                        ok2, nuevo_res, err2 = _resolver_ruta_usuario(ruta_usuario, nuevo_nombre)
-                        if not ok1:
-                            conn.sendall(err1.encode("ascii"))
-                        elif not ok2:
-                            conn.sendall(err2.encode("ascii"))
-                        else:
-                            response = renombrar_fichero(fich_res, nuevo_res)
-                            conn.sendall(response.encode("ascii"))
-                    else:
-                        response = renombrar_fichero(fichero, nuevo_nombre)
-                        conn.sendall(response.encode("ascii"))
-
-            
-            elif orden == 'LOGIN':
-                if len(data_list) < 3:
-                    conn.sendall("ERROR: Uso LOGIN <usuario> <contrasenia>.".encode("ascii"))
-                else:
-                    usr = data_list[1]
-                    pwd = data_list[2]
-                    ok, ruta, msg = iniciar_sesion(usr, pwd)
-                    if ok:
-                        usuario_actual = usr
-                        ruta_usuario = ruta
-                    conn.sendall(msg.encode("ascii"))
-
-            elif orden == 'SING_IN':
-                if len(data_list) < 4:
-                    conn.sendall("ERROR: Uso SING_IN <usuario> <contrasenia> <confirmacion>.".encode("ascii"))
-                else:
-                    usr = data_list[1]
-                    pwd = data_list[2]
-                    conf = data_list[3]
-                    response = registrar_usuario(usr, pwd, conf)
-                    conn.sendall(response.encode("ascii"))
-
-            elif orden == 'SHARE':
-                if len(data_list) < 3:
-                    conn.sendall("ERROR: Uso SHARE <fichero> <usuario_destino>.".encode("ascii"))
-                elif not ruta_usuario:
-                    conn.sendall("ERROR: Debes iniciar sesión antes de usar SHARE.".encode("ascii"))
-                else:
-                    fichero = data_list[1]
-                    usr_dest = data_list[2]
-                    response = compartir_fichero(fichero, usr_dest, ruta_usuario)
-                    conn.sendall(response.encode("ascii"))
-
-            else:
-                conn.sendall("UNKNOWN_COMMAND".encode("ascii"))
-
-        except ConnectionResetError:
-            print('Error: conexión cerrada en el otro extremo')
-        #Cerrar conexión -> close()
-        conn.close()
     print('Cerrando el servidor')
     
     #Cerrar socket -> close()
-    servidor.close()
\ No newline at end of file
+    servidor.close()